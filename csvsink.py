@@ -0,0 +1,181 @@
+"""Where the CSV files go: buffered, optionally compressed, optionally written by a thread
+
+Writing the CSV files used to be plain open() calls with the default (8 KB) buffering, so on a
+slow or network file system the parser spent much of its time waiting on small writes. A CsvSink
+decides how the files are written:
+
+compression: None for plain CSV, "gzip" (.csv.gz) or "zstd" (.csv.zst, needs the zstandard
+    package). Compressed files are several times smaller, which is usually a good trade when the
+    disk is the bottleneck; zstd compresses about as well as gzip at a fraction of the CPU time.
+buffer_size: how many bytes to collect before each write to the file (1 MB by default).
+directory: where the files go (by default, the current directory).
+threaded: if True, the compressing and writing happen in a separate thread, and the parser just
+    hands over a buffer when it's full and carries on. zlib and zstd let go of the interpreter
+    lock while they work, so this really does run at the same time as the parser.
+
+open_csv_source() reads any of these back, going by the first bytes of the file, so the code that
+loads the CSV files into the DB doesn't need to know how they were written.
+
+A gzip or zstd file can be several compressed streams one after the other, which is how the
+parallel parser glues its pieces together (see parseosm.generate_csvs_parallel)."""
+
+from __future__ import print_function
+import gzip
+import io
+import os
+import queue
+import threading
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+# how many full buffers the writer thread can fall behind by before the parser has to wait
+THREAD_QUEUE_BUFFERS = 8
+
+def check_compression(compression):
+    """Raises ValueError if we can't write this kind of compression"""
+    if compression not in COMPRESSIONS:
+        raise ValueError("unknown compression: " + repr(compression))
+    if (compression == "zstd") and (zstandard is None):
+        raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+
+class ThreadedWriter(io.BufferedIOBase):
+    """A write-only binary stream that collects what's written to it into buffers and hands them
+to a thread, which writes them to the real stream. close() waits for the thread to finish and
+closes the real stream. If the thread hits an error, the next write or close raises it."""
+    def __init__(self, stream, buffer_size):
+        super().__init__()
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.pending = bytearray()
+        self.queue = queue.Queue(THREAD_QUEUE_BUFFERS)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """The writer thread: writes buffers until it gets None"""
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is None:
+                try:
+                    self.stream.write(chunk)
+                except Exception as err: # handed over to the parser thread
+                    self.error = err
+
+    def check_error(self):
+        """Raises the writer thread's error, if it had one"""
+        if self.error is not None:
+            raise self.error
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.check_error()
+        self.pending.extend(data)
+        if len(self.pending) >= self.buffer_size:
+            self.queue.put(bytes(self.pending))
+            self.pending = bytearray()
+        return len(data)
+
+    def flush(self):
+        # the thread does the writing; close() waits for it
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        if self.pending:
+            self.queue.put(bytes(self.pending))
+            self.pending = bytearray()
+        self.queue.put(None)
+        self.thread.join()
+        self.stream.close()
+        super().close()
+        self.check_error()
+
+class GzipWriter(io.BufferedIOBase):
+    """A gzip stream on top of a file we opened ourselves, which closes the file along with the
+stream (GzipFile leaves a file it was handed open)."""
+    def __init__(self, rawfile, level):
+        super().__init__()
+        self.rawfile = rawfile
+        self.stream = gzip.GzipFile(fileobj=rawfile, mode="wb", compresslevel=level)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.stream.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.stream.close()
+        self.rawfile.close()
+        super().close()
+
+class CsvSink:
+    """How to write the CSV files (see the top of this file). A CsvSink is just settings, so it can
+be handed to worker processes."""
+    def __init__(self, compression=None, buffer_size=DEFAULT_BUFFER_SIZE, threaded=False,
+                 level=None, directory=None):
+        check_compression(compression)
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.threaded = threaded
+        self.level = level
+        self.directory = directory
+
+    def filename(self, name):
+        """The name the file will actually have, with .gz or .zst added for compression, in our
+directory"""
+        name = name + COMPRESSIONS[self.compression]
+        if self.directory is not None:
+            name = os.path.join(self.directory, name)
+        return name
+
+    def open_binary(self, name):
+        """Opens the file for writing as a binary stream that compresses whatever is written to
+it"""
+        rawfile = open(self.filename(name), "wb", buffering=self.buffer_size)
+        if self.compression == "gzip":
+            stream = GzipWriter(rawfile, 6 if self.level is None else self.level)
+        elif self.compression == "zstd":
+            level = 3 if self.level is None else self.level
+            stream = zstandard.ZstdCompressor(level=level).stream_writer(rawfile)
+        else:
+            stream = rawfile
+        if self.threaded:
+            stream = ThreadedWriter(stream, self.buffer_size)
+        return stream
+
+    def open(self, name):
+        """Opens the file for writing CSV text, ready for csv.writer"""
+        return io.TextIOWrapper(self.open_binary(name), encoding="utf-8", newline="")
+
+def open_csv_source(filename):
+    """Opens a CSV file for reading, whether it's plain, gzip or zstd (we look at the first bytes
+to tell), as a text stream ready for csv.reader."""
+    with open(filename, "rb") as probe:
+        magic = probe.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(filename, "rt", encoding="utf-8", newline="")
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError(filename + " is zstd compressed, which needs the zstandard package")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"),
+                                                            read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(reader, encoding="utf-8", newline="")
+    return open(filename, encoding="utf-8", newline="")
@@ -0,0 +1,284 @@
+"""Memory-mapped storage for node locations
+
+To turn a way (a list of node ids) into coordinates we need the location of every node, and for
+anything bigger than a city a Python dictionary of them won't fit in memory. So we keep them in a
+file instead, as pairs of 32-bit ints in units of 1e-7 degrees (the precision of the OSM data), and
+map the file into memory. The operating system pages in what we use, and reading a location is just
+indexing into the mapped memory, with nothing copied or decoded.
+
+There are two layouts:
+
+dense: one 8-byte slot per possible node id, so a lookup is a single index, O(1). The file is as
+    big as the highest node id times 8 (about 90 GB for the planet), but it is created as a sparse
+    file, so only the parts that actually hold nodes take up disk space and memory. Best when the
+    extract holds a good share of all the node ids, or when the file system does sparse files.
+sparse: the node ids in one file (sorted) and their locations in another, 16 bytes per node that
+    is actually there. A lookup is a binary search, O(log n). Best for small and medium extracts,
+    whose node ids are spread thinly over the whole range.
+
+Files are in the byte order of the machine; they're scratch files, not for sharing."""
+
+from __future__ import print_function
+import array
+import bisect
+import mmap
+import os
+
+COORD_SCALE = 10000000
+
+# in the dense layout an all-zero slot means "no node here", so we store latitudes shifted up by
+# this much (latitudes only go from -900000000 to 900000000 in fixed point, so they still fit)
+DENSE_LAT_SHIFT = 1000000000
+
+# how much to grow the dense file by at a time, at least
+DENSE_GROW_BYTES = 1 << 24
+
+def to_fixed(degrees):
+    """Converts degrees (as a number or a string from the OSM file) to 1e-7 degree fixed point"""
+    return int(round(float(degrees) * COORD_SCALE))
+
+def file_footprint(filename):
+    """Returns (bytes the file appears to have, bytes of disk it actually takes up)"""
+    if not os.path.exists(filename):
+        return 0, 0
+    info = os.stat(filename)
+    allocated = info.st_size
+    if hasattr(info, "st_blocks"):
+        allocated = info.st_blocks * 512
+    return info.st_size, allocated
+
+class DenseNodeStore:
+    """Node locations in one slot per node id (see the top of this file)."""
+    layout = "dense"
+
+    def __init__(self, filename, create):
+        self.filename = filename
+        if create:
+            with open(filename, "wb"):
+                pass
+        self.nodefile = open(filename, "r+b")
+        self.mapped = None
+        self.slots = None
+        self.map_file()
+        self.count = 0
+        self.max_id = -1
+        if not create:
+            # we don't know how many slots are filled without reading the whole file
+            self.count = None
+            if self.slots is not None:
+                self.max_id = len(self.slots) // 2 - 1
+
+    def map_file(self):
+        """(Re)maps the file into memory, after it has been created or has grown"""
+        if self.slots is not None:
+            self.slots.release()
+            self.mapped.close()
+            self.slots = None
+            self.mapped = None
+        size = os.fstat(self.nodefile.fileno()).st_size
+        if size > 0:
+            self.mapped = mmap.mmap(self.nodefile.fileno(), size)
+            self.slots = memoryview(self.mapped).cast("i")
+
+    def set(self, node_id, lat, lon):
+        """Stores the location of a node (in degrees)"""
+        if node_id < 0:
+            raise ValueError("the dense node store can't hold negative node ids")
+        needed = (node_id + 1) * 8
+        size = 0
+        if self.slots is not None:
+            size = len(self.slots) * 4
+        if needed > size:
+            new_size = max(needed, size * 2, DENSE_GROW_BYTES)
+            new_size = ((new_size + DENSE_GROW_BYTES - 1) // DENSE_GROW_BYTES) * DENSE_GROW_BYTES
+            self.nodefile.truncate(new_size)
+            self.map_file()
+        if (self.slots[2 * node_id] == 0) and (self.count is not None):
+            self.count = self.count + 1
+        self.slots[2 * node_id] = to_fixed(lat) + DENSE_LAT_SHIFT
+        self.slots[2 * node_id + 1] = to_fixed(lon)
+        if node_id > self.max_id:
+            self.max_id = node_id
+
+    def finish(self):
+        """Called when all the nodes are in, to get ready for lookups"""
+        if self.mapped is not None:
+            self.mapped.flush()
+
+    def get(self, node_id):
+        """Returns the fixed point (lat, lon) of a node, or None if we don't have it"""
+        idx = 2 * node_id
+        if (self.slots is None) or (idx < 0) or (idx >= len(self.slots)):
+            return None
+        lat = self.slots[idx]
+        if lat == 0:
+            return None
+        return lat - DENSE_LAT_SHIFT, self.slots[idx + 1]
+
+    def footprint(self):
+        """Returns a dictionary with how many nodes we hold and how much space that takes"""
+        apparent, allocated = file_footprint(self.filename)
+        return {"layout": self.layout, "nodes": self.count, "max_id": self.max_id,
+                "mapped_bytes": apparent, "disk_bytes": allocated}
+
+    def close(self):
+        """Unmaps and closes the file"""
+        if self.slots is not None:
+            self.slots.release()
+            self.mapped.close()
+            self.slots = None
+            self.mapped = None
+        self.nodefile.close()
+
+class SparseNodeStore:
+    """Node locations as a sorted list of ids plus a list of locations (see the top of this
+file)."""
+    layout = "sparse"
+
+    def __init__(self, filename, create):
+        self.filename = filename
+        self.ids_filename = filename + ".ids"
+        self.coords_filename = filename + ".coords"
+        self.ids = None
+        self.coords = None
+        self.mappings = []
+        self.count = 0
+        self.max_id = -1
+        self.in_order = True
+        if create:
+            self.ids_file = open(self.ids_filename, "wb")
+            self.coords_file = open(self.coords_filename, "wb")
+            self.id_buffer = array.array("q")
+            self.coord_buffer = array.array("i")
+        else:
+            self.ids_file = None
+            self.coords_file = None
+            self.map_files()
+
+    def flush_buffers(self):
+        """Writes out the nodes collected so far"""
+        self.id_buffer.tofile(self.ids_file)
+        self.coord_buffer.tofile(self.coords_file)
+        self.id_buffer = array.array("q")
+        self.coord_buffer = array.array("i")
+
+    def set(self, node_id, lat, lon):
+        """Adds the location of a node (in degrees). OSM files list nodes in id order, which is
+what we want; if they come out of order we have to sort them in finish()."""
+        if node_id == self.max_id:
+            return
+        if node_id < self.max_id:
+            self.in_order = False
+        else:
+            self.max_id = node_id
+        self.id_buffer.append(node_id)
+        self.coord_buffer.append(to_fixed(lat))
+        self.coord_buffer.append(to_fixed(lon))
+        self.count = self.count + 1
+        if len(self.id_buffer) >= 65536:
+            self.flush_buffers()
+
+    def sort_files(self):
+        """Sorts the ids (and the locations with them). This has to hold everything in memory,
+which is why we'd rather get the nodes in order in the first place."""
+        ids = array.array("q")
+        coords = array.array("i")
+        with open(self.ids_filename, "rb") as idfile:
+            ids.frombytes(idfile.read())
+        with open(self.coords_filename, "rb") as coordfile:
+            coords.frombytes(coordfile.read())
+        order = sorted(range(len(ids)), key=lambda idx: ids[idx])
+        sorted_ids = array.array("q")
+        sorted_coords = array.array("i")
+        last_id = None
+        for idx in order:
+            if ids[idx] != last_id:
+                sorted_ids.append(ids[idx])
+                sorted_coords.append(coords[2 * idx])
+                sorted_coords.append(coords[2 * idx + 1])
+                last_id = ids[idx]
+        self.count = len(sorted_ids)
+        with open(self.ids_filename, "wb") as idfile:
+            sorted_ids.tofile(idfile)
+        with open(self.coords_filename, "wb") as coordfile:
+            sorted_coords.tofile(coordfile)
+
+    def map_files(self):
+        """Maps the id and location files into memory for lookups"""
+        for filename, code in [(self.ids_filename, "q"), (self.coords_filename, "i")]:
+            with open(filename, "rb") as mapfile:
+                size = os.fstat(mapfile.fileno()).st_size
+                if size == 0:
+                    view = memoryview(b"").cast(code)
+                else:
+                    mapped = mmap.mmap(mapfile.fileno(), size, access=mmap.ACCESS_READ)
+                    self.mappings.append(mapped)
+                    view = memoryview(mapped).cast(code)
+            if code == "q":
+                self.ids = view
+            else:
+                self.coords = view
+        self.count = len(self.ids)
+        if self.count > 0:
+            self.max_id = self.ids[-1]
+
+    def finish(self):
+        """Called when all the nodes are in, to write them out and map them for lookups"""
+        if self.ids_file is not None:
+            self.flush_buffers()
+            self.ids_file.close()
+            self.coords_file.close()
+            self.ids_file = None
+            self.coords_file = None
+            if not self.in_order:
+                self.sort_files()
+            self.map_files()
+
+    def get(self, node_id):
+        """Returns the fixed point (lat, lon) of a node, or None if we don't have it"""
+        idx = bisect.bisect_left(self.ids, node_id)
+        if (idx < len(self.ids)) and (self.ids[idx] == node_id):
+            return self.coords[2 * idx], self.coords[2 * idx + 1]
+        return None
+
+    def footprint(self):
+        """Returns a dictionary with how many nodes we hold and how much space that takes"""
+        ids_apparent, ids_allocated = file_footprint(self.ids_filename)
+        coords_apparent, coords_allocated = file_footprint(self.coords_filename)
+        return {"layout": self.layout, "nodes": self.count, "max_id": self.max_id,
+                "mapped_bytes": ids_apparent + coords_apparent,
+                "disk_bytes": ids_allocated + coords_allocated}
+
+    def close(self):
+        """Unmaps and closes the files"""
+        self.finish()
+        if self.ids is not None:
+            self.ids.release()
+            self.coords.release()
+            self.ids = None
+            self.coords = None
+        for mapped in self.mappings:
+            mapped.close()
+        self.mappings = []
+
+def open_node_store(filename, layout="sparse", create=True):
+    """Opens a node location store with the given layout ("dense" or "sparse"). With create True
+we start a new, empty one, otherwise we open one filled earlier."""
+    if layout == "dense":
+        return DenseNodeStore(filename, create)
+    if layout == "sparse":
+        return SparseNodeStore(filename, create)
+    raise ValueError("unknown node store layout: " + str(layout))
+
+def prt_footprint(store):
+    """Prints how much space a store takes, and how much the other layout would take for the same
+nodes, to help pick a layout for an extract."""
+    info = store.footprint()
+    print("Node store (" + info["layout"] + "):", info["nodes"], "nodes, highest id",
+          info["max_id"])
+    print("  mapped into memory:", info["mapped_bytes"], "bytes, on disk:", info["disk_bytes"],
+          "bytes")
+    if info["nodes"] is not None:
+        print("  dense layout would map", (info["max_id"] + 1) * 8, "bytes (" +
+              str(info["nodes"] * 8), "of them used); sparse layout would take",
+              info["nodes"] * 16, "bytes")
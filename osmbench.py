@@ -0,0 +1,615 @@
+"""Benchmarks for the parse -> load -> analyze pipeline in parseosm.py
+
+We don't want to need the real Lyon download (or any download) to see whether a change made
+things faster or slower, so we make up an OSM file of whatever size we like: nodes scattered over
+the Lyon area, tagged according to a tag distribution, ways through nearby nodes (some of them
+closed, like buildings), and multipolygon relations with holes in them. Some of the street names
+are the misspellings corrections.csv fixes, so the corrections have work to do.
+
+Then we run the stages of parseosm.main() one at a time in a scratch directory, and for each one
+record how long it took, how many rows it went through per second, the peak memory (resident set
+size) of the process during the stage, and how many bytes it wrote. The results go into a JSON
+file, and we can compare a run against an earlier one to catch regressions. With --profile each
+stage also runs under cProfile (the hot functions) or tracemalloc (the lines that allocate the
+most memory). With --compare-parsers we instead time the original XML parser against the fast one
+on the same file, and check they write the same rows. After the stages, --routes times that many
+shortest path searches over the routing graph the build_routing_graph stage wrote, with Dijkstra
+and with A* (see osmroute.py), along with how long the graph takes to open.
+
+Usage:
+    python osmbench.py --nodes 200000 --output after.json --compare before.json
+    python osmbench.py --nodes 50000 --profile cprofile --profile-stages analyze_osm_sql
+    python osmbench.py --nodes 300000 --compare-parsers
+    python osmbench.py --osm lyon.osm --routes 1000
+"""
+
+from __future__ import print_function
+import argparse
+import contextlib
+import cProfile
+import csv
+import hashlib
+import io
+import json
+import math
+import os
+import platform
+import pstats
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import csvsink
+import osmroute
+import parseosm
+
+# the area we scatter the nodes over (about the size of Lyon)
+BENCH_BOUNDS = (45.70, 4.75, 45.81, 4.93)
+
+# the tags we hand out: for each key, the chance that a tagged node or way gets it, and the values
+# to pick from
+TAG_DISTRIBUTION = [
+    ["amenity", 0.4, ["cafe", "restaurant", "bench", "parking", "school", "pharmacy", "bank"]],
+    ["addr:street", 0.3, ["Rue de la République", "Rue moliere", "GRANDE RUE",
+                          "Cours DOCTEUR LONG", "Quai Claude Bernard", "Avenue Jean Jaurès",
+                          "Boulevard du 11 novembre 1918", "Rue Garibaldi"]],
+    ["name", 0.3, ["Le Bouchon", "Place Bellecour", "Parc de la Tête d'Or", "Chez \"Paul\"",
+                   "Fourvière", "Les Halles"]],
+    ["surface", 0.1, ["asphalt", "paving_stones", "gravel", "sett"]],
+    ["natural", 0.05, ["tree", "water", "scrub"]],
+]
+
+# the tags for ways only (every way gets a highway or a building)
+WAY_TAGS = [
+    ["highway", ["residential", "primary", "secondary", "footway", "service", "tertiary"]],
+    ["building", ["yes", "house", "apartments", "church"]],
+]
+
+BENCH_USERS = [("alice", 1), ("bob", 2), ("cé'cile", 3), ("d\"an", 4), ("eve", 5), ("frank", 6)]
+
+STAGES = ["generate_csvs", "parse_csvs_into_sql", "apply_corrections_to_sql_db",
+          "build_spatial_index", "build_way_geometries", "build_multipolygons", "build_osm_stats",
+          "finish_osm_db", "build_routing_graph", "analyze_osm_sql"]
+
+PROFILERS = ["cprofile", "tracemalloc"]
+
+# ----------------------------------------------------------------
+# the synthetic OSM file
+
+def load_tag_distribution(filename):
+    """Reads a tag distribution from a JSON file: a list of [key, chance, [values...]], like
+TAG_DISTRIBUTION."""
+    with open(filename, encoding="utf-8") as tagfile:
+        distribution = json.load(tagfile)
+    for entry in distribution:
+        if (len(entry) != 3) or (not isinstance(entry[2], list)) or (not entry[2]):
+            raise ValueError(filename + ": each entry must be [key, chance, [values...]]")
+    return distribution
+
+def element_attributes(rng, elem_id, timestamp_day):
+    """The attributes every element has, as a string ready to go in the XML"""
+    user, uid = rng.choice(BENCH_USERS)
+    return "id=\"" + str(elem_id) + "\" version=\"" + str(rng.randint(1, 9)) + \
+           "\" timestamp=\"2017-01-" + "%02d" % timestamp_day + "T10:00:00Z\" changeset=\"" + \
+           str(rng.randint(1000, 99999)) + "\" uid=\"" + str(uid) + "\" user=" + quoteattr(user)
+
+def tag_lines(rng, tag_distribution):
+    """Picks the tags for one element"""
+    lines = []
+    for key, chance, values in tag_distribution:
+        if rng.random() < chance:
+            lines.append("    <tag k=" + quoteattr(key) + " v=" + quoteattr(rng.choice(values)) +
+                         "/>\n")
+    return lines
+
+def generate_osm(filename, num_nodes, num_ways=None, num_relations=None, tag_rate=0.2,
+                 tag_distribution=None, seed=1):
+    """Writes a made-up OSM XML file with num_nodes nodes (a share tag_rate of them tagged,
+according to tag_distribution), num_ways ways (by default a tenth of the nodes) and num_relations
+multipolygons (by default a twentieth of the ways). The same seed always gives the same file.
+Returns the number of elements written."""
+    if num_ways is None:
+        num_ways = num_nodes // 10
+    if num_relations is None:
+        num_relations = num_ways // 20
+    if tag_distribution is None:
+        tag_distribution = TAG_DISTRIBUTION
+    rng = random.Random(seed)
+    min_lat, min_lon, max_lat, max_lon = BENCH_BOUNDS
+    with open(filename, "w", encoding="utf-8") as osmfile:
+        osmfile.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
+        osmfile.write("<osm version=\"0.6\" generator=\"osmbench\">\n")
+        osmfile.write("  <bounds minlat=\"" + str(min_lat) + "\" minlon=\"" + str(min_lon) +
+                      "\" maxlat=\"" + str(max_lat) + "\" maxlon=\"" + str(max_lon) + "\"/>\n")
+        for node_id in range(1, num_nodes + 1):
+            lat = min_lat + rng.random() * (max_lat - min_lat)
+            lon = min_lon + rng.random() * (max_lon - min_lon)
+            start = "  <node " + element_attributes(rng, node_id, 1 + node_id % 28) + \
+                    " lat=\"%.7f\" lon=\"%.7f\"" % (lat, lon)
+            tags = []
+            if rng.random() < tag_rate:
+                tags = tag_lines(rng, tag_distribution)
+            if tags:
+                osmfile.write(start + ">\n" + "".join(tags) + "  </node>\n")
+            else:
+                osmfile.write(start + "/>\n")
+        # ways go through runs of nearby node ids; about a third are closed, like buildings
+        closed_ways = []
+        for way_num in range(1, num_ways + 1):
+            way_id = 1000000 + way_num
+            first = rng.randint(1, max(1, num_nodes - 12))
+            refs = [min(num_nodes, first + step) for step in range(rng.randint(2, 10))]
+            closed = (len(refs) >= 3) and (rng.random() < 0.35)
+            if closed:
+                refs.append(refs[0])
+                closed_ways.append(way_id)
+            osmfile.write("  <way " + element_attributes(rng, way_id, 1 + way_num % 28) + ">\n")
+            for ref in refs:
+                osmfile.write("    <nd ref=\"" + str(ref) + "\"/>\n")
+            key, values = WAY_TAGS[1 if closed else 0]
+            osmfile.write("    <tag k=\"" + key + "\" v=" + quoteattr(rng.choice(values)) + "/>\n")
+            osmfile.write("".join(tag_lines(rng, tag_distribution)))
+            osmfile.write("  </way>\n")
+        # each multipolygon has one or two closed ways as outer rings and maybe one as a hole
+        for rel_num in range(1, num_relations + 1):
+            if not closed_ways:
+                break
+            osmfile.write("  <relation " + element_attributes(rng, 2000000 + rel_num,
+                                                               1 + rel_num % 28) + ">\n")
+            members = [(way_id, "outer") for way_id in
+                       rng.sample(closed_ways, min(len(closed_ways), rng.randint(1, 2)))]
+            if rng.random() < 0.5:
+                members.append((rng.choice(closed_ways), "inner"))
+            for way_id, role in members:
+                osmfile.write("    <member type=\"way\" ref=\"" + str(way_id) + "\" role=\"" +
+                              role + "\"/>\n")
+            osmfile.write("    <tag k=\"type\" v=\"multipolygon\"/>\n")
+            osmfile.write("".join(tag_lines(rng, tag_distribution)))
+            osmfile.write("  </relation>\n")
+        osmfile.write("</osm>\n")
+    return num_nodes + num_ways + num_relations
+
+# ----------------------------------------------------------------
+# measuring
+
+def process_io():
+    """Returns the number of bytes this process has written so far (to files, pipes or anything
+else), if the operating system tells us, otherwise None."""
+    try:
+        with open("/proc/self/io") as iofile:
+            for line in iofile:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+def reset_peak_rss():
+    """Starts the peak memory count over, where the operating system lets us (Linux). Returns
+whether it worked; if not, the peak we report is the peak since the process started."""
+    try:
+        with open("/proc/self/clear_refs", "w") as refsfile:
+            refsfile.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+def peak_rss():
+    """The peak resident set size of this process in bytes (since the last reset_peak_rss)"""
+    try:
+        with open("/proc/self/status") as statusfile:
+            for line in statusfile:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+def dir_bytes(path):
+    """The total size of the files in a directory"""
+    total = 0
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        if os.path.isfile(full):
+            total = total + os.path.getsize(full)
+    return total
+
+def csv_rows(sink, tblname):
+    """The number of rows in one of the generated CSV files (not counting the header)"""
+    with csvsink.open_csv_source(sink.filename(tblname + ".csv")) as csvfile:
+        return sum(1 for row in csv.reader(csvfile)) - 1
+
+def table_rows(osmcu, tables):
+    """The total number of rows in some tables"""
+    return sum(osmcu.execute("SELECT COUNT(*) FROM " + tblname + ";").fetchone()[0]
+               for tblname in tables)
+
+def run_stage(name, function, profile, profile_dir, quiet):
+    """Runs one stage, under the profiler if asked to, with its output thrown away if quiet.
+Returns the number of seconds it took and the peak memory during the stage."""
+    profiler = None
+    if profile == "cprofile":
+        profiler = cProfile.Profile()
+    elif profile == "tracemalloc":
+        tracemalloc.start()
+    reset_peak_rss()
+    output = io.StringIO() if quiet else None
+    started = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if output is not None:
+            stack.enter_context(contextlib.redirect_stdout(output))
+        if profiler is not None:
+            profiler.enable()
+        try:
+            function()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    seconds = time.perf_counter() - started
+    peak = peak_rss()
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(profile_dir, name + ".prof"))
+        print("  hot spots in", name + ":")
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats("cumulative").print_stats(15)
+    elif profile == "tracemalloc":
+        snapshot = tracemalloc.take_snapshot()
+        current, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("  biggest allocations in", name, "(peak traced", traced_peak, "bytes):")
+        for stat in snapshot.statistics("lineno")[:10]:
+            print("   ", stat)
+    return seconds, peak
+
+# ----------------------------------------------------------------
+# the benchmark
+
+def run_benchmark(osm_file, workdir, profile=None, profile_stages=None, quiet=True,
+                  correct_while_parsing=False, sink=None, fast_parse=False, bulk_load=False):
+    """Runs the pipeline stages on osm_file in workdir (which gets a fresh lyon.db, and the
+lyon.graph routing graph next to it) and returns the list of results, one dictionary per stage.
+Unless correct_while_parsing is True, the tags are corrected in the DB by
+apply_corrections_to_sql_db, so that stage has something to do. profile is None, "cprofile" or
+"tracemalloc", and applies to the stages in profile_stages (all of them if None). sink says how to
+write the CSV files (see csvsink.py), fast_parse picks the fast XML parser, and bulk_load sets up
+the DB for bulk loading (see parseosm.set_up_osm_db)."""
+    if sink is None:
+        sink = csvsink.CsvSink()
+    osm_file = os.path.abspath(osm_file)
+    curdir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        if os.path.exists("lyon.db"):
+            os.remove("lyon.db")
+        osmconn, osmcu = parseosm.set_up_osm_db(True, bulk_load=bulk_load)
+        rules = parseosm.default_correction_rules()
+        parse_rules = rules if correct_while_parsing else parseosm.CorrectionRules([])
+        all_tables = parseosm.OSM_TABLES
+        tags_tables = [tblname for tblname in all_tables if tblname.endswith("_tags")]
+        stages = [
+            ("generate_csvs",
+             lambda: parseosm.generate_csvs(osm_file, rules=parse_rules, sink=sink,
+                                            fast=fast_parse),
+             lambda: sum(csv_rows(sink, tblname) for tblname in all_tables)),
+            ("parse_csvs_into_sql",
+             lambda: parseosm.parse_csvs_into_sql(osmconn, osmcu, sink=sink),
+             lambda: table_rows(osmcu, all_tables)),
+            ("apply_corrections_to_sql_db",
+             lambda: parseosm.apply_corrections_to_sql_db(osmconn, osmcu, rules),
+             lambda: table_rows(osmcu, tags_tables)),
+            ("build_spatial_index",
+             lambda: parseosm.build_spatial_index(osmconn, osmcu),
+             lambda: table_rows(osmcu, ["nodes", "ways_nodes"])),
+            ("build_way_geometries",
+             lambda: parseosm.build_way_geometries(osmconn, osmcu),
+             lambda: table_rows(osmcu, ["ways_nodes"])),
+            ("build_multipolygons",
+             lambda: parseosm.build_multipolygons(osmconn, osmcu),
+             lambda: table_rows(osmcu, ["relations_members"])),
+            ("build_osm_stats",
+             lambda: parseosm.build_osm_stats(osmconn, osmcu),
+             lambda: table_rows(osmcu, all_tables)),
+            ("finish_osm_db",
+             lambda: parseosm.finish_osm_db(osmconn, osmcu),
+             lambda: table_rows(osmcu, [tblname for idxname, tblname, columns
+                                        in parseosm.OSM_INDEXES])),
+            ("build_routing_graph",
+             lambda: osmroute.build_routing_graph(osmcu, "lyon.graph"),
+             lambda: table_rows(osmcu, ["ways_nodes"])),
+            ("analyze_osm_sql",
+             lambda: parseosm.analyze_osm_sql(osmcu),
+             lambda: table_rows(osmcu, all_tables)),
+        ]
+        results = []
+        for name, function, count_rows in stages:
+            stage_profile = profile
+            if (profile_stages is not None) and (name not in profile_stages):
+                stage_profile = None
+            written_before = process_io()
+            seconds, peak = run_stage(name, function, stage_profile, workdir, quiet)
+            written_after = process_io()
+            if written_before is None:
+                written = None
+            else:
+                written = written_after - written_before
+            rows = count_rows()
+            result = {"stage": name, "seconds": round(seconds, 4), "rows": rows,
+                      "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+                      "peak_rss_bytes": peak, "bytes_written": written,
+                      "files_bytes": dir_bytes(workdir)}
+            results.append(result)
+            print(name + ":", round(seconds, 3), "seconds,", rows, "rows,",
+                  int(result["rows_per_sec"] or 0), "rows/sec, peak RSS", peak, "bytes")
+        osmconn.close()
+    finally:
+        os.chdir(curdir)
+    return results
+
+def random_route_ends(graph, count, rng, max_steps=1000):
+    """Picks count (source, target) pairs of graph nodes to route between. Each target is where
+a random walk of up to max_steps edges from its source ends up, so there's always a route (on the
+synthetic files most pairs of random nodes aren't connected at all)."""
+    pairs = []
+    if graph.num_edges == 0:
+        return pairs
+    while len(pairs) < count:
+        source = rng.randrange(graph.num_nodes)
+        target = source
+        for step in range(rng.randint(1, max_steps)):
+            first = graph.offsets[target]
+            last = graph.offsets[target + 1]
+            if first == last:
+                break
+            target = graph.targets[rng.randrange(first, last)]
+        if target != source:
+            pairs.append((source, target))
+    return pairs
+
+def percentile(sorted_values, fraction):
+    """The value below which the given fraction of sorted_values falls (nearest rank)"""
+    rank = max(1, int(math.ceil(fraction * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+def bench_routes(graph_file, count, seed=1):
+    """Times opening a routing graph, and count shortest path searches over it with each method,
+on the same pairs of nodes. Checks that Dijkstra and A* find routes of the same length, and
+returns the timings (in milliseconds) as a dictionary."""
+    started = time.perf_counter()
+    graph = osmroute.RoutingGraph(graph_file)
+    open_ms = (time.perf_counter() - started) * 1000
+    results = {"graph_bytes": os.path.getsize(graph_file), "nodes": graph.num_nodes,
+               "edges": graph.num_edges, "open_ms": round(open_ms, 3), "routes": count}
+    print("Opened the routing graph (" + str(graph.num_nodes), "nodes,", graph.num_edges,
+          "edges) in", round(open_ms, 3), "ms")
+    try:
+        pairs = random_route_ends(graph, count, random.Random(seed))
+        distances = {"dijkstra": [], "astar": []}
+        for method in distances:
+            if not pairs:
+                break
+            latencies = []
+            settled = 0
+            for source, target in pairs:
+                started = time.perf_counter()
+                found = graph.shortest_path(source, target, method)
+                latencies.append((time.perf_counter() - started) * 1000)
+                distances[method].append(found[0])
+                settled = settled + found[2]
+            latencies.sort()
+            results[method] = {"p50_ms": round(percentile(latencies, 0.5), 3),
+                               "p99_ms": round(percentile(latencies, 0.99), 3),
+                               "mean_ms": round(sum(latencies) / len(latencies), 3),
+                               "mean_settled": round(settled / len(pairs), 1)}
+            print("%-8s p50 %.3f ms, p99 %.3f ms, mean %.3f ms, %.1f nodes settled on average" %
+                  (method, results[method]["p50_ms"], results[method]["p99_ms"],
+                   results[method]["mean_ms"], results[method]["mean_settled"]))
+        mismatches = sum(1 for old, new in zip(distances["dijkstra"], distances["astar"])
+                         if old != new)
+        results["mismatches"] = mismatches
+        if mismatches:
+            print("Dijkstra and A* disagree on", mismatches, "of", len(pairs), "routes!")
+    finally:
+        graph.close()
+    return results
+
+class CountingWriter:
+    """A writer that throws the rows away, just counting them, and if digest is True, hashing
+them too"""
+    def __init__(self, digest=False):
+        self.rows = 0
+        self.digest = hashlib.md5() if digest else None
+
+    def writerow(self, row):
+        self.rows = self.rows + 1
+        if self.digest is not None:
+            self.digest.update(repr(list(row)).encode("utf-8"))
+
+PARSERS = [("original", parseosm.parse_osm_events_into_writers),
+           ("fast", parseosm.parse_osm_fast_events_into_writers)]
+
+def run_parser(parse_events, osm_file, digest):
+    """Parses osm_file into CountingWriters. Returns the seconds it took, the writers, and the
+tallies."""
+    writers = {}
+    for tblname in parseosm.OSM_TABLES:
+        writers[tblname] = CountingWriter(digest)
+    rules = parseosm.default_correction_rules()
+    started = time.perf_counter()
+    tallies = parse_events(ET.iterparse(osm_file, events=("start", "end")), writers, rules=rules)
+    return time.perf_counter() - started, writers, tallies
+
+def compare_parsers(osm_file, rounds=3):
+    """Times the original and the fast XML parser on the same file, best of rounds, with writers
+that throw the rows away so we're timing just the parsing. Checks first that both write the same
+rows and count the same tallies. Returns a list of results, one dictionary per parser."""
+    checks = []
+    for name, parse_events in PARSERS:
+        seconds, writers, tallies = run_parser(parse_events, osm_file, True)
+        digests = {}
+        for tblname, writer in writers.items():
+            digests[tblname] = (writer.rows, writer.digest.hexdigest())
+        del tallies["tag_sub_tags"], tallies["tag_attrs"] # the fast parser skips these
+        checks.append((name, digests, tallies))
+    same = all((digests == checks[0][1]) and (tallies == checks[0][2])
+               for name, digests, tallies in checks)
+    if not same:
+        for tblname in parseosm.OSM_TABLES:
+            print(tblname, [digests[tblname] for name, digests, tallies in checks])
+        raise ValueError("the parsers don't agree on " + osm_file)
+    print("Both parsers write the same rows and tallies")
+    results = []
+    for name, parse_events in PARSERS:
+        best = None
+        for _ in range(rounds):
+            reset_peak_rss()
+            seconds, writers, tallies = run_parser(parse_events, osm_file, False)
+            if (best is None) or (seconds < best):
+                best = seconds
+        rows = sum(writer.rows for writer in writers.values())
+        elements = sum(tallies["tag_set"].get(tag, 0) for tag in ["node", "way", "relation"])
+        result = {"parser": name, "seconds": round(best, 4), "rows": rows,
+                  "rows_per_sec": round(rows / best, 1),
+                  "elements_per_sec": round(elements / best, 1), "peak_rss_bytes": peak_rss()}
+        results.append(result)
+        print("%-10s %8.3f seconds, %10d elements/sec, %10d rows/sec" %
+              (name, best, result["elements_per_sec"], result["rows_per_sec"]))
+    print("fast / original time: %.2f" % (results[1]["seconds"] / results[0]["seconds"]))
+    return results
+
+def compare_results(old, new):
+    """Prints the time of each stage in two runs side by side, with the ratio (new / old)"""
+    old_stages = {}
+    for result in old["stages"]:
+        old_stages[result["stage"]] = result
+    print("%-30s %10s %10s %8s" % ("stage", "before", "after", "ratio"))
+    for result in new["stages"]:
+        before = old_stages.get(result["stage"])
+        if before is None:
+            print("%-30s %10s %10.3f %8s" % (result["stage"], "-", result["seconds"], "-"))
+            continue
+        ratio = "-"
+        if before["seconds"] > 0:
+            ratio = "%.2f" % (result["seconds"] / before["seconds"])
+        print("%-30s %10.3f %10.3f %8s" % (result["stage"], before["seconds"], result["seconds"],
+                                           ratio))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the parseosm.py pipeline on a "
+                                     "synthetic OSM file")
+    parser.add_argument("--nodes", type=int, default=100000, help="number of nodes to generate")
+    parser.add_argument("--ways", type=int, default=None,
+                        help="number of ways (default: a tenth of the nodes)")
+    parser.add_argument("--relations", type=int, default=None,
+                        help="number of multipolygons (default: a twentieth of the ways)")
+    parser.add_argument("--tag-rate", type=float, default=0.2,
+                        help="share of the nodes that have tags")
+    parser.add_argument("--tag-distribution", default=None,
+                        help="JSON file with a list of [key, chance, [values...]]")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--osm", default=None,
+                        help="benchmark this OSM file instead of generating one")
+    parser.add_argument("--workdir", default=None,
+                        help="where to put the files (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    parser.add_argument("--output", default="bench-results.json",
+                        help="where to write the results (JSON)")
+    parser.add_argument("--compare", default=None,
+                        help="results of an earlier run to compare against")
+    parser.add_argument("--profile", choices=PROFILERS, default=None)
+    parser.add_argument("--profile-stages", nargs="+", choices=STAGES, default=None,
+                        help="which stages to profile (default: all)")
+    parser.add_argument("--correct-while-parsing", action="store_true",
+                        help="apply corrections.csv while parsing, not afterwards in the DB")
+    parser.add_argument("--csv-compression", choices=["gzip", "zstd"], default=None,
+                        help="write the CSV files compressed")
+    parser.add_argument("--csv-writer-thread", action="store_true",
+                        help="compress and write the CSV files in a separate thread")
+    parser.add_argument("--fast-parse", action="store_true", help="use the fast XML parser")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="load with SQLite tuned for bulk inserts, building the indexes after")
+    parser.add_argument("--compare-parsers", action="store_true",
+                        help="time the original XML parser against the fast one, instead of "
+                        "running the stages")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="with --compare-parsers, how many times to run each parser")
+    parser.add_argument("--routes", type=int, default=200,
+                        help="how many shortest path searches to time after the stages (0 for "
+                        "none)")
+    parser.add_argument("--verbose", action="store_true", help="show what the stages print")
+    args = parser.parse_args()
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="osmbench-")
+    else:
+        os.makedirs(workdir, exist_ok=True)
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+    try:
+        config = {"nodes": args.nodes, "ways": args.ways, "relations": args.relations,
+                  "tag_rate": args.tag_rate, "tag_distribution": args.tag_distribution,
+                  "seed": args.seed, "osm": args.osm,
+                  "correct_while_parsing": args.correct_while_parsing,
+                  "csv_compression": args.csv_compression,
+                  "csv_writer_thread": args.csv_writer_thread, "fast_parse": args.fast_parse,
+                  "bulk_load": args.bulk_load, "routes": args.routes}
+        osm_file = args.osm
+        if osm_file is None:
+            osm_file = os.path.join(workdir, "bench.osm")
+            tag_distribution = None
+            if args.tag_distribution is not None:
+                tag_distribution = load_tag_distribution(args.tag_distribution)
+            started = time.perf_counter()
+            elements = generate_osm(osm_file, args.nodes, args.ways, args.relations,
+                                    args.tag_rate, tag_distribution, args.seed)
+            print("Generated", elements, "elements (" + str(os.path.getsize(osm_file)), "bytes) in",
+                  round(time.perf_counter() - started, 2), "seconds")
+        config["osm_bytes"] = os.path.getsize(osm_file)
+        if args.compare_parsers:
+            parsers = compare_parsers(osm_file, args.rounds)
+            with open(args.output, "w") as outfile:
+                json.dump({"config": config, "python": platform.python_version(),
+                           "started": started_at, "parsers": parsers}, outfile, indent=2)
+            print("Results written to", args.output)
+            return
+        sink = csvsink.CsvSink(args.csv_compression, threaded=args.csv_writer_thread)
+        stages = run_benchmark(osm_file, workdir, args.profile, args.profile_stages,
+                               not args.verbose, args.correct_while_parsing, sink,
+                               args.fast_parse, args.bulk_load)
+        results = {"config": config,
+                   "python": platform.python_version(),
+                   "sqlite": sqlite3.sqlite_version,
+                   "platform": platform.platform(),
+                   "started": started_at,
+                   "total_seconds": round(sum(stage["seconds"] for stage in stages), 4),
+                   "stages": stages}
+        if args.routes > 0:
+            results["routing"] = bench_routes(os.path.join(workdir, "lyon.graph"), args.routes,
+                                              args.seed)
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        print("Results written to", args.output)
+        if args.compare is not None:
+            with open(args.compare) as oldfile:
+                compare_results(json.load(oldfile), results)
+    finally:
+        if args.keep or (args.workdir is not None):
+            print("Files kept in", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Columnar (Parquet) export of the OSM tables
+
+The CSV files are all text, so whoever reads them has to parse every number again, and reading
+the DB means going through SQLite a row at a time. For analysis it's much faster to have each
+table as a Parquet file: every column is stored by itself, typed (ids, versions and timestamps as
+64-bit ints, latitudes and longitudes as 64-bit floats) and compressed, so a query reads just the
+columns it needs, and tools like pyarrow, pandas or DuckDB work on whole columns at once.
+
+ParquetTableWriter looks like a csv.writer to the parser (it has a writerow() method), so the
+Parquet files can be written in the same pass as the CSV files or the DB (see
+parseosm.add_columnar_writers). It collects rows_per_group rows, turns them into columns and writes
+them out as one row group, so memory use doesn't grow with the size of the file.
+
+This needs the pyarrow package (pip install pyarrow); the rest of parseosm.py works without it."""
+
+from __future__ import print_function
+import datetime
+import os
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DEFAULT_ROWS_PER_GROUP = 131072
+
+# the type of each column; everything else is a string
+COLUMN_TYPES = {
+    "id": "int64",
+    "lat": "float64",
+    "lon": "float64",
+    "uid": "int64",
+    "version": "int64",
+    "changeset": "int64",
+    "timestamp": "int64",
+    "node_id": "int64",
+    "member_id": "int64",
+    "position": "int64",
+}
+
+def check_pyarrow():
+    """Raises ValueError if pyarrow isn't there"""
+    if pyarrow is None:
+        raise ValueError("the Parquet export needs the pyarrow package (pip install pyarrow)")
+
+def timestamp_to_epoch(stamp):
+    """Converts an OSM timestamp (2017-01-01T10:00:00Z) to seconds since 1970, or None if it's
+empty"""
+    if not stamp:
+        return None
+    return int(datetime.datetime.fromisoformat(stamp.replace("Z", "+00:00")).timestamp())
+
+def to_int(value):
+    """Converts a field to an int, or None if it's empty"""
+    if value == "":
+        return None
+    return int(value)
+
+def to_float(value):
+    """Converts a field to a float, or None if it's empty"""
+    if value == "":
+        return None
+    return float(value)
+
+COLUMN_CONVERSIONS = {"int64": to_int, "float64": to_float}
+
+def table_schema(columns):
+    """The pyarrow schema for a table with the given columns"""
+    fields = []
+    for column in columns:
+        col_type = COLUMN_TYPES.get(column)
+        if col_type == "int64":
+            fields.append(pyarrow.field(column, pyarrow.int64()))
+        elif col_type == "float64":
+            fields.append(pyarrow.field(column, pyarrow.float64()))
+        else:
+            fields.append(pyarrow.field(column, pyarrow.string()))
+    return pyarrow.schema(fields)
+
+class ParquetTableWriter:
+    """Collects the rows of one table and writes them to a Parquet file, rows_per_group rows at a
+time."""
+    def __init__(self, filename, columns, rows_per_group=DEFAULT_ROWS_PER_GROUP,
+                 compression="zstd"):
+        check_pyarrow()
+        self.filename = filename
+        self.columns = columns
+        self.schema = table_schema(columns)
+        self.conversions = []
+        for column in columns:
+            if column == "timestamp":
+                self.conversions.append(timestamp_to_epoch)
+            else:
+                self.conversions.append(COLUMN_CONVERSIONS.get(COLUMN_TYPES.get(column)))
+        self.rows_per_group = rows_per_group
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema, compression=compression)
+        self.batch = []
+        self.rows = 0
+
+    def writerow(self, row):
+        """Queue up one row, and write a row group if we have enough"""
+        self.batch.append(row)
+        if len(self.batch) >= self.rows_per_group:
+            self.flush()
+
+    def flush(self):
+        """Write the rows we have queued up as a row group"""
+        if not self.batch:
+            return
+        arrays = []
+        for colnum, conversion in enumerate(self.conversions):
+            if conversion is None:
+                values = [row[colnum] for row in self.batch]
+            else:
+                values = [conversion(row[colnum]) for row in self.batch]
+            arrays.append(pyarrow.array(values, type=self.schema.field(colnum).type))
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = self.rows + len(self.batch)
+        self.batch = []
+
+    def close(self):
+        """Write what's left and finish the file"""
+        self.flush()
+        self.writer.close()
+
+class ColumnarExport:
+    """One ParquetTableWriter per table, writing table.parquet files into a directory."""
+    def __init__(self, directory, tables, rows_per_group=DEFAULT_ROWS_PER_GROUP,
+                 compression="zstd"):
+        check_pyarrow()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.writers = {}
+        for tblname, columns in tables.items():
+            filename = os.path.join(directory, tblname + ".parquet")
+            self.writers[tblname] = ParquetTableWriter(filename, columns, rows_per_group,
+                                                       compression)
+
+    def close(self):
+        """Finishes all the files, and reports how many rows went into each"""
+        for tblname, writer in self.writers.items():
+            writer.close()
+            print("Wrote", writer.rows, "rows to", writer.filename)
+
+def export_db_tables(osmcu, directory, tables, rows_per_group=DEFAULT_ROWS_PER_GROUP,
+                     compression="zstd"):
+    """Exports tables that are already in the DB to Parquet files, reading them rows_per_group rows
+at a time."""
+    export = ColumnarExport(directory, tables, rows_per_group, compression)
+    for tblname, columns in tables.items():
+        writer = export.writers[tblname]
+        cursor = osmcu.execute("SELECT " + ", ".join(columns) + " FROM " + tblname + ";")
+        while True:
+            rows = cursor.fetchmany(rows_per_group)
+            if not rows:
+                break
+            for row in rows:
+                writer.writerow(["" if item is None else item for item in row])
+    export.close()
+
+def tag_value_counts(directory, tags_table, tag_type, tag_key, top=10):
+    """Counts the values of one tag key in a tags table's Parquet file, like
+parseosm.count_tags_for_key, but by reading just the columns it needs and grouping them all at
+once. Returns a list of [value, count], most common first."""
+    check_pyarrow()
+    table = pyarrow.parquet.read_table(os.path.join(directory, tags_table + ".parquet"),
+                                       columns=["value"],
+                                       filters=[("type", "=", tag_type), ("key", "=", tag_key)])
+    counts = table.group_by("value").aggregate([("value", "count")])
+    counts = counts.sort_by([("value_count", "descending"), ("value", "ascending")])
+    result = []
+    for value, count in zip(counts.column("value").to_pylist()[:top],
+                            counts.column("value_count").to_pylist()[:top]):
+        result.append([value, count])
+    return result
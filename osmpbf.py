@@ -0,0 +1,395 @@
+"""Reads OpenStreetMap PBF files (the compact binary format, .osm.pbf)
+
+A PBF file is a series of blobs. Each blob is preceded by a 4-byte length and a BlobHeader that
+says what kind of blob it is ("OSMHeader" or "OSMData") and how big it is. The blob itself is
+usually zlib-compressed, and inside an OSMData blob is a PrimitiveBlock: a string table plus groups
+of nodes, dense nodes, ways and relations. All of this is encoded with Protocol Buffers, which we
+decode by hand here so we don't need the protobuf library or any generated code.
+
+See https://wiki.openstreetmap.org/wiki/PBF_Format for the details."""
+
+from __future__ import print_function
+import collections
+import lzma
+import multiprocessing
+import struct
+import time
+import zlib
+
+# the features we know how to read; a file that requires anything else gets rejected
+SUPPORTED_FEATURES = ["OsmSchema-V0.6", "DenseNodes"]
+
+MEMBER_TYPES = ["node", "way", "relation"]
+
+# how many blobs read_pbf keeps in flight per worker, ahead of the block its caller is on
+BLOCKS_AHEAD = 4
+
+class PbfError(Exception):
+    """Raised when a PBF file is broken or uses something we can't read."""
+
+# ----------------------------------------------------------------
+# first section: decoding Protocol Buffers
+
+def read_varint(buf, pos):
+    """Reads a varint starting at pos, and returns it with the position right after it."""
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos = pos + 1
+        result = result | ((byte & 0x7f) << shift)
+        if byte < 0x80:
+            return result, pos
+        shift = shift + 7
+
+def iter_fields(buf):
+    """Yields (field number, value) for every field in a protobuf message. Varints come back as
+(unsigned) ints, and length-delimited fields as bytes or memoryview slices."""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos = pos + length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos = pos + 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos = pos + 4
+        else:
+            raise PbfError("unknown protobuf wire type " + str(wire_type))
+        yield key >> 3, value
+
+def packed_varints(buf):
+    """Decodes a packed repeated field of varints into a list"""
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        value, pos = read_varint(buf, pos)
+        values.append(value)
+    return values
+
+def signed(value):
+    """Turns an int32/int64 read as an unsigned varint back into a signed number"""
+    if value >= (1 << 63):
+        return value - (1 << 64)
+    return value
+
+def zigzag(value):
+    """Decodes a sint32/sint64 (zigzag-encoded) varint"""
+    return (value >> 1) ^ -(value & 1)
+
+def packed_sints(buf):
+    """Decodes a packed repeated field of sint32/sint64"""
+    return [(value >> 1) ^ -(value & 1) for value in packed_varints(buf)]
+
+def delta_decode(values):
+    """Undoes delta coding: each value in the file is the difference from the one before it."""
+    total = 0
+    result = []
+    for value in values:
+        total = total + value
+        result.append(total)
+    return result
+
+# ----------------------------------------------------------------
+# second section: the file and blob framing
+
+def read_blobs(filename):
+    """Yields (blob type, blob) for every blob in the file, without decompressing them."""
+    with open(filename, "rb") as pbffile:
+        while True:
+            size = pbffile.read(4)
+            if not size:
+                return
+            if len(size) < 4:
+                raise PbfError("truncated blob header length")
+            header = pbffile.read(struct.unpack(">I", size)[0])
+            blob_type = None
+            datasize = None
+            for field, value in iter_fields(header):
+                if field == 1:
+                    blob_type = bytes(value).decode("utf-8")
+                elif field == 3:
+                    datasize = value
+            if (blob_type is None) or (datasize is None):
+                raise PbfError("blob header without a type or size")
+            blob = pbffile.read(datasize)
+            if len(blob) < datasize:
+                raise PbfError("truncated blob")
+            yield blob_type, blob
+
+def decompress_blob(blob):
+    """Returns the contents of a blob, decompressing them if need be."""
+    for field, value in iter_fields(blob):
+        if field == 1:
+            return bytes(value)
+        if field == 3:
+            return zlib.decompress(value)
+        if field == 4:
+            return lzma.decompress(value)
+        if field in (5, 6, 7):
+            raise PbfError("unsupported blob compression (field " + str(field) + ")")
+    raise PbfError("blob without any data")
+
+def check_header_block(data):
+    """Makes sure we can read everything the file says it requires"""
+    for field, value in iter_fields(data):
+        if field == 4:
+            feature = bytes(value).decode("utf-8")
+            if feature not in SUPPORTED_FEATURES:
+                raise PbfError("unsupported required feature: " + feature)
+
+# ----------------------------------------------------------------
+# third section: decoding PrimitiveBlocks into nodes, ways and relations
+#
+# Each node comes back as (id, lat, lon, user, uid, version, changeset, timestamp, tags), each way
+# as (id, user, uid, version, changeset, timestamp, tags, node ids) and each relation as
+# (id, user, uid, version, changeset, timestamp, tags, members), where tags is a list of
+# (key, value) pairs and members is a list of (type, ref, role). Everything except the ids and the
+# lists is a string formatted the way it would appear in the XML, so the rows look the same no
+# matter which kind of file they came from.
+
+def format_degrees(nanodegrees):
+    """Formats a latitude or longitude given in nanodegrees, with (at least) the 7 decimals the
+XML files use, without going through a float."""
+    sign = ""
+    if nanodegrees < 0:
+        sign = "-"
+        nanodegrees = -nanodegrees
+    fraction = "%09d" % (nanodegrees % 1000000000)
+    return sign + str(nanodegrees // 1000000000) + "." + fraction[:7] + fraction[7:].rstrip("0")
+
+def format_timestamp(milliseconds):
+    """Formats a timestamp the way the XML files do"""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(milliseconds // 1000))
+
+def decode_info(buf, strings, date_granularity):
+    """Decodes an Info message into (user, uid, version, changeset, timestamp)"""
+    user = ""
+    uid = ""
+    version = ""
+    changeset = ""
+    timestamp = ""
+    for field, value in iter_fields(buf):
+        if field == 1:
+            version = str(signed(value))
+        elif field == 2:
+            timestamp = format_timestamp(signed(value) * date_granularity)
+        elif field == 3:
+            changeset = str(signed(value))
+        elif field == 4:
+            uid = str(signed(value))
+        elif field == 5:
+            user = strings[value]
+    return user, uid, version, changeset, timestamp
+
+def decode_tags(keys, vals, strings):
+    """Turns the parallel lists of key and value string ids into (key, value) pairs"""
+    return [(strings[key], strings[val]) for key, val in zip(keys, vals)]
+
+def decode_dense(buf, block, nodes):
+    """Decodes a DenseNodes message, appending the nodes to the list"""
+    strings = block["strings"]
+    ids = []
+    lats = []
+    lons = []
+    keys_vals = []
+    info = None
+    for field, value in iter_fields(buf):
+        if field == 1:
+            ids = delta_decode(packed_sints(value))
+        elif field == 5:
+            info = value
+        elif field == 8:
+            lats = delta_decode(packed_sints(value))
+        elif field == 9:
+            lons = delta_decode(packed_sints(value))
+        elif field == 10:
+            keys_vals = packed_varints(value)
+    count = len(ids)
+    users = [""] * count
+    uids = [""] * count
+    versions = [""] * count
+    changesets = [""] * count
+    timestamps = [""] * count
+    if info is not None:
+        for field, value in iter_fields(info):
+            if field == 1:
+                versions = [str(version) for version in packed_varints(value)]
+            elif field == 2:
+                timestamps = [format_timestamp(stamp * block["date_granularity"])
+                              for stamp in delta_decode(packed_sints(value))]
+            elif field == 3:
+                changesets = [str(changeset) for changeset in delta_decode(packed_sints(value))]
+            elif field == 4:
+                uids = [str(uid) for uid in delta_decode(packed_sints(value))]
+            elif field == 5:
+                users = [strings[sid] for sid in delta_decode(packed_sints(value))]
+    # keys_vals is key, value, key, value, ..., 0 for each node in turn (empty if no node has tags)
+    kvpos = 0
+    granularity = block["granularity"]
+    lat_offset = block["lat_offset"]
+    lon_offset = block["lon_offset"]
+    for idx in range(count):
+        tags = []
+        if keys_vals:
+            while keys_vals[kvpos] != 0:
+                tags.append((strings[keys_vals[kvpos]], strings[keys_vals[kvpos + 1]]))
+                kvpos = kvpos + 2
+            kvpos = kvpos + 1
+        nodes.append((ids[idx], format_degrees(lat_offset + granularity * lats[idx]),
+                      format_degrees(lon_offset + granularity * lons[idx]), users[idx], uids[idx],
+                      versions[idx], changesets[idx], timestamps[idx], tags))
+
+def decode_node(buf, block, nodes):
+    """Decodes a (non-dense) Node message, appending it to the list"""
+    strings = block["strings"]
+    node_id = 0
+    keys = []
+    vals = []
+    info = ("", "", "", "", "")
+    lat = 0
+    lon = 0
+    for field, value in iter_fields(buf):
+        if field == 1:
+            node_id = zigzag(value)
+        elif field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            vals = packed_varints(value)
+        elif field == 4:
+            info = decode_info(value, strings, block["date_granularity"])
+        elif field == 8:
+            lat = zigzag(value)
+        elif field == 9:
+            lon = zigzag(value)
+    nodes.append((node_id,
+                  format_degrees(block["lat_offset"] + block["granularity"] * lat),
+                  format_degrees(block["lon_offset"] + block["granularity"] * lon))
+                 + info + (decode_tags(keys, vals, strings),))
+
+def decode_way(buf, block, ways):
+    """Decodes a Way message, appending it to the list"""
+    strings = block["strings"]
+    way_id = 0
+    keys = []
+    vals = []
+    info = ("", "", "", "", "")
+    refs = []
+    for field, value in iter_fields(buf):
+        if field == 1:
+            way_id = signed(value)
+        elif field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            vals = packed_varints(value)
+        elif field == 4:
+            info = decode_info(value, strings, block["date_granularity"])
+        elif field == 8:
+            refs = delta_decode(packed_sints(value))
+    ways.append((way_id,) + info + (decode_tags(keys, vals, strings), refs))
+
+def decode_relation(buf, block, relations):
+    """Decodes a Relation message, appending it to the list"""
+    strings = block["strings"]
+    relation_id = 0
+    keys = []
+    vals = []
+    info = ("", "", "", "", "")
+    roles = []
+    memids = []
+    types = []
+    for field, value in iter_fields(buf):
+        if field == 1:
+            relation_id = signed(value)
+        elif field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            vals = packed_varints(value)
+        elif field == 4:
+            info = decode_info(value, strings, block["date_granularity"])
+        elif field == 8:
+            roles = [strings[sid] for sid in packed_varints(value)]
+        elif field == 9:
+            memids = delta_decode(packed_sints(value))
+        elif field == 10:
+            types = [MEMBER_TYPES[member_type] for member_type in packed_varints(value)]
+    members = list(zip(types, memids, roles))
+    relations.append((relation_id,) + info + (decode_tags(keys, vals, strings), members))
+
+def decode_primitive_block(data):
+    """Decodes a PrimitiveBlock, returning a dictionary with lists of "nodes", "ways" and
+"relations" (see above for what each one looks like)."""
+    block = {"strings": [], "granularity": 100, "lat_offset": 0, "lon_offset": 0,
+             "date_granularity": 1000}
+    groups = []
+    for field, value in iter_fields(memoryview(data)):
+        if field == 1:
+            block["strings"] = [bytes(stng).decode("utf-8") for fld, stng in iter_fields(value)
+                                if fld == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            block["granularity"] = value
+        elif field == 18:
+            block["date_granularity"] = value
+        elif field == 19:
+            block["lat_offset"] = signed(value)
+        elif field == 20:
+            block["lon_offset"] = signed(value)
+    result = {"nodes": [], "ways": [], "relations": []}
+    for group in groups:
+        for field, value in iter_fields(group):
+            if field == 1:
+                decode_node(value, block, result["nodes"])
+            elif field == 2:
+                decode_dense(value, block, result["nodes"])
+            elif field == 3:
+                decode_way(value, block, result["ways"])
+            elif field == 4:
+                decode_relation(value, block, result["relations"])
+    return result
+
+def decode_data_blob(blob):
+    """Decompresses and decodes one OSMData blob. This is what the worker processes run."""
+    return decode_primitive_block(decompress_blob(blob))
+
+def data_blobs(filename):
+    """Yields the OSMData blobs of a file, after checking its header"""
+    for blob_type, blob in read_blobs(filename):
+        if blob_type == "OSMHeader":
+            check_header_block(decompress_blob(blob))
+        elif blob_type == "OSMData":
+            yield blob
+        # anything else is an unknown blob type, which the format says we should skip
+
+def read_pbf(filename, workers=None, blocks_ahead=None):
+    """Yields the decoded blocks of a PBF file, in file order. Decompressing and decoding the blobs
+is where the time goes, so that's done by a pool of worker processes (one per core by default);
+set workers to 1 to do it all in this process. At most blocks_ahead blobs (by default, BLOCKS_AHEAD
+per worker) are read ahead of the block the caller is on, so if the caller is slower than the
+workers (inserting into the DB, say), the decoded blocks don't pile up in memory."""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        for blob in data_blobs(filename):
+            yield decode_data_blob(blob)
+        return
+    if blocks_ahead is None:
+        blocks_ahead = BLOCKS_AHEAD * workers
+    with multiprocessing.Pool(workers) as pool:
+        pending = collections.deque()
+        for blob in data_blobs(filename):
+            pending.append(pool.apply_async(decode_data_blob, (blob,)))
+            if len(pending) >= blocks_ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
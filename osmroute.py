@@ -0,0 +1,513 @@
+"""A routing graph of the highways, and shortest paths over it
+
+The DB knows which ways are highways and which nodes each one goes through, but to find a route we
+need a network: junctions connected by stretches of road with a length. build_routing_graph makes
+one out of the highway ways. It cuts each way at the nodes it shares with other ways (and at its
+ends), so the graph nodes are the junctions and dead ends, and each piece in between is an edge,
+as long as the sum of the great-circle distances between its nodes. Oneway streets (oneway=yes or
+-1, and roundabouts) only get an edge in the direction they go, unless we're asked to ignore that
+(on foot, say).
+
+The graph is written to one file next to the DB (lyon.graph next to lyon.db) in compressed sparse
+row (CSR) form: the edges sorted by the node they start from, so the edges out of node i are
+targets[offsets[i]:offsets[i + 1]]. Everything is flat arrays of fixed-size ints, so RoutingGraph
+just maps the file into memory and casts memoryviews over it (like nodestore.SparseNodeStore):
+opening a graph takes milliseconds whatever its size, and the operating system pages in the parts
+a search actually touches. The file holds, after a header, each starting on an 8-byte boundary:
+
+    node_ids      int64 [nodes]      OSM id of each graph node, sorted
+    coords        int32 [2 * nodes]  lat, lon of each node, in 1e-7 degrees (nodestore.to_fixed)
+    offsets       int64 [nodes + 1]  where each node's edges start in the edge arrays
+    targets       int32 [edges]      the node each edge goes to
+    lengths       int32 [edges]      the length of each edge in centimeters
+    edge_ways     int64 [edges]      the OSM way each edge is part of
+    cell_keys     int64 [cells]      the grid cells that have nodes in them, sorted
+    cell_offsets  int64 [cells + 1]  where each cell's nodes start in cell_nodes
+    cell_nodes    int32 [nodes]      the nodes, grouped by grid cell
+
+The lengths are in whole centimeters, rounded up, so the distances the searches add up are exact
+and an edge is never shorter than the straight line between its ends, which A* relies on. The grid
+(cells of cell_size, in 1e-7 degrees) is there to find the node nearest to a point without going
+through them all. Like the node store, the file is in the byte order of the machine.
+
+shortest_path does Dijkstra's algorithm, or A* with the great-circle distance to the target as the
+estimate of what's left, which finds the same distance while looking at far fewer nodes:
+
+    graph = osmroute.RoutingGraph("lyon.graph")
+    route = graph.route_between(45.7597, 4.8422, 45.7772, 4.8559)
+    print(route["distance_m"], route["ways"])
+
+or from the command line:
+
+    python osmroute.py lyon.graph --from-point 45.7597 4.8422 --to-point 45.7772 4.8559"""
+
+from __future__ import print_function
+import argparse
+import array
+import bisect
+import heapq
+import itertools
+import math
+import mmap
+import os
+import struct
+import time
+import nodestore
+
+GRAPH_MAGIC = b"OSMGRAPH"
+GRAPH_VERSION = 1
+
+# magic, version, nodes, edges, cells, cell size
+GRAPH_HEADER = struct.Struct("=8sqqqqq")
+
+# 0.005 degrees, about 550 m north to south
+DEFAULT_CELL_SIZE = 50000
+
+# how far from a point route_between looks for a node of the graph, in meters
+DEFAULT_SNAP_M = 1000
+
+# the same as parseosm.EARTH_RADIUS_M
+EARTH_RADIUS_M = 6371008.8
+
+# highway values that aren't roads (yet, or any more) or that aren't ways to get anywhere
+NON_ROUTABLE_HIGHWAYS = ["proposed", "construction", "abandoned", "disused", "razed", "platform",
+                         "raceway", "bus_stop", "elevator", "services", "rest_area"]
+
+ONEWAY_FORWARD = ["yes", "true", "1"]
+ONEWAY_BACKWARD = ["-1", "reverse"]
+
+def graph_filename(db_file):
+    """The routing graph that goes with a DB: lyon.graph for lyon.db"""
+    return os.path.splitext(db_file)[0] + ".graph"
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Distance in meters between two points on the Earth (parseosm.haversine_m)"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    hav = math.sin((phi2 - phi1) / 2) ** 2 + \
+          math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(hav)))
+
+def fixed_distance_m(lat1, lon1, lat2, lon2):
+    """distance_m for points in 1e-7 degree fixed point"""
+    scale = nodestore.COORD_SCALE
+    return distance_m(lat1 / scale, lon1 / scale, lat2 / scale, lon2 / scale)
+
+def cell_coords(lat, lon, cell_size):
+    """The row and column of the grid cell a fixed point location is in"""
+    return (lat + 900000000) // cell_size, (lon + 1800000000) // cell_size
+
+def cell_key(row, column, cell_size):
+    """One int for a grid cell, in the order the cells are stored"""
+    return row * (3600000000 // cell_size + 1) + column
+
+# ----------------------------------------------------------------
+# building the graph
+
+def routable_ways_sql(skip_highways):
+    """The SQL for the ids of the highway ways, and its parameters"""
+    sql = "SELECT DISTINCT id FROM ways_tags WHERE (type = 'regular') AND (key = 'highway')"
+    if skip_highways:
+        sql = sql + " AND (value NOT IN (" + ", ".join("?" * len(skip_highways)) + "))"
+    return sql, list(skip_highways)
+
+def way_directions(osmcu, ways_sql, ways_params, respect_oneway):
+    """Returns a dictionary from way id to the directions it can be gone along: "forward" or
+"backward" for the oneway ways; the others aren't in it."""
+    directions = {}
+    if not respect_oneway:
+        return directions
+    sql = "SELECT id, key, value FROM ways_tags WHERE (type = 'regular') AND \
+           (key IN ('oneway', 'junction')) AND (id IN (" + ways_sql + "));"
+    oneway = {}
+    roundabouts = set()
+    for way_id, key, value in osmcu.execute(sql, ways_params):
+        if key == "oneway":
+            oneway[way_id] = value
+        elif value == "roundabout":
+            roundabouts.add(way_id)
+    for way_id in roundabouts:
+        directions[way_id] = "forward"
+    for way_id, value in oneway.items():
+        if value in ONEWAY_FORWARD:
+            directions[way_id] = "forward"
+        elif value in ONEWAY_BACKWARD:
+            directions[way_id] = "backward"
+        elif value == "no":
+            directions.pop(way_id, None)
+    return directions
+
+def way_pieces(osmcu, ways_sql, ways_params):
+    """Yields (way id, node ids, coordinates) for the highway ways, node ids as an array of int64
+and coordinates as an array of int32 (lat, lon, lat, lon, ...) in fixed point. A way that goes
+through nodes that aren't in the DB (the extract cuts it off) comes out in pieces, one for each
+run of nodes we have."""
+    sql = "SELECT ways_nodes.id, ways_nodes.node_id, nodes.lat, nodes.lon FROM ways_nodes    \
+           LEFT JOIN nodes ON nodes.id = ways_nodes.node_id                                   \
+           WHERE ways_nodes.id IN (" + ways_sql + ") ORDER BY ways_nodes.id, ways_nodes.position;"
+    for way_id, rows in itertools.groupby(osmcu.execute(sql, ways_params), lambda row: row[0]):
+        node_ids = array.array("q")
+        coords = array.array("i")
+        for row in rows:
+            if row[2] is None:
+                if len(node_ids) >= 2:
+                    yield way_id, node_ids, coords
+                node_ids = array.array("q")
+                coords = array.array("i")
+                continue
+            node_ids.append(row[1])
+            coords.append(nodestore.to_fixed(row[2]))
+            coords.append(nodestore.to_fixed(row[3]))
+        if len(node_ids) >= 2:
+            yield way_id, node_ids, coords
+
+def write_graph(filename, node_ids, coords, edges, cell_size):
+    """Writes the graph file (see the top of this file). edges is a list of (from, to, length in
+centimeters, way id), with from and to indexes into node_ids. We write to a temporary file and
+move it into place, so that nobody ever maps half a graph."""
+    num_nodes = len(node_ids)
+    offsets = array.array("q", [0] * (num_nodes + 1))
+    for edge in edges:
+        offsets[edge[0] + 1] = offsets[edge[0] + 1] + 1
+    for idx in range(num_nodes):
+        offsets[idx + 1] = offsets[idx + 1] + offsets[idx]
+    targets = array.array("i", [0] * len(edges))
+    lengths = array.array("i", [0] * len(edges))
+    edge_ways = array.array("q", [0] * len(edges))
+    fill = array.array("q", offsets[:num_nodes])
+    for from_idx, to_idx, length, way_id in edges:
+        pos = fill[from_idx]
+        targets[pos] = to_idx
+        lengths[pos] = length
+        edge_ways[pos] = way_id
+        fill[from_idx] = pos + 1
+    cells = {}
+    for idx in range(num_nodes):
+        row, column = cell_coords(coords[2 * idx], coords[2 * idx + 1], cell_size)
+        cells.setdefault(cell_key(row, column, cell_size), []).append(idx)
+    cell_keys = array.array("q", sorted(cells))
+    cell_offsets = array.array("q", [0])
+    cell_nodes = array.array("i")
+    for key in cell_keys:
+        cell_nodes.extend(cells[key])
+        cell_offsets.append(len(cell_nodes))
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as graphfile:
+        graphfile.write(GRAPH_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, num_nodes, len(edges),
+                                          len(cell_keys), cell_size))
+        for values in [node_ids, coords, offsets, targets, lengths, edge_ways, cell_keys,
+                       cell_offsets, cell_nodes]:
+            values.tofile(graphfile)
+            padding = -(len(values) * values.itemsize) % 8
+            graphfile.write(b"\0" * padding)
+    os.replace(temp_filename, filename)
+
+def build_routing_graph(osmcu, filename, respect_oneway=True, skip_highways=None,
+                        cell_size=DEFAULT_CELL_SIZE):
+    """Builds the routing graph out of the highway ways in the DB (all of them but the
+skip_highways values, by default NON_ROUTABLE_HIGHWAYS) and writes it to filename (see the top of
+this file). With respect_oneway False, every way can be gone along both ways. Returns a dictionary
+with the number of ways, nodes and edges."""
+    if skip_highways is None:
+        skip_highways = NON_ROUTABLE_HIGHWAYS
+    ways_sql, ways_params = routable_ways_sql(skip_highways)
+    directions = way_directions(osmcu, ways_sql, ways_params, respect_oneway)
+    # first we read all the pieces, counting how many times each node is used: the graph nodes
+    # are the ones used more than once, and the ends of the pieces
+    pieces = []
+    uses = {}
+    for piece in way_pieces(osmcu, ways_sql, ways_params):
+        pieces.append(piece)
+        node_ids = piece[1]
+        for node_id in node_ids:
+            uses[node_id] = uses.get(node_id, 0) + 1
+        # counting the ends twice makes them graph nodes
+        uses[node_ids[0]] = uses[node_ids[0]] + 1
+        uses[node_ids[-1]] = uses[node_ids[-1]] + 1
+    graph_node_ids = array.array("q", sorted(node_id for node_id, count in uses.items()
+                                             if count > 1))
+    uses = None
+    index = {}
+    for idx, node_id in enumerate(graph_node_ids):
+        index[node_id] = idx
+    graph_coords = array.array("i", [0] * (2 * len(graph_node_ids)))
+    # then we walk along each piece, cutting it at every graph node
+    edges = []
+    way_ids = set()
+    for way_id, node_ids, coords in pieces:
+        way_ids.add(way_id)
+        direction = directions.get(way_id)
+        start = index[node_ids[0]]
+        graph_coords[2 * start] = coords[0]
+        graph_coords[2 * start + 1] = coords[1]
+        length = 0.0
+        for pos in range(1, len(node_ids)):
+            length = length + fixed_distance_m(coords[2 * pos - 2], coords[2 * pos - 1],
+                                               coords[2 * pos], coords[2 * pos + 1])
+            end = index.get(node_ids[pos])
+            if end is None:
+                continue
+            graph_coords[2 * end] = coords[2 * pos]
+            graph_coords[2 * end + 1] = coords[2 * pos + 1]
+            if end != start:
+                length_cm = int(math.ceil(length * 100))
+                if direction != "backward":
+                    edges.append((start, end, length_cm, way_id))
+                if direction != "forward":
+                    edges.append((end, start, length_cm, way_id))
+            start = end
+            length = 0.0
+    pieces = None
+    write_graph(filename, graph_node_ids, graph_coords, edges, cell_size)
+    print("Routing graph:", len(graph_node_ids), "nodes and", len(edges), "edges from",
+          len(way_ids), "highway ways, written to", filename)
+    return {"ways": len(way_ids), "nodes": len(graph_node_ids), "edges": len(edges)}
+
+# ----------------------------------------------------------------
+# finding routes
+
+class RoutingGraph:
+    """A routing graph file, mapped into memory (see the top of this file)."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.views = []
+        with open(filename, "rb") as graphfile:
+            size = os.fstat(graphfile.fileno()).st_size
+            self.mapped = mmap.mmap(graphfile.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            magic, version, num_nodes, num_edges, num_cells, cell_size = \
+                GRAPH_HEADER.unpack_from(self.mapped)
+        except struct.error:
+            self.mapped.close()
+            raise ValueError(filename + " is not a routing graph")
+        if (magic != GRAPH_MAGIC) or (version != GRAPH_VERSION):
+            self.mapped.close()
+            raise ValueError(filename + " is not a routing graph (of version " +
+                             str(GRAPH_VERSION) + ")")
+        self.num_nodes = num_nodes
+        self.num_edges = num_edges
+        self.cell_size = cell_size
+        self.pos = GRAPH_HEADER.size
+        self.node_ids = self.array_view("q", num_nodes)
+        self.coords = self.array_view("i", 2 * num_nodes)
+        self.offsets = self.array_view("q", num_nodes + 1)
+        self.targets = self.array_view("i", num_edges)
+        self.lengths = self.array_view("i", num_edges)
+        self.edge_ways = self.array_view("q", num_edges)
+        self.cell_keys = self.array_view("q", num_cells)
+        self.cell_offsets = self.array_view("q", num_cells + 1)
+        self.cell_nodes = self.array_view("i", num_nodes)
+
+    def array_view(self, code, count):
+        """A memoryview of the next array in the file"""
+        itemsize = struct.calcsize(code)
+        end = self.pos + count * itemsize
+        if end > len(self.mapped):
+            self.close()
+            raise ValueError(self.filename + " is cut off")
+        view = memoryview(self.mapped)[self.pos:end].cast(code)
+        self.views.append(view)
+        self.pos = end + (-(count * itemsize) % 8)
+        return view
+
+    def close(self):
+        """Unmaps the file"""
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.mapped.close()
+
+    def node_index(self, node_id):
+        """The index of the graph node with an OSM node id, or None if it isn't one"""
+        idx = bisect.bisect_left(self.node_ids, node_id)
+        if (idx < self.num_nodes) and (self.node_ids[idx] == node_id):
+            return idx
+        return None
+
+    def node_location(self, idx):
+        """The (lat, lon) of a graph node, in degrees"""
+        return (self.coords[2 * idx] / nodestore.COORD_SCALE,
+                self.coords[2 * idx + 1] / nodestore.COORD_SCALE)
+
+    def nearest_node(self, lat, lon, max_distance_m=DEFAULT_SNAP_M):
+        """The index of the graph node nearest to a point (in degrees), or None if there's none
+within max_distance_m. We look through the grid cells in rings around the point's cell, until the
+next ring is further away than the nearest node so far."""
+        lat_fixed = nodestore.to_fixed(lat)
+        lon_fixed = nodestore.to_fixed(lon)
+        row, column = cell_coords(lat_fixed, lon_fixed, self.cell_size)
+        # the north-south size of a cell in meters, and the narrowest a cell gets east-west
+        # anywhere we could find a node close enough
+        cell_m = math.radians(self.cell_size / nodestore.COORD_SCALE) * EARTH_RADIUS_M
+        max_lat = min(90.0, abs(lat) + math.degrees(max_distance_m / EARTH_RADIUS_M))
+        min_cell_m = cell_m * max(0.01, math.cos(math.radians(max_lat)))
+        best = None
+        best_m = max_distance_m
+        ring = 0
+        # everything in a ring is at least ring - 1 whole cells away
+        while (ring - 1) * min_cell_m <= best_m:
+            for ring_row in range(row - ring, row + ring + 1):
+                step = 1
+                if abs(ring_row - row) < ring:
+                    step = 2 * ring
+                for ring_column in range(column - ring, column + ring + 1, step):
+                    key = cell_key(ring_row, ring_column, self.cell_size)
+                    cell = bisect.bisect_left(self.cell_keys, key)
+                    if (cell >= len(self.cell_keys)) or (self.cell_keys[cell] != key):
+                        continue
+                    for pos in range(self.cell_offsets[cell], self.cell_offsets[cell + 1]):
+                        idx = self.cell_nodes[pos]
+                        dist = fixed_distance_m(lat_fixed, lon_fixed, self.coords[2 * idx],
+                                                self.coords[2 * idx + 1])
+                        if dist <= best_m:
+                            best = idx
+                            best_m = dist
+            ring = ring + 1
+        return best
+
+    def shortest_path(self, source, target, method="astar"):
+        """Finds the shortest path between two graph nodes (indexes), with Dijkstra's algorithm
+(method "dijkstra") or A* (method "astar"). Returns (length in centimeters, list of edge indexes,
+number of nodes settled), or None if there's no path."""
+        if method not in ["astar", "dijkstra"]:
+            raise ValueError("unknown shortest path method: " + str(method))
+        offsets = self.offsets
+        targets = self.targets
+        lengths = self.lengths
+        coords = self.coords
+        estimate = None
+        if method == "astar":
+            # the great-circle distance (in centimeters) to the target, never more than what's left
+            scale = math.pi / 180 / nodestore.COORD_SCALE
+            target_phi = coords[2 * target] * scale
+            target_lambda = coords[2 * target + 1] * scale
+            cos_target = math.cos(target_phi)
+            diameter_cm = 2 * EARTH_RADIUS_M * 100
+            def estimate(idx):
+                phi = coords[2 * idx] * scale
+                hav = math.sin((target_phi - phi) / 2) ** 2 + math.cos(phi) * cos_target * \
+                      math.sin((target_lambda - coords[2 * idx + 1] * scale) / 2) ** 2
+                return diameter_cm * math.asin(min(1.0, math.sqrt(hav)))
+        dist = {source: 0}
+        came_by = {}
+        settled = set()
+        if estimate is None:
+            heap = [(0, source)]
+        else:
+            heap = [(estimate(source), source)]
+        while heap:
+            key, idx = heapq.heappop(heap)
+            if idx in settled:
+                continue
+            settled.add(idx)
+            if idx == target:
+                break
+            here = dist[idx]
+            for edge in range(offsets[idx], offsets[idx + 1]):
+                nxt = targets[edge]
+                there = here + lengths[edge]
+                if (nxt not in settled) and (there < dist.get(nxt, there + 1)):
+                    dist[nxt] = there
+                    came_by[nxt] = edge
+                    if estimate is None:
+                        heapq.heappush(heap, (there, nxt))
+                    else:
+                        heapq.heappush(heap, (there + estimate(nxt), nxt))
+        if target not in settled:
+            return None
+        path = []
+        idx = target
+        while idx != source:
+            edge = came_by[idx]
+            path.append(edge)
+            idx = self.edge_source(edge)
+        path.reverse()
+        return dist[target], path, len(settled)
+
+    def edge_source(self, edge):
+        """The node an edge starts from (the one whose range in offsets it's in)"""
+        return bisect.bisect_right(self.offsets, edge) - 1
+
+    def route(self, source, target, method="astar"):
+        """The shortest route between two graph nodes (indexes), as a dictionary with its length
+("distance_m"), the OSM ids and locations of the graph nodes along it ("nodes", "coords"), the
+ways it takes, in order ("ways"), and how many nodes the search settled ("settled"). None if
+there's no route."""
+        found = self.shortest_path(source, target, method)
+        if found is None:
+            return None
+        length, path, settled = found
+        nodes = [source] + [self.targets[edge] for edge in path]
+        ways = []
+        for edge in path:
+            way_id = self.edge_ways[edge]
+            if (not ways) or (ways[-1] != way_id):
+                ways.append(way_id)
+        return {"distance_m": length / 100.0, "nodes": [self.node_ids[idx] for idx in nodes],
+                "coords": [self.node_location(idx) for idx in nodes], "ways": ways,
+                "settled": settled}
+
+    def route_between_nodes(self, from_node_id, to_node_id, method="astar"):
+        """route between two OSM nodes; raises ValueError if either one isn't a graph node (a
+junction or the end of a highway)"""
+        source = self.node_index(from_node_id)
+        target = self.node_index(to_node_id)
+        for node_id, idx in [(from_node_id, source), (to_node_id, target)]:
+            if idx is None:
+                raise ValueError("node " + str(node_id) + " is not a junction or end of a highway")
+        return self.route(source, target, method)
+
+    def route_between(self, from_lat, from_lon, to_lat, to_lon, method="astar",
+                      max_snap_m=DEFAULT_SNAP_M):
+        """route between the graph nodes nearest two points (in degrees); None if there's no
+node within max_snap_m meters of either of them, or no route"""
+        source = self.nearest_node(from_lat, from_lon, max_snap_m)
+        target = self.nearest_node(to_lat, to_lon, max_snap_m)
+        if (source is None) or (target is None):
+            return None
+        return self.route(source, target, method)
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the shortest route over a routing graph")
+    parser.add_argument("graph", help="routing graph file (e.g. lyon.graph)")
+    parser.add_argument("--from-node", type=int, default=None, help="OSM id of the start node")
+    parser.add_argument("--to-node", type=int, default=None, help="OSM id of the end node")
+    parser.add_argument("--from-point", type=float, nargs=2, metavar=("LAT", "LON"), default=None)
+    parser.add_argument("--to-point", type=float, nargs=2, metavar=("LAT", "LON"), default=None)
+    parser.add_argument("--method", choices=["astar", "dijkstra"], default="astar")
+    args = parser.parse_args()
+    if ((args.from_node is None) == (args.from_point is None)) or \
+       ((args.to_node is None) == (args.to_point is None)):
+        parser.error("give one of --from-node and --from-point, and one of --to-node and " +
+                     "--to-point")
+    started = time.perf_counter()
+    graph = RoutingGraph(args.graph)
+    print("Opened", args.graph, "(" + str(graph.num_nodes), "nodes,", graph.num_edges,
+          "edges) in", round((time.perf_counter() - started) * 1000, 2), "ms")
+    try:
+        ends = []
+        for node_id, point in [(args.from_node, args.from_point), (args.to_node, args.to_point)]:
+            if node_id is not None:
+                idx = graph.node_index(node_id)
+                if idx is None:
+                    parser.error("node " + str(node_id) + " is not in the graph")
+            else:
+                idx = graph.nearest_node(point[0], point[1])
+                if idx is None:
+                    parser.error("no graph node within " + str(DEFAULT_SNAP_M) + " m of " +
+                                 str(point))
+            ends.append(idx)
+        started = time.perf_counter()
+        route = graph.route(ends[0], ends[1], args.method)
+        print("Searched in", round((time.perf_counter() - started) * 1000, 2), "ms")
+        if route is None:
+            print("No route")
+            return
+        print("Distance:", route["distance_m"], "m, settled", route["settled"], "nodes")
+        print("Ways:", " ".join(str(way_id) for way_id in route["ways"]))
+        print("Nodes:", " ".join(str(node_id) for node_id in route["nodes"]))
+    finally:
+        graph.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""A long-running query service over the OSM DB
+
+parseosm.py answers its questions by running the whole analysis and printing the results, so
+anything that wants one number (the top values of a tag, the shape of a street) has to run it all
+again. This is a small HTTP server that keeps the DB open and answers single queries with JSON:
+
+    python osmservice.py lyon.db --port 8642
+    curl 'http://localhost:8642/query/tag_counts?key=amenity'
+    curl 'http://localhost:8642/query/way_geometry?id=442928017'
+    curl 'http://localhost:8642/stats'
+
+It runs on asyncio, and the queries themselves run in a pool of threads, each with a read-only
+SQLite connection of its own (SQLite lets go of the interpreter lock while it works, so several
+queries really do run at once), so a slow query doesn't hold up the others.
+
+Tag counts and way geometries get asked for over and over, so their results are kept in an LRU
+cache: up to cache_entries of them, dropping the one used longest ago when it's full. Before every
+query we check whether the DB file has changed (a new load replaces the file, an .osc update
+changes it), and if it has, we empty the cache and swap the connections for new ones; /reload does
+the same on demand. /stats has the number of queries, the 50th and 99th percentile latencies
+(over the last LATENCY_WINDOW queries of each kind), and the cache hits, misses and evictions."""
+
+from __future__ import print_function
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import math
+import os
+import sqlite3
+import time
+import urllib.parse
+import parseosm
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CACHE_ENTRIES = 4096
+DEFAULT_PORT = 8642
+
+# how many of the latest latencies of each kind of query the percentiles are worked out from
+LATENCY_WINDOW = 10000
+
+# the most values a tag_counts query can ask for (top), so one request can't pull in, and cache,
+# the whole tags table
+MAX_TOP = 1000
+
+# the most nodes or ways a bounding box query returns (limit), for the same reason
+DEFAULT_BBOX_LIMIT = 1000
+MAX_BBOX_LIMIT = 10000
+
+# ----------------------------------------------------------------
+# the queries
+
+def required_arg(args, name):
+    """An argument a query can't do without"""
+    if name not in args:
+        raise ValueError("missing argument: " + name)
+    return args[name]
+
+def bbox_args(args):
+    """The min_lat, min_lon, max_lat and max_lon arguments, as numbers"""
+    return [float(required_arg(args, name))
+            for name in ["min_lat", "min_lon", "max_lat", "max_lon"]]
+
+def bbox_limit(args):
+    """The limit argument of a bounding box query, as a number"""
+    limit = int(args.get("limit", DEFAULT_BBOX_LIMIT))
+    if (limit < 1) or (limit > MAX_BBOX_LIMIT):
+        raise ValueError("limit must be between 1 and " + str(MAX_BBOX_LIMIT))
+    return limit
+
+def query_tag_counts(osmcu, args):
+    """The most common values of a tag key (key, and optionally type, table and top), as a list of
+[value, count]"""
+    table = args.get("table", "nodes_tags")
+    if table not in ["nodes_tags", "ways_tags", "relations_tags"]:
+        raise ValueError("no such tags table: " + table)
+    top = int(args.get("top", 10))
+    if (top < 1) or (top > MAX_TOP):
+        raise ValueError("top must be between 1 and " + str(MAX_TOP))
+    if not parseosm.has_osm_stats(osmcu):
+        raise ValueError("the summary tables haven't been built (run the stats stage)")
+    return parseosm.top_tag_values(osmcu, table, args.get("type", "regular"),
+                                   required_arg(args, "key"), top)
+
+def query_way_geometry(osmcu, args):
+    """The coordinates of a way (id), as a list of [lat, lon], or None if there's no such way"""
+    if not parseosm.has_way_geometries(osmcu):
+        raise ValueError("the way geometries haven't been built (run the way_geometries stage)")
+    coords = parseosm.get_way_geometry(osmcu, int(required_arg(args, "id")))
+    if coords is None:
+        return None
+    return [list(point) for point in coords]
+
+def query_multipolygon(osmcu, args):
+    """The outer and inner rings of a multipolygon (id), or None if there's no such
+multipolygon"""
+    if not parseosm.has_multipolygons(osmcu):
+        raise ValueError("the multipolygons haven't been built (run the multipolygons stage)")
+    return parseosm.get_multipolygon(osmcu, int(required_arg(args, "id")))
+
+def query_nodes_in_bbox(osmcu, args):
+    """The nodes in a bounding box (up to limit of them), with their tags"""
+    return parseosm.nodes_in_bbox(osmcu, *bbox_args(args), limit=bbox_limit(args))
+
+def query_ways_in_bbox(osmcu, args):
+    """The ways whose bounding box overlaps a bounding box (up to limit of them), with their
+tags"""
+    return parseosm.ways_in_bbox(osmcu, *bbox_args(args), limit=bbox_limit(args))
+
+def query_counts(osmcu, args):
+    """The numbers in the osm_stats summary table, by name"""
+    if not parseosm.has_osm_stats(osmcu):
+        raise ValueError("the summary tables haven't been built (run the stats stage)")
+    return {row[0]: row[1] for row in osmcu.execute("SELECT name, value FROM osm_stats;")}
+
+# the queries by name, and whether their results go in the cache
+QUERIES = {
+    "tag_counts": (query_tag_counts, True),
+    "way_geometry": (query_way_geometry, True),
+    "multipolygon": (query_multipolygon, False),
+    "nodes_in_bbox": (query_nodes_in_bbox, False),
+    "ways_in_bbox": (query_ways_in_bbox, False),
+    "counts": (query_counts, False),
+}
+
+# ----------------------------------------------------------------
+# the cache, the latency counters and the connection pool
+
+class LruCache:
+    """Keeps up to max_entries results, dropping the one used longest ago to make room."""
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns (True, result) if key is in the cache, otherwise (False, None)"""
+        if key not in self.entries:
+            self.misses = self.misses + 1
+            return False, None
+        self.hits = self.hits + 1
+        self.entries.move_to_end(key)
+        return True, self.entries[key]
+
+    def put(self, key, result):
+        """Adds a result, dropping the least recently used one if the cache is full"""
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions = self.evictions + 1
+
+    def clear(self):
+        """Empties the cache (the hit and miss counts carry on)"""
+        self.entries.clear()
+
+    def stats(self):
+        """The size of the cache and its hits, misses and evictions"""
+        return {"entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+def percentile(sorted_values, fraction):
+    """The value below which the given fraction of sorted_values falls (nearest rank)"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(fraction * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+class LatencyCounters:
+    """Counts the queries of each kind and keeps their latest latencies, for percentiles."""
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.counts = collections.Counter()
+        self.latencies = {}
+
+    def record(self, name, seconds):
+        """Adds the latency of one query"""
+        self.counts[name] += 1
+        if name not in self.latencies:
+            self.latencies[name] = collections.deque(maxlen=self.window)
+        self.latencies[name].append(seconds)
+
+    def stats(self):
+        """The count and the 50th and 99th percentile latency (in milliseconds) of each kind of
+query"""
+        result = {}
+        for name, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            result[name] = {"count": self.counts[name],
+                            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+                            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3)}
+        return result
+
+def open_read_only(db_file):
+    """Opens the DB read-only, for use from any thread (each connection is only ever used by one
+query at a time)"""
+    uri = "file:" + urllib.parse.quote(os.path.abspath(db_file)) + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+class ConnectionPool:
+    """A fixed number of read-only connections, handed out one query at a time. Each connection
+belongs to a generation; renew() starts a new generation, and connections from an older one are
+closed and replaced as they come back (or are handed out), so queries that are running when the DB
+is reloaded finish on the connection they started with."""
+    def __init__(self, db_file, size=DEFAULT_POOL_SIZE):
+        self.db_file = db_file
+        self.size = size
+        self.generation = 0
+        self.idle = asyncio.Queue()
+        for _ in range(size):
+            self.idle.put_nowait((self.generation, open_read_only(db_file)))
+
+    async def acquire(self):
+        """Waits for a connection and returns it, as (generation, connection)"""
+        generation, conn = await self.idle.get()
+        if generation != self.generation:
+            conn.close()
+            generation, conn = self.generation, open_read_only(self.db_file)
+        return generation, conn
+
+    def release(self, generation, conn):
+        """Hands a connection back"""
+        if generation != self.generation:
+            conn.close()
+            generation, conn = self.generation, open_read_only(self.db_file)
+        self.idle.put_nowait((generation, conn))
+
+    def renew(self):
+        """Starts a new generation of connections (see above)"""
+        self.generation = self.generation + 1
+
+    async def close(self):
+        """Waits for all the connections to come back, and closes them"""
+        for _ in range(self.size):
+            generation, conn = await self.idle.get()
+            conn.close()
+
+# ----------------------------------------------------------------
+# the service
+
+def db_signature(db_file):
+    """What tells us whether the DB file has changed: which file it is, its size and when it was
+last written"""
+    info = os.stat(db_file)
+    return info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns
+
+class QueryService:
+    """Runs the QUERIES on a DB, with the connection pool, the cache and the latency counters (see
+the top of this file). Use it from within the event loop."""
+    def __init__(self, db_file, pool_size=DEFAULT_POOL_SIZE, cache_entries=DEFAULT_CACHE_ENTRIES):
+        self.db_file = db_file
+        self.signature = db_signature(db_file)
+        self.pool = ConnectionPool(db_file, pool_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(pool_size)
+        self.cache = LruCache(cache_entries)
+        self.latency = LatencyCounters()
+        self.in_flight = {}
+        self.shared = 0
+        self.reloads = 0
+        self.started = time.time()
+
+    def reload(self):
+        """Empties the cache and renews the connections, for when the DB has changed. Raises
+OSError, with nothing changed, if the DB file isn't there (while it's being replaced, say)."""
+        signature = db_signature(self.db_file)
+        self.cache.clear()
+        self.in_flight.clear()
+        self.pool.renew()
+        self.signature = signature
+        self.reloads = self.reloads + 1
+
+    def check_reload(self):
+        """Reloads if the DB file has changed since we last looked"""
+        if db_signature(self.db_file) != self.signature:
+            self.reload()
+
+    async def query(self, name, args):
+        """Runs a query (one of QUERIES) with the given arguments (a dictionary of strings) and
+returns its result"""
+        if name not in QUERIES:
+            raise KeyError(name)
+        function, cacheable = QUERIES[name]
+        started = time.perf_counter()
+        self.check_reload()
+        key = (name, tuple(sorted(args.items())))
+        found, result = False, None
+        if cacheable:
+            found, result = self.cache.get(key)
+        if not found:
+            # if the same query is already running, we wait for its result rather than run it
+            # again (a burst of requests for the same thing would otherwise all miss the cache)
+            task = None
+            if cacheable:
+                task = self.in_flight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self.run_uncached(function, args))
+                if cacheable:
+                    self.in_flight[key] = task
+                    task.add_done_callback(lambda done: self.query_done(key, done))
+            else:
+                self.shared = self.shared + 1
+            generation, result = await asyncio.shield(task)
+        self.latency.record(name, time.perf_counter() - started)
+        return result
+
+    async def run_uncached(self, function, args):
+        """Runs a query on a connection from the pool, in a worker thread. Returns the generation
+of the connection along with the result."""
+        generation, conn = await self.pool.acquire()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, run_query, conn, function, args)
+        finally:
+            self.pool.release(generation, conn)
+        return generation, result
+
+    def query_done(self, key, task):
+        """Puts the result of a cacheable query in the cache, unless the DB was reloaded while it
+ran"""
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        if task.cancelled() or (task.exception() is not None):
+            return
+        generation, result = task.result()
+        if generation == self.pool.generation:
+            self.cache.put(key, result)
+
+    def stats(self):
+        """The latency counters, the cache and the reloads, for /stats"""
+        return {"db": self.db_file, "uptime_seconds": round(time.time() - self.started, 1),
+                "reloads": self.reloads, "queries": self.latency.stats(),
+                "cache": self.cache.stats(), "shared_results": self.shared}
+
+    async def close(self):
+        """Closes the connections and stops the threads"""
+        await self.pool.close()
+        self.executor.shutdown()
+
+def run_query(conn, function, args):
+    """Runs a query function on a connection (in a worker thread)"""
+    osmcu = conn.cursor()
+    try:
+        return function(osmcu, args)
+    finally:
+        osmcu.close()
+
+# ----------------------------------------------------------------
+# the HTTP side, just enough for GET requests with JSON answers
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                500: "Internal Server Error"}
+
+async def answer_request(service, method, target):
+    """Works out the answer to one request: returns (status, JSON-able body)"""
+    if method != "GET":
+        return 405, {"error": "only GET is supported"}
+    url = urllib.parse.urlsplit(target)
+    args = dict(urllib.parse.parse_qsl(url.query))
+    if url.path == "/stats":
+        return 200, service.stats()
+    if url.path == "/reload":
+        try:
+            service.reload()
+        except (sqlite3.Error, OSError) as err:
+            return 500, {"error": str(err)}
+        return 200, {"reloads": service.reloads}
+    if url.path.startswith("/query/"):
+        name = url.path[len("/query/"):]
+        if name not in QUERIES:
+            return 404, {"error": "no such query: " + name, "queries": sorted(QUERIES)}
+        try:
+            return 200, {"result": await service.query(name, args)}
+        except ValueError as err:
+            return 400, {"error": str(err)}
+        except (sqlite3.Error, OSError) as err:
+            return 500, {"error": str(err)}
+    return 404, {"error": "not found: " + url.path}
+
+async def handle_connection(service, reader, writer):
+    """Answers one HTTP request on a connection, then closes it"""
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        # skip the headers; we don't need any of them
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+        if len(request_line) < 2:
+            status, body = 400, {"error": "bad request"}
+        else:
+            status, body = await answer_request(service, request_line[0], request_line[1])
+        payload = json.dumps(body).encode("utf-8")
+        writer.write(("HTTP/1.1 " + str(status) + " " + HTTP_REASONS[status] + "\r\n" +
+                      "Content-Type: application/json\r\n" +
+                      "Content-Length: " + str(len(payload)) + "\r\n" +
+                      "Connection: close\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(db_file, host="127.0.0.1", port=DEFAULT_PORT, pool_size=DEFAULT_POOL_SIZE,
+                cache_entries=DEFAULT_CACHE_ENTRIES):
+    """Runs the service until it's interrupted"""
+    service = QueryService(db_file, pool_size, cache_entries)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(service, reader, writer), host, port)
+    print("Serving", db_file, "on http://" + host + ":" + str(port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve queries on an OSM DB over HTTP")
+    parser.add_argument("db", nargs="?", default="lyon.db", help="the DB (default: lyon.db)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--connections", type=int, default=DEFAULT_POOL_SIZE,
+                        help="how many queries can run at once")
+    parser.add_argument("--cache-entries", type=int, default=DEFAULT_CACHE_ENTRIES,
+                        help="how many tag count and way geometry results to keep")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.db, args.host, args.port, args.connections, args.cache_entries))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,31 @@
 """Analyzes an OpenStreetMap file for Lyon, France"""
 
 from __future__ import print_function
+import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import gzip
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import sys
 import xml.etree.ElementTree as ET
 import sqlite3
+import time
+import traceback
+import csvsink
+import nodestore
+import osmcolumnar
+import osmpbf
+import osmroute
 
 # ----------------------------------------------------------------
 # first section: parsing the XML file into CSVs
@@ -28,9 +50,205 @@ def prt_sorted_dict_top(unsrt, top_num):
             if count >= top_num:
                 return
 
-def generate_csvs():
-    """Parses the OpenStreetMap XML and generates CSV files required by the project. We also tally
-up some totals while parsing the XML."""
+# the tables we generate, in the order we generate them, and the columns of each one (these are
+# also the header lines of the CSV files)
+OSM_TABLES = ["nodes", "nodes_tags", "ways", "ways_tags", "ways_nodes", "relations",
+              "relations_tags", "relations_members"]
+OSM_COLUMNS = {
+    "nodes": ["id", "lat", "lon", "user", "uid", "version", "changeset", "timestamp"],
+    "nodes_tags": ["id", "key", "value", "type"],
+    "ways": ["id", "user", "uid", "version", "changeset", "timestamp"],
+    "ways_tags": ["id", "key", "value", "type"],
+    "ways_nodes": ["id", "node_id", "position"],
+    "relations": ["id", "user", "uid", "version", "changeset", "timestamp"],
+    "relations_tags": ["id", "key", "value", "type"],
+    "relations_members": ["id", "member_type", "member_id", "role", "position"],
+}
+
+
+# ----------------------------------------------------------------
+# the corrections we make to the tag values
+#
+# The corrections live in corrections.csv, one rule per line, with these columns:
+#   key          the tag key the rule applies to, e.g. addr:street
+#   match        how the value is matched: "exact", "nocase" (ignoring case), "regex" (a Python
+#                regular expression that has to match the whole value) or "any" (every value)
+#   pattern      what to match the value against (not used for "any")
+#   action       "replace" to change the value, or "delete" to drop the tag altogether
+#   replacement  the new value; for a regex it can refer to groups as \1 or \g<name>
+#   element, id  optionally, only apply the rule to the tags of one node, way or relation
+# A value gets at most one correction: rules for one element first, then exact, nocase, regex and
+# "any" rules, and within each kind, the first matching rule in the file.
+#
+# We compile the rules once into dictionaries (and a short list of regexes) per key, so checking a
+# tag costs a dictionary lookup for keys without rules, and we count how often each rule fires
+# instead of printing every correction.
+
+CORRECTIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corrections.csv")
+CORRECTION_MATCHES = ["exact", "nocase", "regex", "any"]
+CORRECTION_ACTIONS = ["replace", "delete"]
+
+class CorrectionRules:
+    """A set of correction rules, compiled for fast lookups."""
+    def __init__(self, rules):
+        self.rules = rules
+        self.keys = set()
+        self.by_element = {}
+        self.exact = {}
+        self.nocase = {}
+        self.regex = {}
+        self.any = {}
+        for rulenum, rule in enumerate(rules):
+            key = rule["key"]
+            self.keys.add(key)
+            if rule["id"]:
+                self.by_element.setdefault((key, rule["element"], rule["id"]), []).append(rulenum)
+            elif rule["match"] == "exact":
+                self.exact.setdefault(key, {}).setdefault(rule["pattern"], rulenum)
+            elif rule["match"] == "nocase":
+                self.nocase.setdefault(key, {}).setdefault(rule["pattern"].casefold(), rulenum)
+            elif rule["match"] == "regex":
+                self.regex.setdefault(key, []).append((re.compile(rule["pattern"]), rulenum))
+            else:
+                self.any.setdefault(key, rulenum)
+
+    def rule_matches(self, rulenum, value):
+        """Tells whether a single rule matches a value"""
+        rule = self.rules[rulenum]
+        if rule["match"] == "exact":
+            return value == rule["pattern"]
+        if rule["match"] == "nocase":
+            return value.casefold() == rule["pattern"].casefold()
+        if rule["match"] == "regex":
+            return re.fullmatch(rule["pattern"], value) is not None
+        return True
+
+    def find_rule(self, element, elem_id, key, value):
+        """Returns the number of the rule that applies to a tag, or -1 if none does. element is
+"node", "way" or "relation" and elem_id is the id as a string."""
+        if key not in self.keys:
+            return -1
+        if self.by_element:
+            for rulenum in self.by_element.get((key, element, elem_id), []):
+                if self.rule_matches(rulenum, value):
+                    return rulenum
+        if key in self.exact:
+            rulenum = self.exact[key].get(value, -1)
+            if rulenum >= 0:
+                return rulenum
+        if key in self.nocase:
+            rulenum = self.nocase[key].get(value.casefold(), -1)
+            if rulenum >= 0:
+                return rulenum
+        for pattern, rulenum in self.regex.get(key, []):
+            if pattern.fullmatch(value):
+                return rulenum
+        return self.any.get(key, -1)
+
+    def apply_rule(self, rulenum, value):
+        """Returns what a rule turns a value into, or None if it deletes the tag"""
+        rule = self.rules[rulenum]
+        if rule["action"] == "delete":
+            return None
+        if rule["match"] == "regex":
+            return re.fullmatch(rule["pattern"], value).expand(rule["replacement"])
+        return rule["replacement"]
+
+    def correct(self, element, elem_id, key, value, counts):
+        """Returns the corrected value of a tag, or None if the tag should be dropped, and counts
+the rule that fired (if one did) in counts."""
+        rulenum = self.find_rule(element, elem_id, key, value)
+        if rulenum < 0:
+            return value
+        counts[rulenum] = counts[rulenum] + 1
+        return self.apply_rule(rulenum, value)
+
+    def describe(self, rulenum):
+        """Describes a rule for the correction report"""
+        rule = self.rules[rulenum]
+        desc = rule["key"] + " " + rule["match"]
+        if rule["match"] != "any":
+            desc = desc + " '" + rule["pattern"] + "'"
+        if rule["id"]:
+            desc = desc + " (" + rule["element"] + " " + rule["id"] + ")"
+        if rule["action"] == "delete":
+            return desc + " deleted"
+        return desc + " -> '" + rule["replacement"] + "'"
+
+def load_correction_rules(filename=CORRECTIONS_FILE):
+    """Reads the correction rules from a CSV file (see above) and compiles them."""
+    rules = []
+    with open(filename, newline="") as rulesfile:
+        for linenum, rule in enumerate(csv.DictReader(rulesfile), start=2):
+            for column in ["pattern", "replacement", "element", "id"]:
+                rule[column] = rule.get(column) or ""
+            if rule["match"] not in CORRECTION_MATCHES:
+                raise ValueError(filename + " line " + str(linenum) + ": unknown match " +
+                                 repr(rule["match"]))
+            if rule["action"] not in CORRECTION_ACTIONS:
+                raise ValueError(filename + " line " + str(linenum) + ": unknown action " +
+                                 repr(rule["action"]))
+            if rule["id"] and (rule["element"] not in ("node", "way", "relation")):
+                raise ValueError(filename + " line " + str(linenum) +
+                                 ": a rule with an id needs an element of node, way or relation")
+            if rule["match"] == "regex":
+                re.compile(rule["pattern"])
+            rules.append(rule)
+    return CorrectionRules(rules)
+
+def default_correction_rules():
+    """The rules from corrections.csv next to this script, or no rules if it isn't there"""
+    if os.path.exists(CORRECTIONS_FILE):
+        return load_correction_rules(CORRECTIONS_FILE)
+    return CorrectionRules([])
+
+def prt_correction_counts(counts):
+    """Prints how many times each correction rule fired, given the (description, count) pairs
+from the tallies"""
+    print("Corrections made:")
+    total = 0
+    for desc, num in counts:
+        if num > 0:
+            print("  " + desc + ":", num)
+            total = total + num
+    print("Total corrections:", total)
+
+# ----------------------------------------------------------------
+
+def open_csv_writers(suffix=".csv", header=True, sink=None):
+    """Opens one CSV file per table for writing and writes the header line to each (unless header
+is False). sink says how the files are written (see csvsink.py); by default they're plain CSV with
+a big write buffer. Returns the open files (so they can be closed) and a dictionary of csv.writer
+objects keyed by table name."""
+    if sink is None:
+        sink = csvsink.CsvSink()
+    files = []
+    writers = {}
+    for tblname in OSM_TABLES:
+        csvfile = sink.open(tblname + suffix)
+        writers[tblname] = csv.writer(csvfile, dialect='unix')
+        if header:
+            writers[tblname].writerow(OSM_COLUMNS[tblname])
+        files.append(csvfile)
+    return files, writers
+
+def parse_osm_into_writers(filename, writers, rules=None, fast=False):
+    """Parses the OpenStreetMap XML and hands every row to the writer for its table. A writer is
+anything with a writerow() method, such as a csv.writer or an SqlBatchWriter. The tag values are
+corrected with the given CorrectionRules (by default, the ones in corrections.csv). We also tally up
+some totals while parsing the XML, and return the tallies. With fast True we use the fast parser,
+which skips the structure tallies (see parse_osm_fast_events_into_writers)."""
+    events = ET.iterparse(filename, events=('start', 'end'))
+    if fast:
+        return parse_osm_fast_events_into_writers(events, writers, rules=rules)
+    return parse_osm_events_into_writers(events, writers, rules=rules)
+
+def parse_osm_events_into_writers(events, writers, wrapped=False, rules=None):
+    """Does the work for parse_osm_into_writers, given the (event, element) pairs from the XML
+parser. If wrapped is True, the first element is a made-up <osm> around a piece of the file (see
+parse_shard), which goes on the stack like the real one would but is left out of the tallies."""
+    if rules is None:
+        rules = default_correction_rules()
     # we tally up various things as we parse
     count = 0
     tag_set = {}
@@ -42,85 +260,32 @@ up some totals while parsing the XML."""
     stack = []
     stkptr = 0
 
-    # open the CSV files for writing
-    nodes_file = open("nodes.csv", mode="w", newline="")
-    nodes_tags_file = open("nodes_tags.csv", mode="w", newline="")
-    ways_file = open("ways.csv", mode="w", newline="")
-    ways_tags_file = open("ways_tags.csv", mode="w", newline="")
-    ways_nodes_file = open("ways_nodes.csv", mode="w", newline="")
-
-    nodes_writer = csv.writer(nodes_file, dialect='unix')
-    nodes_tags_writer = csv.writer(nodes_tags_file, dialect='unix')
-    ways_writer = csv.writer(ways_file, dialect='unix')
-    ways_tags_writer = csv.writer(ways_tags_file, dialect='unix')
-    ways_nodes_writer = csv.writer(ways_nodes_file, dialect='unix')
-
-    nodes_writer.writerow(["id", "lat", "lon", "user", "uid", "version", "changeset", "timestamp"])
-    ways_writer.writerow(["id", "user", "uid", "version", "changeset", "timestamp"])
-    nodes_tags_writer.writerow(["id", "key", "value", "type"])
-    ways_tags_writer.writerow(["id", "key", "value", "type"])
-    ways_nodes_writer.writerow(["id", "node_id", "position"])
+    nodes_writer = writers["nodes"]
+    nodes_tags_writer = writers["nodes_tags"]
+    ways_writer = writers["ways"]
+    ways_tags_writer = writers["ways_tags"]
+    ways_nodes_writer = writers["ways_nodes"]
+    relations_writer = writers["relations"]
+    relations_tags_writer = writers["relations_tags"]
+    relations_members_writer = writers["relations_members"]
     way_position = 0
-
-    #
-    # all the corrections to addr:street that we are going to do
-    corrections = {
-        "Boulevard du 11 novembre 1918": "Boulevard du 11 Novembre 1918",
-        "Rue moliere": "Rue Molière",
-        "Chemin jean petit": "Chemin Jean Petit",
-        "Cours DOCTEUR LONG": "Cours Docteur Long",
-        "Cours du Docteur Long": "Cours Docteur Long",
-        "Rue du Docteur Fleury-Pierre Papillon": "Rue du Docteur Pierre-Fleury Papillon",
-        "Galerie Soufflot": "Quai Jules Courmont",
-        "Caluire-et-Cuire": "Quai Clemenceau",
-        "Route de vienne": "Route de Vienne",
-        "rue de la charité": "Rue de la Charité",
-        "rue du 8 Mai 1945": "Rue du 8 Mai 1945",
-        "GRANDE RUE": "Grande Rue",
-        "rue des Charmettes": "Rue des Charmettes",
-        "allée des Savoies": "Allée des Savoies",
-        "Roger Salengro": "Rue Roger Salengro",
-        "Passage du beal": "Passage du Beal",
-        "/25 Grande Rue": "Grande Rue",
-        "37": "Grande Rue de Vaise",
-        "A 7": "A7",
-        "Ctre Cial Carrefour Ecully": "Centre Commercial Carrefour Ecully",
-        "Grand Cloître": "Place du Grand Cloître",
-        "Pl. Depéret": "Place Depéret",
-        "Rond-Point Maréchal de Lattre de Tassigny":
-            "Rue du Rond-Point Maréchal de Lattre de Tassigny",
-        "Rue": "Rue Lortet",
-        "Victor Hugo": "Rue Victor Hugo",
-        "avenue Roger Salengro": "Avenue Roger Salengro",
-        "boulevard Joliot Curie": "Boulevard Joliot Curie",
-        "Chemin de Chalin": "chemin de Chalin",
-        "chemin de chantegrillet": "Chemin de chantegrillet",
-        "des remparts d'Ainay": "Rue des Remparts d'Ainay",
-        "humanités": "Rue des Humanités",
-        "place des Trois Renards": "Place des Trois Renards",
-        "quai Perrache": "Quai Perrache",
-        "rue Béchevelin": "Rue Béchevelin",
-        "rue Carnot": "Rue Carnot",
-        "rue Chavanne": "Rue Chavanne",
-        "rue Duhamel": "Rue Duhamel",
-        "rue François Peissel": "Rue François Peissel",
-        "rue Laurent Paul": "Rue Laurent Paul",
-        "rue Roger Salengro": "Rue Roger Salengro",
-        "rue commandant Charcot": "Rue Commandant Charcot",
-        "rue de Sèze": "Rue de Sèze",
-        "rue de sans soucis": "Rue de Sans Soucis",
-        "rue de tourvielle": "Rue de Tourvielle",
-        "rue des freres bertrand": "Rue des Frères Bertrand",
-        "rue du 4 août 1789": "Rue du 4 Août 1789",
-        "rue vaubecour": "Rue Vaubecour",
-    }
+    member_position = 0
+    correction_counts = [0] * len(rules.rules)
 
     #
     # here we go -- here's the parser + corrector
-    filename = "lyon.osm"
-    for event, elem in ET.iterparse(filename, events=('start', 'end')):
+    root = None
+    for event, elem in events:
+        if wrapped and ((root is None) or (elem is root)):
+            if root is None:
+                root = elem
+                stack.append([elem.tag, elem.attrib])
+                stkptr = 1
+                tag_sub_tags[elem.tag] = {}
+                tag_attrs[elem.tag] = {}
+            continue
         count = count + 1
-        if count == 1:
+        if root is None:
             root = elem
         if event == "start":
             tag = elem.tag
@@ -171,15 +336,17 @@ up some totals while parsing the XML."""
                 value = attributes["v"]
                 #
                 # Here's the magic spot where we apply our corrections
-                if attributes["k"] == "addr:street":
-                    if value in corrections:
-                        print("Correcting", value, "-> to:", corrections[value])
-                        value = corrections[value]
-                if above_tag == "node":
+                if attributes["k"] in rules.keys:
+                    value = rules.correct(above_tag, above_attrs["id"], attributes["k"], value,
+                                          correction_counts)
+                if value is None:
+                    pass # a rule deleted this tag
+                elif above_tag == "node":
                     nodes_tags_writer.writerow([above_attrs["id"], key, value, k_type])
                 elif above_tag == "way":
                     ways_tags_writer.writerow([above_attrs["id"], key, value, k_type])
-                # for relation, we do nothing
+                elif above_tag == "relation":
+                    relations_tags_writer.writerow([above_attrs["id"], key, value, k_type])
             elif tag == "way":
                 ways_writer.writerow([attributes["id"], attributes["user"], attributes["uid"],
                                       attributes["version"], attributes["changeset"],
@@ -189,6 +356,17 @@ up some totals while parsing the XML."""
                 way_position = way_position + 1
                 above_attrs = stack[stkptr - 2][1]
                 ways_nodes_writer.writerow([above_attrs["id"], attributes["ref"], way_position])
+            elif tag == "relation":
+                relations_writer.writerow([attributes["id"], attributes["user"], attributes["uid"],
+                                           attributes["version"], attributes["changeset"],
+                                           attributes["timestamp"]])
+                member_position = 0
+            elif tag == "member":
+                member_position = member_position + 1
+                above_attrs = stack[stkptr - 2][1]
+                relations_members_writer.writerow([above_attrs["id"], attributes["type"],
+                                                   attributes["ref"], attributes["role"],
+                                                   member_position])
             # for all the other tags, we do nothing
         if event == "end":
             tag = elem.tag
@@ -198,21 +376,395 @@ up some totals while parsing the XML."""
                 print("tag end mismatch!!")
         # magic line that keeps memory usage from exploding
         root.clear()
+    return {
+        "count": count,
+        "tag_set": tag_set,
+        "tag_sub_tags": tag_sub_tags,
+        "tag_attrs": tag_attrs,
+        "osmtag_keys": osmtag_keys,
+        "unique_users": unique_users,
+        "corrections": [[rules.describe(rulenum), num]
+                        for rulenum, num in enumerate(correction_counts)],
+    }
+
+# ----------------------------------------------------------------
+# the fast parser
+#
+# parse_osm_events_into_writers keeps a stack of every open element and updates the tallies for
+# every start event, before it even looks at what the element is. The fast parser only does work
+# when a node, way or relation ends: by then the element has all its tags, nds and members as
+# children, so we write the element and its children in one go, count them in bulk, and clear it
+# straight away. The tags, nds and members themselves are skipped when they end, as their parent
+# takes care of them. Start events are only used to get hold of the root, so the cleared elements
+# can be dropped from it. The structure tallies (which tags are in which, and their attributes)
+# cost extra, so they're only collected if asked for.
+
+def parse_osm_fast_events_into_writers(events, writers, wrapped=False, rules=None,
+                                       structure_tallies=False):
+    """The fast version of parse_osm_events_into_writers (see above). Writes the same rows and
+returns the same tallies, except that tag_sub_tags and tag_attrs are left empty unless
+structure_tallies is True."""
+    if rules is None:
+        rules = default_correction_rules()
+    tag_set = collections.Counter()
+    osmtag_keys = collections.Counter()
+    tag_sub_tags = {}
+    tag_attrs = {}
+    unique_users = {}
+    correction_counts = [0] * len(rules.rules)
+    rule_keys = rules.keys
+
+    nodes_writer = writers["nodes"]
+    ways_writer = writers["ways"]
+    ways_nodes_writer = writers["ways_nodes"]
+    relations_writer = writers["relations"]
+    relations_members_writer = writers["relations_members"]
+    tags_writers = {"node": writers["nodes_tags"], "way": writers["ways_tags"],
+                    "relation": writers["relations_tags"]}
+
+    root = None
+    for event, elem in events:
+        if event == "start":
+            if root is None:
+                root = elem
+                if not wrapped:
+                    tag_set[elem.tag] += 1
+                    if structure_tallies:
+                        tag_attrs.setdefault(elem.tag, {}).update(dict.fromkeys(elem.attrib, True))
+            continue
+        tag = elem.tag
+        if tag in ("tag", "nd", "member"):
+            continue
+        if elem is root:
+            break
+        attributes = elem.attrib
+        tag_set[tag] += 1
+        if structure_tallies:
+            tag_sub_tags.setdefault(root.tag, {})[tag] = True
+            tag_attrs.setdefault(tag, {}).update(dict.fromkeys(attributes, True))
+        if tag == "node":
+            nodes_writer.writerow([attributes["id"], attributes["lat"], attributes["lon"],
+                                   attributes["user"], attributes["uid"], attributes["version"],
+                                   attributes["changeset"], attributes["timestamp"]])
+        elif tag == "way":
+            ways_writer.writerow([attributes["id"], attributes["user"], attributes["uid"],
+                                  attributes["version"], attributes["changeset"],
+                                  attributes["timestamp"]])
+        elif tag == "relation":
+            relations_writer.writerow([attributes["id"], attributes["user"], attributes["uid"],
+                                       attributes["version"], attributes["changeset"],
+                                       attributes["timestamp"]])
+        if "uid" in attributes:
+            unique_users[attributes["uid"]] = True
+        if len(elem):
+            tag_set.update([child.tag for child in elem])
+            tags_writer = tags_writers.get(tag)
+            elem_id = attributes.get("id")
+            position = 0
+            for child in elem:
+                child_tag = child.tag
+                child_attrs = child.attrib
+                if structure_tallies:
+                    tag_sub_tags.setdefault(tag, {})[child_tag] = True
+                    tag_attrs.setdefault(child_tag, {}).update(dict.fromkeys(child_attrs, True))
+                if child_tag == "tag":
+                    k = child_attrs["k"]
+                    osmtag_keys[k] += 1
+                    if tags_writer is None:
+                        continue
+                    value = child_attrs["v"]
+                    # Here's the magic spot where we apply our corrections
+                    if k in rule_keys:
+                        value = rules.correct(tag, elem_id, k, value, correction_counts)
+                        if value is None:
+                            continue # a rule deleted this tag
+                    key, k_type = split_into_key_and_type(k)
+                    tags_writer.writerow([elem_id, key, value, k_type])
+                elif child_tag == "nd":
+                    position = position + 1
+                    ways_nodes_writer.writerow([elem_id, child_attrs["ref"], position])
+                elif child_tag == "member":
+                    position = position + 1
+                    relations_members_writer.writerow([elem_id, child_attrs["type"],
+                                                       child_attrs["ref"], child_attrs["role"],
+                                                       position])
+        # we're done with this element, so let it (and its children) go
+        elem.clear()
+        root.clear()
+    structure_order = list(tag_set)
+    if (root is not None) and (root.tag not in tag_set):
+        structure_order.insert(0, root.tag)
+    return {
+        "count": 2 * sum(tag_set.values()),
+        "tag_set": dict(tag_set),
+        "tag_sub_tags": {tag: tag_sub_tags.get(tag, {}) for tag in structure_order}
+                        if structure_tallies else {},
+        "tag_attrs": {tag: tag_attrs.get(tag, {}) for tag in structure_order}
+                     if structure_tallies else {},
+        "osmtag_keys": dict(osmtag_keys),
+        "unique_users": unique_users,
+        "corrections": [[rules.describe(rulenum), num]
+                        for rulenum, num in enumerate(correction_counts)],
+    }
+
+def prt_tallies(tallies):
+    """Prints the tallies we collected while parsing the XML"""
+    print("Total number of tags", tallies["count"])
+    print("Number of occurrences of each tag", tallies["tag_set"])
+    if tallies["tag_sub_tags"]:
+        print("Tags and their sub-tags (which tags are contained within each other tag)",
+              tallies["tag_sub_tags"])
+    if tallies["tag_attrs"]:
+        print("Tag attributes -- list of what attributes each tag has", tallies["tag_attrs"])
+    print("Values used for keys ('k' attributes on 'tag' tags")
+    prt_sorted_dict_top(tallies["osmtag_keys"], -1)
+    print("Total number of unique users:", len(tallies["unique_users"]))
+    prt_correction_counts(tallies["corrections"])
+
+def parse_pbf_into_writers(filename, writers, workers=None, rules=None):
+    """Reads an OpenStreetMap PBF file and hands every row to the writer for its table, the same
+rows parse_osm_into_writers would produce from the XML. The blobs are decoded by a pool of worker
+processes (see osmpbf.read_pbf). We tally up what we can while we go; a PBF file has no XML, so
+there are no attributes to tally, and we count a start and an end for every element, like the XML
+parser would."""
+    count = 0
+    tag_set = {}
+    tag_sub_tags = {}
+    osmtag_keys = {}
+    unique_users = {}
+    if rules is None:
+        rules = default_correction_rules()
+    correction_counts = [0] * len(rules.rules)
+
+    def tally(tag, num, sub_tag):
+        """Counts num elements of one kind, and which kind of element they contain"""
+        if tag not in tag_set:
+            tag_set[tag] = 0
+            tag_sub_tags[tag] = {}
+        tag_set[tag] = tag_set[tag] + num
+        if sub_tag is not None:
+            tag_sub_tags[tag][sub_tag] = True
+
+    def write_tags(tags_writer, element, elem_id, tags):
+        """Writes out the tags of one element, with our corrections"""
+        for k, value in tags:
+            osmtag_keys[k] = osmtag_keys.get(k, 0) + 1
+            key, k_type = split_into_key_and_type(k)
+            if k in rules.keys:
+                value = rules.correct(element, str(elem_id), k, value, correction_counts)
+            if value is not None:
+                tags_writer.writerow([elem_id, key, value, k_type])
+        if tags:
+            tally("tag", len(tags), None)
+
+    for block in osmpbf.read_pbf(filename, workers):
+        for node in block["nodes"]:
+            writers["nodes"].writerow(node[:8])
+            unique_users[node[4]] = True
+            tally("node", 1, "tag" if node[8] else None)
+            write_tags(writers["nodes_tags"], "node", node[0], node[8])
+        for way in block["ways"]:
+            writers["ways"].writerow(way[:6])
+            unique_users[way[2]] = True
+            tally("way", 1, "tag" if way[6] else None)
+            if way[7]:
+                tally("way", 0, "nd")
+                tally("nd", len(way[7]), None)
+            way_position = 0
+            for node_id in way[7]:
+                way_position = way_position + 1
+                writers["ways_nodes"].writerow([way[0], node_id, way_position])
+            write_tags(writers["ways_tags"], "way", way[0], way[6])
+        for relation in block["relations"]:
+            writers["relations"].writerow(relation[:6])
+            unique_users[relation[2]] = True
+            tally("relation", 1, "tag" if relation[6] else None)
+            if relation[7]:
+                tally("relation", 0, "member")
+                tally("member", len(relation[7]), None)
+            member_position = 0
+            for member_type, member_id, role in relation[7]:
+                member_position = member_position + 1
+                writers["relations_members"].writerow([relation[0], member_type, member_id, role,
+                                                       member_position])
+            write_tags(writers["relations_tags"], "relation", relation[0], relation[6])
+    unique_users.pop("", None)
+    for num in tag_set.values():
+        count = count + 2 * num
+    return {
+        "count": count,
+        "tag_set": tag_set,
+        "tag_sub_tags": tag_sub_tags,
+        "tag_attrs": {},
+        "osmtag_keys": osmtag_keys,
+        "unique_users": unique_users,
+        "corrections": [[rules.describe(rulenum), num]
+                        for rulenum, num in enumerate(correction_counts)],
+    }
+
+def parse_into_writers(filename, writers, rules=None, fast=False):
+    """Parses an OpenStreetMap file into the writers, going by the file name to tell a PBF file
+(.osm.pbf) from an XML one. fast picks the fast XML parser (see parse_osm_into_writers)."""
+    if filename.endswith(".pbf"):
+        return parse_pbf_into_writers(filename, writers, rules=rules)
+    return parse_osm_into_writers(filename, writers, rules, fast)
+
+def generate_csvs(filename="lyon.osm", node_store=None, rules=None, sink=None, columnar=None,
+                  fast=False):
+    """Parses the OpenStreetMap XML (or PBF) and generates CSV files required by the project,
+correcting the tags with rules (by default, corrections.csv), and writing them through sink (by
+default, plain CSV; see csvsink.py). We also tally up some totals while parsing. If node_store is
+given (see nodestore.py), we fill it with the node locations too, and if columnar is given (an
+osmcolumnar.ColumnarExport), we write the tables to Parquet files as well. fast picks the fast XML
+parser."""
+    # open the CSV files for writing
+    files, writers = open_csv_writers(sink=sink)
+    add_node_store_writer(writers, node_store)
+    add_columnar_writers(writers, columnar)
+    tallies = parse_into_writers(filename, writers, rules, fast)
     print("Done with parsing.")
+    finish_node_store(node_store)
+    if columnar is not None:
+        columnar.close()
     # close all the output files
-    nodes_file.close()
-    nodes_tags_file.close()
-    ways_file.close()
-    ways_tags_file.close()
-    ways_nodes_file.close()
+    for csvfile in files:
+        csvfile.close()
     # output our tallies
-    print("Total number of tags", count)
-    print("Number of occurrences of each tag", tag_set)
-    print("Tags and their sub-tags (which tags are contained within each other tag)", tag_sub_tags)
-    print("Tag attributes -- list of what attributes each tag has", tag_attrs)
-    print("Values used for keys ('k' attributes on 'tag' tags")
-    prt_sorted_dict_top(osmtag_keys, -1)
-    print("Total number of unique users:", len(unique_users))
+    prt_tallies(tallies)
+
+# ----------------------------------------------------------------
+# parsing the XML file on several cores at once
+#
+# We cut the file into byte ranges, one per worker process. Each range starts on a top-level
+# <node>, <way> or <relation>, so no element is ever split between two workers. A worker that
+# doesn't start at the top of the file never sees the real <osm> element, so we wrap its range in
+# a made-up one, which we leave out of the tallies. Each worker writes its rows to its own part
+# files, and when everyone is done we glue the parts together in order and add up the tallies,
+# which gets us exactly what the one-core parse would have produced.
+
+ELEMENT_START = re.compile(rb"<(?:node|way|relation)[\s/>]")
+
+def find_element_start(osmfile, offset):
+    """Returns the byte offset of the first top-level node, way or relation at or after offset in
+an OSM file opened in binary mode, or None if there isn't one."""
+    osmfile.seek(offset)
+    chunk_start = offset
+    carry = b""
+    while True:
+        chunk = osmfile.read(1 << 16)
+        if not chunk:
+            return None
+        data = carry + chunk
+        match = ELEMENT_START.search(data)
+        if match:
+            return chunk_start - len(carry) + match.start()
+        # keep the end of this chunk in case a tag is split across chunks
+        carry = data[-16:]
+        chunk_start = chunk_start + len(chunk)
+
+def split_osm_file(filename, num_shards):
+    """Cuts an OSM file into up to num_shards byte ranges that each start on a top-level element
+(except the first, which starts at the top of the file). Returns a list of (start, end) pairs."""
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, "rb") as osmfile:
+        for shard in range(1, num_shards):
+            boundary = find_element_start(osmfile, (size * shard) // num_shards)
+            if (boundary is not None) and (boundary > boundaries[-1]):
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return [(boundaries[idx], boundaries[idx + 1]) for idx in range(len(boundaries) - 1)]
+
+def shard_events(filename, start, end, last):
+    """Feeds a byte range of the OSM file to the XML parser and yields the (event, element) pairs.
+Unless the range starts at the top of the file, we wrap it in a made-up <osm> element."""
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    if start > 0:
+        parser.feed(b"<osm>")
+    with open(filename, "rb") as osmfile:
+        osmfile.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = osmfile.read(min(1 << 20, remaining))
+            if not chunk:
+                break
+            remaining = remaining - len(chunk)
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                yield event, elem
+    if not last:
+        parser.feed(b"</osm>")
+    parser.close()
+    for event, elem in parser.read_events():
+        yield event, elem
+
+def parse_shard(args):
+    """Worker process: parses one byte range of the OSM file into its own set of part CSV files.
+Returns the tallies and the suffix of the part files."""
+    filename, shard, start, end, last, rules, sink, fast = args
+    suffix = ".csv.part" + str(shard)
+    files, writers = open_csv_writers(suffix, header=False, sink=sink)
+    parse_events = parse_osm_events_into_writers
+    if fast:
+        parse_events = parse_osm_fast_events_into_writers
+    tallies = parse_events(shard_events(filename, start, end, last), writers, start > 0, rules)
+    for csvfile in files:
+        csvfile.close()
+    return tallies, suffix
+
+def merge_tallies(all_tallies):
+    """Adds up the tallies from several workers, in order, so that the dictionaries come out in the
+same order as they would from a single parse."""
+    merged = {"count": 0, "tag_set": {}, "tag_sub_tags": {}, "tag_attrs": {}, "osmtag_keys": {},
+              "unique_users": {}, "corrections": []}
+    for tallies in all_tallies:
+        if not merged["corrections"]:
+            merged["corrections"] = [[desc, 0] for desc, num in tallies["corrections"]]
+        for rulenum, (desc, num) in enumerate(tallies["corrections"]):
+            merged["corrections"][rulenum][1] = merged["corrections"][rulenum][1] + num
+        merged["count"] = merged["count"] + tallies["count"]
+        for name in ["tag_set", "osmtag_keys"]:
+            for key, value in tallies[name].items():
+                merged[name][key] = merged[name].get(key, 0) + value
+        for name in ["tag_sub_tags", "tag_attrs"]:
+            for key, value in tallies[name].items():
+                if key not in merged[name]:
+                    merged[name][key] = {}
+                merged[name][key].update(value)
+        merged["unique_users"].update(tallies["unique_users"])
+    return merged
+
+def generate_csvs_parallel(filename="lyon.osm", workers=None, rules=None, sink=None, fast=False):
+    """Same as generate_csvs, but spreads the parsing over several worker processes."""
+    if filename.endswith(".pbf"):
+        # the PBF reader already decodes on all our cores
+        generate_csvs(filename, rules=rules, sink=sink)
+        return
+    if workers is None:
+        workers = os.cpu_count()
+    if rules is None:
+        rules = default_correction_rules()
+    if sink is None:
+        sink = csvsink.CsvSink()
+    shards = split_osm_file(filename, workers)
+    jobs = []
+    for shard, (start, end) in enumerate(shards):
+        jobs.append((filename, shard, start, end, shard == len(shards) - 1, rules, sink, fast))
+    print("Parsing", filename, "in", len(jobs), "pieces")
+    with multiprocessing.Pool(min(workers, len(jobs))) as pool:
+        results = pool.map(parse_shard, jobs)
+    print("Done with parsing.")
+    # glue the part files together, in order, under a header line (compressed part files are
+    # complete compressed streams, which can follow each other in one file)
+    for tblname in OSM_TABLES:
+        with sink.open(tblname + ".csv") as csvfile:
+            csv.writer(csvfile, dialect='unix').writerow(OSM_COLUMNS[tblname])
+        with open(sink.filename(tblname + ".csv"), mode="ab") as csvfile:
+            for tallies, suffix in results:
+                with open(sink.filename(tblname + suffix), mode="rb") as partfile:
+                    shutil.copyfileobj(partfile, csvfile, 1 << 20)
+                os.remove(sink.filename(tblname + suffix))
+    prt_tallies(merge_tallies([tallies for tallies, suffix in results]))
 
 # ----------------------------------------------------------------
 # second section: parsing the CSV files into an SQL DB
@@ -254,10 +806,11 @@ def dict_to_insert(tblname, insdct):
 # YOU must create the table with the correct field names and types before calling this function.
 # Column names much match field names in the CSV.
 def csv_to_database(csv_file, tblname, rename_fields, dbcu):
-    """Pulls a CSV file into a database table. The table needs to already be created."""
+    """Pulls a CSV file into a database table. The table needs to already be created. The file can
+be gzip or zstd compressed (see csvsink.py)."""
     fieldnames = []
     rownum = 0
-    with open(csv_file, newline='') as csvfile:
+    with csvsink.open_csv_source(csv_file) as csvfile:
         thereader = csv.reader(csvfile, delimiter=',', quotechar='"')
         for rowdat in thereader:
             if rownum == 0:
@@ -275,13 +828,122 @@ def csv_to_database(csv_file, tblname, rename_fields, dbcu):
                 sql = dict_to_insert(tblname, insdict)
                 dbcu.execute(sql)
             rownum = rownum + 1
+    return rownum - 1
+
+# The bulk import engine. Instead of building an SQL string per row like csv_to_database does, we
+# prepare one INSERT per table (see SqlBatchWriter) and stream the rows through executemany in
+# chunks. Since we're not building SQL strings any more, we can't lean on the quoting to get the
+# types right, so we convert each column to the type set_up_osm_db declared for it.
+def coerce_int(info):
+    """Converts a CSV field to an int, leaving it alone if it isn't one"""
+    try:
+        return int(info)
+    except ValueError:
+        return info
+
+def coerce_float(info):
+    """Converts a CSV field to a float, leaving it alone if it isn't one"""
+    try:
+        return float(info)
+    except ValueError:
+        return info
+
+COLUMN_COERCIONS = {"INTEGER": coerce_int, "REAL": coerce_float}
+
+def table_column_types(dbcu, tblname):
+    """Asks the DB what type each column of a table was declared with, and returns a dictionary
+from column name to type."""
+    types = {}
+    for row in dbcu.execute("PRAGMA table_info(" + tblname + ");"):
+        types[row[1]] = row[2].upper()
+    return types
+
+def bulk_csv_to_database(csv_file, tblname, rename_fields, dbcu, chunk_size=10000, skip_rows=0,
+                         checkpoint=None, checkpoint_rows=None):
+    """Pulls a CSV file into a database table with one prepared INSERT, chunked executemany calls,
+and per-column type conversion. The table needs to already be created. Returns the number of
+rows. Like csv_to_database, it reads compressed files too. The first skip_rows rows are skipped
+(they're in the table already), and if checkpoint is given, we call it every checkpoint_rows rows,
+once they're inserted, with the number of rows done so far (counting the skipped ones)."""
+    with csvsink.open_csv_source(csv_file) as csvfile:
+        thereader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        fieldnames = []
+        for info in next(thereader):
+            if info in rename_fields:
+                fieldnames.append(rename_fields[info])
+            else:
+                fieldnames.append(info)
+        writer = SqlBatchWriter(dbcu, tblname, fieldnames, chunk_size, coerce=True)
+        rows = thereader
+        if skip_rows > 0:
+            rows = itertools.islice(thereader, skip_rows, None)
+        next_checkpoint = None
+        if checkpoint is not None:
+            next_checkpoint = checkpoint_rows
+        done = 0
+        for rowdat in rows:
+            writer.writerow(rowdat)
+            done = done + 1
+            if done == next_checkpoint:
+                writer.flush()
+                checkpoint(skip_rows + done)
+                next_checkpoint = next_checkpoint + checkpoint_rows
+        writer.flush()
+    return writer.rows
 
-def set_up_osm_db(create_schema):
-    """Set up the DB where we are going to import and analyze the OSM data"""
+def prt_rows_per_sec(tblname, rows, seconds):
+    """Prints how fast we got rows into a table"""
+    if seconds > 0:
+        rate = rows / seconds
+    else:
+        rate = 0
+    print(tblname + ":", rows, "rows in", round(seconds, 2), "seconds (" + str(int(rate)),
+          "rows/sec)")
+
+# Loading a whole OSM file is one big batch of inserts into a brand new DB, and SQLite's defaults
+# are made for keeping a DB safe through crashes, not for that. In bulk-load mode (see
+# set_up_osm_db) we use bigger pages and a bigger cache, keep the rollback journal in memory and
+# don't wait for the disk after each commit (if we crash halfway through, we start the load over
+# anyway). We also leave out the secondary indexes, so the inserts don't have to keep them up to
+# date row by row; building them afterwards from the finished tables is much faster. When we're
+# done, finish_osm_db builds the indexes, runs ANALYZE so SQLite's query planner knows how big the
+# tables are and how selective the indexes are, and puts the safe settings back. (The FOREIGN KEYs
+# in the schema cost nothing while loading, as SQLite only checks them with PRAGMA foreign_keys on.)
+BULK_LOAD_PAGE_SIZE = 16384
+BULK_LOAD_PRAGMAS = [("journal_mode", "MEMORY"), ("synchronous", "OFF"),
+                     ("cache_size", "-262144"), ("temp_store", "MEMORY")]
+SAFE_PRAGMAS = [("journal_mode", "DELETE"), ("synchronous", "FULL"), ("cache_size", "-2000"),
+                ("temp_store", "DEFAULT")]
+
+# the secondary indexes on the OSM tables: name, table, columns
+OSM_INDEXES = [
+    ("idx_nd_usr", "nodes", "uid"),
+    ("idx_wy_usr", "ways", "uid"),
+    ("idx_wynd_id", "ways_nodes", "id"),
+    ("idx_wynd_nd", "ways_nodes", "node_id"),
+    ("idx_ndtg_tk", "nodes_tags", "type, key"),
+    ("idx_wytg_tk", "ways_tags", "type, key"),
+    ("idx_rltg_tk", "relations_tags", "type, key"),
+]
+
+def set_pragmas(osmcu, pragmas):
+    """Sets SQLite pragmas, given as (name, value) pairs"""
+    for name, value in pragmas:
+        osmcu.execute("PRAGMA " + name + " = " + value + ";")
+
+def set_up_osm_db(create_schema, db_file="lyon.db", bulk_load=False):
+    """Set up the DB where we are going to import and analyze the OSM data. With bulk_load True
+the DB is set up for loading (see above), and it's up to finish_osm_db to build the indexes and
+put the safe settings back."""
     # osmconn = sqlite3.connect(":memory:") # lyon data is too big for memory
-    osmconn = sqlite3.connect("lyon.db")
+    osmconn = sqlite3.connect(db_file)
     osmconn.row_factory = sqlite3.Row
     osmcu = osmconn.cursor()
+    if bulk_load:
+        # the page size has to be set before the first table is created (on a DB that has tables
+        # already, this does nothing)
+        osmcu.execute("PRAGMA page_size = " + str(BULK_LOAD_PAGE_SIZE) + ";")
+        set_pragmas(osmcu, BULK_LOAD_PRAGMAS)
     if not create_schema:
         return osmconn, osmcu
     # We don't have a system in place to figure out data types from the CSV file, so we have to
@@ -325,39 +987,231 @@ def set_up_osm_db(create_schema):
                        FOREIGN KEY (id) REFERENCES ways(id),      \
                        FOREIGN KEY (node_id) REFERENCES nodes(id) \
                    );")
-    osmcu.execute("CREATE INDEX idx_nd_usr ON nodes (uid);")
-    osmconn.commit()
-    osmcu.execute("CREATE INDEX idx_wy_usr ON ways (uid);")
-    osmconn.commit()
+    osmcu.execute("CREATE TABLE relations (             \
+                       id INTEGER PRIMARY KEY NOT NULL, \
+                       user TEXT,                       \
+                       uid INTEGER,                     \
+                       version INTEGER,                 \
+                       changeset INTEGER,               \
+                       timestamp TEXT                   \
+                   );")
+    osmcu.execute("CREATE TABLE relations_tags (                 \
+                       id INTEGER NOT NULL,                      \
+                       key TEXT NOT NULL,                        \
+                       value TEXT NOT NULL,                      \
+                       type TEXT,                                \
+                       FOREIGN KEY (id) REFERENCES relations(id) \
+                   );")
+    osmcu.execute("CREATE TABLE relations_members (              \
+                       id INTEGER NOT NULL,                      \
+                       member_type TEXT NOT NULL,                \
+                       member_id INTEGER NOT NULL,               \
+                       role TEXT NOT NULL,                       \
+                       position INTEGER NOT NULL,                \
+                       FOREIGN KEY (id) REFERENCES relations(id) \
+                   );")
+    if not bulk_load:
+        osmcu.execute("CREATE INDEX idx_nd_usr ON nodes (uid);")
+        osmconn.commit()
+        osmcu.execute("CREATE INDEX idx_wy_usr ON ways (uid);")
+        osmconn.commit()
     return osmconn, osmcu
 
+def create_osm_indexes(osmconn, osmcu):
+    """Builds the secondary indexes (OSM_INDEXES) that aren't there yet"""
+    for idxname, tblname, columns in OSM_INDEXES:
+        started = time.perf_counter()
+        osmcu.execute("CREATE INDEX IF NOT EXISTS " + idxname + " ON " + tblname + " (" +
+                      columns + ");")
+        osmconn.commit()
+        print("Index", idxname, "on", tblname, "(" + columns + ") in",
+              round(time.perf_counter() - started, 2), "seconds")
+
+def finish_osm_db(osmconn, osmcu):
+    """Gets a freshly loaded DB ready for use: builds the secondary indexes (including the ones by
+element id, which the query functions fetch tags by and updates need), runs ANALYZE and puts the
+safe settings back (see the comment above set_up_osm_db)."""
+    create_osm_indexes(osmconn, osmcu)
+    ensure_update_indexes(osmconn, osmcu)
+    started = time.perf_counter()
+    osmcu.execute("ANALYZE;")
+    osmconn.commit()
+    print("ANALYZE in", round(time.perf_counter() - started, 2), "seconds")
+    set_pragmas(osmcu, SAFE_PRAGMAS)
+
 # This function is like sql_to_dataframe except it just gives us a single number back
 # useful if you're just selecting a count of something or the ID number for something.
 def sql_to_scalar(dbcu, sql):
-    """Return a single value from an SQL query"""
+    """Return a single value from an SQL query, or None if it returns no rows"""
     print(sql)
+    result = None
     for row in dbcu.execute(sql):
         for item in row:
             result = item
     return result
 
-def parse_csvs_into_sql(osmconn, osmcu):
-    """This function pulls all our generated CSV files into one SQL db"""
-    print("Parsing nodes.csv")
-    csv_to_database("nodes.csv", 'nodes', {}, osmcu)
-    osmconn.commit()
-    print("Parsing nodes_tags.csv")
-    csv_to_database("nodes_tags.csv", 'nodes_tags', {}, osmcu)
-    osmconn.commit()
-    print("Parsing ways.csv")
-    csv_to_database("ways.csv", 'ways', {}, osmcu)
-    osmconn.commit()
-    print("Parsing ways_tags.csv")
-    csv_to_database("ways_tags.csv", 'ways_tags', {}, osmcu)
-    osmconn.commit()
-    print("Parsing ways_nodes.csv")
-    csv_to_database("ways_nodes.csv", 'ways_nodes', {}, osmcu)
+def parse_csvs_into_sql(osmconn, osmcu, bulk=True, chunk_size=10000, sink=None,
+                        checkpoint_rows=None):
+    """This function pulls all our generated CSV files into one SQL db. If bulk is True we use the
+bulk import engine, otherwise we go row by row with csv_to_database. Either way we report the rows
+per second for each table, so the two can be compared. sink is what the files were written with,
+which tells us their names (nodes.csv.gz and so on, if they were compressed). With checkpoint_rows
+(and bulk), the load is checkpointed every that many rows and carries on from the last checkpoint
+(see stream_osm_into_sql_checkpointed)."""
+    if sink is None:
+        sink = csvsink.CsvSink()
+    if checkpoint_rows is not None:
+        if not bulk:
+            raise ValueError("only the bulk import engine does checkpoints")
+        create_checkpoint_table(osmconn, osmcu)
+    for tblname in OSM_TABLES:
+        csv_file = sink.filename(tblname + ".csv")
+        skip_rows = 0
+        checkpoint = None
+        if checkpoint_rows is not None:
+            previous = get_checkpoint(osmcu, "load_csv", csv_file)
+            if previous is not None:
+                if previous["done"]:
+                    print(csv_file, "is loaded already")
+                    continue
+                skip_rows = previous["position"]
+                print("Resuming", csv_file, "after row", skip_rows)
+
+            def checkpoint(rows, csv_file=csv_file):
+                """Commits the rows so far, with a checkpoint"""
+                save_checkpoint(osmcu, "load_csv", csv_file, rows)
+                osmconn.commit()
+        print("Parsing " + csv_file)
+        started = time.perf_counter()
+        if bulk:
+            rows = bulk_csv_to_database(csv_file, tblname, {}, osmcu, chunk_size, skip_rows,
+                                        checkpoint, checkpoint_rows)
+        else:
+            rows = csv_to_database(csv_file, tblname, {}, osmcu)
+        if checkpoint_rows is not None:
+            save_checkpoint(osmcu, "load_csv", csv_file, skip_rows + rows, done=True)
+        osmconn.commit()
+        prt_rows_per_sec(tblname, rows, time.perf_counter() - started)
+
+# SqlBatchWriter looks like a csv.writer to the parser, but instead of writing to a file, it
+# collects rows and inserts them into an SQL table with executemany. The INSERT is built once with
+# "?" placeholders, so SQLite only has to parse and prepare it once per table instead of once per
+# row, and we don't have to escape anything. With coerce True, the fields (strings, from the parser
+# or a CSV file) are converted to the types the columns were declared with before they go in, the
+# same way on every route into the DB: left to SQLite, the conversion of a latitude from text can
+# come out one bit different from Python's float().
+class SqlBatchWriter:
+    """Collects rows for one table and inserts them in batches with executemany."""
+    def __init__(self, dbcu, tblname, fieldnames, batch_size=10000, coerce=False):
+        self.dbcu = dbcu
+        self.tblname = tblname
+        self.sql = "INSERT INTO " + tblname + " (" + ", ".join(fieldnames) + ") VALUES (" + \
+                   ", ".join(["?"] * len(fieldnames)) + ");"
+        self.batch_size = batch_size
+        self.batch = []
+        self.rows = 0
+        # one conversion function per column that has one
+        self.coercions = []
+        if coerce:
+            types = table_column_types(dbcu, tblname)
+            for colnum, fieldname in enumerate(fieldnames):
+                coercion = COLUMN_COERCIONS.get(types.get(fieldname, ""))
+                if coercion is not None:
+                    self.coercions.append((colnum, coercion))
+
+    def writerow(self, row):
+        """Queue up one row, and insert the batch if it's full"""
+        if self.coercions:
+            row = list(row)
+            for colnum, coercion in self.coercions:
+                row[colnum] = coercion(row[colnum])
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert whatever rows we have queued up"""
+        if self.batch:
+            self.dbcu.executemany(self.sql, self.batch)
+            self.rows = self.rows + len(self.batch)
+            self.batch = []
+
+class NodeLocationWriter:
+    """Takes the rows meant for the nodes table and puts the node locations into a node store (see
+nodestore.py), so the locations are on hand for the ways without reading the nodes back."""
+    def __init__(self, store):
+        self.store = store
+
+    def writerow(self, row):
+        """Store the location of the node in the row"""
+        self.store.set(int(row[0]), row[1], row[2])
+
+class TeeWriter:
+    """Passes every row on to several writers, so we can for example fill the DB and write the CSV
+files in the same pass."""
+    def __init__(self, writers):
+        self.writers = writers
+
+    def writerow(self, row):
+        """Hand the row to each of our writers"""
+        for writer in self.writers:
+            writer.writerow(row)
+
+def add_node_store_writer(writers, node_store):
+    """Makes the nodes writer fill the node store as well, if we have one"""
+    if node_store is not None:
+        writers["nodes"] = TeeWriter([writers["nodes"], NodeLocationWriter(node_store)])
+
+def add_columnar_writers(writers, columnar):
+    """Makes every writer fill its Parquet file as well, if we're exporting them (see
+osmcolumnar.py)"""
+    if columnar is not None:
+        for tblname in OSM_TABLES:
+            writers[tblname] = TeeWriter([writers[tblname], columnar.writers[tblname]])
+
+def open_columnar_export(directory, rows_per_group=osmcolumnar.DEFAULT_ROWS_PER_GROUP):
+    """Starts a Parquet export of all our tables into a directory (see osmcolumnar.py)"""
+    return osmcolumnar.ColumnarExport(directory, OSM_COLUMNS, rows_per_group)
+
+def finish_node_store(node_store):
+    """Gets the node store ready for lookups once parsing is done, and reports its size"""
+    if node_store is not None:
+        node_store.finish()
+        nodestore.prt_footprint(node_store)
+
+def stream_osm_into_sql(osmconn, osmcu, filename="lyon.osm", csv_side_output=False,
+                        batch_size=10000, node_store=None, rules=None, sink=None, columnar=None,
+                        fast=False):
+    """Parses the OpenStreetMap XML straight into the SQL DB, without the round trip through the CSV
+files. If csv_side_output is True, we write the CSV files as well (through sink, see csvsink.py),
+in the same pass. If node_store is given (see nodestore.py), we fill it with the node locations
+while we're at it, and if columnar is given (see open_columnar_export), the Parquet files. fast
+picks the fast XML parser."""
+    sql_writers = {}
+    writers = {}
+    for tblname in OSM_TABLES:
+        sql_writers[tblname] = SqlBatchWriter(osmcu, tblname, OSM_COLUMNS[tblname], batch_size,
+                                              coerce=True)
+        writers[tblname] = sql_writers[tblname]
+    files = []
+    if csv_side_output:
+        files, csv_writers = open_csv_writers(sink=sink)
+        for tblname in OSM_TABLES:
+            writers[tblname] = TeeWriter([sql_writers[tblname], csv_writers[tblname]])
+    add_node_store_writer(writers, node_store)
+    add_columnar_writers(writers, columnar)
+    tallies = parse_into_writers(filename, writers, rules, fast)
+    print("Done with parsing.")
+    finish_node_store(node_store)
+    if columnar is not None:
+        columnar.close()
+    for tblname in OSM_TABLES:
+        sql_writers[tblname].flush()
+        print("Inserted", sql_writers[tblname].rows, "rows into", tblname)
     osmconn.commit()
+    for csvfile in files:
+        csvfile.close()
+    prt_tallies(tallies)
 
 def sql_to_list_of_lists(dbcu, sql):
     """Takes an SQL query that returns two colums and turns into Python dict where the first column
@@ -373,13 +1227,55 @@ is the key and the second column is the value."""
         result.append(rvals)
     return result
 
-def apply_corrections_to_sql_db(osmconn, osmcu):
-    """Here we apply any data corrections that we do AFTER the parsing (most corrections are done
-while parsing the XML, but we can make corrections here as well.)"""
-    sql = "DELETE FROM ways_tags WHERE (id = 44895025) AND (type = 'addr') AND (key = 'street');"
-    print(sql)
-    osmcu.execute(sql)
+def apply_corrections_to_sql_db(osmconn, osmcu, rules=None):
+    """Here we apply the correction rules (by default, corrections.csv) to tags that are already in
+the DB, for when they weren't corrected while parsing. Rather than fetching and updating the tags
+one at a time, for each tags table we mark the tags that have a rule that applies in one SELECT,
+then fix them all with one UPDATE and one DELETE. The rules themselves are run by SQLite calling
+back into CorrectionRules, so they work exactly the way they do while parsing."""
+    if rules is None:
+        rules = default_correction_rules()
+    if not rules.rules:
+        return
+    counts = [0] * len(rules.rules)
+    osmconn.create_function("osm_correction_rule", 4, rules.find_rule, deterministic=True)
+    osmconn.create_function("osm_apply_rule", 2, rules.apply_rule, deterministic=True)
+    # we only need to look at the tags with a key that has rules
+    conditions = []
+    params = []
+    for k in sorted(rules.keys):
+        key, k_type = split_into_key_and_type(k)
+        conditions.append("((type = ?) AND (key = ?))")
+        params.extend([k_type, key])
+    for element, tags_table in [("node", "nodes_tags"), ("way", "ways_tags"),
+                                ("relation", "relations_tags")]:
+        osmcu.execute("DROP TABLE IF EXISTS temp.pending_corrections;")
+        osmcu.execute("CREATE TEMP TABLE pending_corrections (                \
+                           tag_rowid INTEGER PRIMARY KEY,                     \
+                           rule INTEGER NOT NULL,                             \
+                           value TEXT                                         \
+                       );")
+        osmcu.execute("INSERT INTO pending_corrections                                          \
+                       SELECT tag_rowid, rule, value FROM (                                     \
+                           SELECT rowid AS tag_rowid, value,                                    \
+                               osm_correction_rule('" + element + "', CAST(id AS TEXT),         \
+                                   CASE type WHEN 'regular' THEN key ELSE type || ':' || key END, \
+                                   value) AS rule                                               \
+                           FROM " + tags_table + " WHERE " + " OR ".join(conditions) + "        \
+                       ) WHERE rule >= 0;", params)
+        for row in osmcu.execute("SELECT rule, COUNT(*) FROM pending_corrections GROUP BY rule;"
+                                ).fetchall():
+            counts[row[0]] = counts[row[0]] + row[1]
+        osmcu.execute("DELETE FROM " + tags_table + " WHERE rowid IN (                        \
+                           SELECT tag_rowid FROM pending_corrections                          \
+                           WHERE osm_apply_rule(rule, value) IS NULL);")
+        osmcu.execute("UPDATE " + tags_table + " SET value = (                                  \
+                           SELECT osm_apply_rule(rule, value) FROM pending_corrections          \
+                           WHERE tag_rowid = " + tags_table + ".rowid)                          \
+                       WHERE rowid IN (SELECT tag_rowid FROM pending_corrections);")
+        osmcu.execute("DROP TABLE temp.pending_corrections;")
     osmconn.commit()
+    prt_correction_counts([[rules.describe(rulenum), num] for rulenum, num in enumerate(counts)])
 
 def prt_list_top(lst, top_num):
     """Print the top entries in a list of lists (such as returned by sql_to_list_of_lists)
@@ -406,50 +1302,394 @@ def prt_list_w_commas(lst):
         outstr = outstr[2:]
         print(outstr)
 
+# ----------------------------------------------------------------
+# checkpointed imports
+#
+# Loading a big extract takes hours, and if it dies halfway through we don't want to start over. A
+# checkpointed import reads the OSM file in segments of about checkpoint_bytes, each starting on a
+# top-level element (found the same way the parallel parser finds them), and at the end of each
+# segment it commits the segment's rows together with a checkpoint: how far into the file we've
+# got, the last element written and the tallies so far. Since the rows and the checkpoint go in in
+# the same transaction, after a crash the DB holds exactly the rows up to the last checkpoint, and a
+# restart carries on from there. Loading the CSV files works the same way (see parse_csvs_into_sql),
+# with the checkpoint counting rows instead of bytes; writing the CSV files in the first place only
+# gets a checkpoint when it's done, so a crash partway through that step starts it over. The
+# checkpoints live in the import_checkpoints table, one per step and file (by absolute path), with
+# the size and modification time of the file, so we never resume from a file that has changed
+# since.
+
+DEFAULT_CHECKPOINT_BYTES = 64 << 20
+DEFAULT_CHECKPOINT_ROWS = 1000000
+
+def create_checkpoint_table(osmconn, osmcu):
+    """Creates the import_checkpoints table, if it isn't there yet"""
+    osmcu.execute("CREATE TABLE IF NOT EXISTS import_checkpoints ( \
+                       step TEXT NOT NULL,                         \
+                       source TEXT NOT NULL,                       \
+                       size INTEGER,                               \
+                       mtime_ns INTEGER,                           \
+                       position INTEGER NOT NULL,                  \
+                       last_element TEXT,                          \
+                       tallies TEXT,                               \
+                       done INTEGER NOT NULL,                      \
+                       PRIMARY KEY (step, source)                  \
+                   );")
+    # a crash in the middle of a segment has to leave the DB as it was at the last checkpoint,
+    # which takes a rollback journal on disk (the bulk-load settings keep it in memory)
+    if osmcu.execute("PRAGMA journal_mode;").fetchone()[0].lower() in ["memory", "off"]:
+        osmcu.execute("PRAGMA journal_mode = DELETE;")
+    osmconn.commit()
+
+def has_checkpoints(db_file):
+    """Tells whether a DB was loaded (or was being loaded) by a checkpointed import"""
+    conn = sqlite3.connect(db_file)
+    try:
+        sql = "SELECT COUNT(*) FROM sqlite_master WHERE (type = 'table') AND \
+               (name = 'import_checkpoints');"
+        return conn.execute(sql).fetchone()[0] > 0
+    finally:
+        conn.close()
+
+def file_identity(filename):
+    """The size and modification time of a file, to tell whether it has changed"""
+    info = os.stat(filename)
+    return info.st_size, info.st_mtime_ns
+
+def get_checkpoint(osmcu, step, source):
+    """Returns the checkpoint of one step of an import (e.g. "stream" for stream_osm_into_sql) on
+one file as a dictionary, or None if there isn't one. Raises ValueError if the file has changed
+since the checkpoint. Files go by their absolute path, so it doesn't matter which directory the
+import is resumed from."""
+    source = os.path.abspath(source)
+    row = osmcu.execute("SELECT size, mtime_ns, position, last_element, tallies, done    \
+                         FROM import_checkpoints WHERE (step = ?) AND (source = ?);",
+                        (step, source)).fetchone()
+    if row is None:
+        return None
+    if (row[0], row[1]) != file_identity(source):
+        raise ValueError(source + " has changed since the last checkpoint, so the import can't " +
+                         "be resumed; start it over")
+    tallies = None
+    if row[4] is not None:
+        tallies = json.loads(row[4])
+    return {"position": row[2], "last_element": row[3], "tallies": tallies, "done": bool(row[5])}
+
+def save_checkpoint(osmcu, step, source, position, last_element=None, tallies=None, done=False):
+    """Records how far one step of an import has got. The caller commits it, along with the rows
+it covers."""
+    source = os.path.abspath(source)
+    size, mtime_ns = file_identity(source)
+    if tallies is not None:
+        tallies = json.dumps(tallies)
+    osmcu.execute("INSERT OR REPLACE INTO import_checkpoints                             \
+                       (step, source, size, mtime_ns, position, last_element, tallies, done) \
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                  (step, source, size, mtime_ns, position, last_element, tallies, int(done)))
+
+class ProgressWriter:
+    """Passes the rows for the nodes, ways or relations on to another writer, noting the last
+element written in progress (a dictionary shared by the three), for the checkpoints."""
+    def __init__(self, writer, element, progress):
+        self.writer = writer
+        self.element = element
+        self.progress = progress
+
+    def writerow(self, row):
+        """Note the element and hand the row on"""
+        self.progress["last_element"] = self.element + " " + str(row[0])
+        self.writer.writerow(row)
+
+def stream_osm_into_sql_checkpointed(osmconn, osmcu, filename="lyon.osm",
+                                     checkpoint_bytes=DEFAULT_CHECKPOINT_BYTES, batch_size=10000,
+                                     rules=None, fast=False):
+    """Like stream_osm_into_sql (without the side outputs), but checkpointed (see above): if this
+file has a checkpoint in the DB, we carry on from there, and if it has been loaded already,
+there's nothing to do. This only works on XML files; a PBF file can't be cut up by bytes."""
+    if filename.endswith(".pbf"):
+        raise ValueError("checkpointed imports only work on XML files, not " + filename)
+    if rules is None:
+        rules = default_correction_rules()
+    create_checkpoint_table(osmconn, osmcu)
+    checkpoint = get_checkpoint(osmcu, "stream", filename)
+    start = 0
+    all_tallies = []
+    progress = {"last_element": None}
+    if checkpoint is not None:
+        if checkpoint["done"]:
+            print(filename, "is loaded already")
+            return
+        start = checkpoint["position"]
+        all_tallies.append(checkpoint["tallies"])
+        progress["last_element"] = checkpoint["last_element"]
+        print("Resuming", filename, "at byte", start, "after", progress["last_element"])
+    sql_writers = {}
+    writers = {}
+    for tblname in OSM_TABLES:
+        sql_writers[tblname] = SqlBatchWriter(osmcu, tblname, OSM_COLUMNS[tblname], batch_size,
+                                              coerce=True)
+        writers[tblname] = sql_writers[tblname]
+    for tblname, element in [("nodes", "node"), ("ways", "way"), ("relations", "relation")]:
+        writers[tblname] = ProgressWriter(sql_writers[tblname], element, progress)
+    parse_events = parse_osm_events_into_writers
+    if fast:
+        parse_events = parse_osm_fast_events_into_writers
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as osmfile:
+        while start < size:
+            end = None
+            if start + checkpoint_bytes < size:
+                end = find_element_start(osmfile, start + checkpoint_bytes)
+            if end is None:
+                end = size
+            all_tallies.append(parse_events(shard_events(filename, start, end, end == size),
+                                            writers, start > 0, rules))
+            for tblname in OSM_TABLES:
+                sql_writers[tblname].flush()
+            all_tallies = [merge_tallies(all_tallies)]
+            save_checkpoint(osmcu, "stream", filename, end, progress["last_element"],
+                            all_tallies[0], end == size)
+            osmconn.commit()
+            print("Checkpoint at byte", end, "of", size, "after", progress["last_element"])
+            start = end
+    print("Done with parsing.")
+    for tblname in OSM_TABLES:
+        print("Inserted", sql_writers[tblname].rows, "rows into", tblname)
+    prt_tallies(all_tallies[0])
+
+# ----------------------------------------------------------------
+# the summary tables behind analyze_osm_sql
+#
+# Counting and grouping the whole DB for every report takes more than 20 full table scans. Instead
+# we work out the numbers once, with a single scan of each table, and keep them in three summary
+# tables:
+#   osm_stats         row counts and the bounding box of the nodes, by name
+#   osm_tag_counts    how many times each (type, key, value) occurs in each tags table
+#   osm_user_counts   how many nodes, ways and relations each uid has
+# Triggers keep them up to date as the data changes (updates from change files, corrections after
+# loading). The one thing a trigger can't cheaply do is move the bounding box inwards when the node
+# on its edge is deleted, so then we just mark it stale and rescan the nodes next time it's asked
+# for.
+
+def has_osm_stats(osmcu):
+    """Tells whether build_osm_stats has been run on this DB"""
+    sql = "SELECT COUNT(*) FROM sqlite_master WHERE (type = 'table') AND (name = 'osm_stats');"
+    return osmcu.execute(sql).fetchone()[0] > 0
+
+def osm_stats_triggers():
+    """Returns the SQL for the triggers that keep the summary tables up to date"""
+    triggers = []
+    # nodes: the count, the users, and the bounding box
+    bounds_grow = ""
+    bounds_edge = []
+    for column in ["lat", "lon"]:
+        bounds_grow = bounds_grow + \
+            "UPDATE osm_stats SET value = COALESCE(MIN(value, NEW." + column + "), NEW." + \
+            column + ") WHERE (name = 'min_" + column + "') AND (NEW." + column + \
+            " IS NOT NULL); " + \
+            "UPDATE osm_stats SET value = COALESCE(MAX(value, NEW." + column + "), NEW." + \
+            column + ") WHERE (name = 'max_" + column + "') AND (NEW." + column + \
+            " IS NOT NULL); "
+        bounds_edge.append("(OLD." + column + " <= (SELECT value FROM osm_stats WHERE name = 'min_" +
+                           column + "'))")
+        bounds_edge.append("(OLD." + column + " >= (SELECT value FROM osm_stats WHERE name = 'max_" +
+                           column + "'))")
+    user_add = "INSERT OR IGNORE INTO osm_user_counts (uid, count) VALUES (NEW.uid, 0); " + \
+               "UPDATE osm_user_counts SET count = count + 1 WHERE uid IS NEW.uid; "
+    user_remove = "UPDATE osm_user_counts SET count = count - 1 WHERE uid IS OLD.uid; " + \
+                  "DELETE FROM osm_user_counts WHERE (uid IS OLD.uid) AND (count <= 0); "
+    for tblname, extra_add, extra_remove in [
+            ("nodes", bounds_grow, "UPDATE osm_stats SET value = 1 WHERE (name = 'bounds_stale') " +
+             "AND (" + " OR ".join(bounds_edge) + "); "),
+            ("ways", "", ""),
+            ("relations", "", "")]:
+        triggers.append("CREATE TRIGGER osm_stats_" + tblname + "_insert AFTER INSERT ON " +
+                        tblname + " BEGIN UPDATE osm_stats SET value = value + 1 " +
+                        "WHERE name = 'num_" + tblname + "'; " + user_add + extra_add + "END;")
+        triggers.append("CREATE TRIGGER osm_stats_" + tblname + "_delete AFTER DELETE ON " +
+                        tblname + " BEGIN UPDATE osm_stats SET value = value - 1 " +
+                        "WHERE name = 'num_" + tblname + "'; " + user_remove + extra_remove +
+                        "END;")
+        triggers.append("CREATE TRIGGER osm_stats_" + tblname + "_update AFTER UPDATE ON " +
+                        tblname + " BEGIN " + user_remove + extra_remove + user_add + extra_add +
+                        "END;")
+    # tags: the count per (type, key, value)
+    for tblname in ["nodes_tags", "ways_tags", "relations_tags"]:
+        tag_add = "INSERT OR IGNORE INTO osm_tag_counts (tbl, type, key, value, count) " + \
+                  "VALUES ('" + tblname + "', NEW.type, NEW.key, NEW.value, 0); " + \
+                  "UPDATE osm_tag_counts SET count = count + 1 WHERE (tbl = '" + tblname + "') " + \
+                  "AND (type IS NEW.type) AND (key IS NEW.key) AND (value IS NEW.value); "
+        tag_remove = "UPDATE osm_tag_counts SET count = count - 1 WHERE (tbl = '" + tblname + \
+                     "') AND (type IS OLD.type) AND (key IS OLD.key) AND (value IS OLD.value); " + \
+                     "DELETE FROM osm_tag_counts WHERE (tbl = '" + tblname + "') " + \
+                     "AND (type IS OLD.type) AND (key IS OLD.key) AND (value IS OLD.value) " + \
+                     "AND (count <= 0); "
+        triggers.append("CREATE TRIGGER osm_stats_" + tblname + "_insert AFTER INSERT ON " +
+                        tblname + " BEGIN UPDATE osm_stats SET value = value + 1 " +
+                        "WHERE name = 'num_" + tblname + "'; " + tag_add + "END;")
+        triggers.append("CREATE TRIGGER osm_stats_" + tblname + "_delete AFTER DELETE ON " +
+                        tblname + " BEGIN UPDATE osm_stats SET value = value - 1 " +
+                        "WHERE name = 'num_" + tblname + "'; " + tag_remove + "END;")
+        triggers.append("CREATE TRIGGER osm_stats_" + tblname + "_update AFTER UPDATE ON " +
+                        tblname + " BEGIN " + tag_remove + tag_add + "END;")
+    # ways_nodes and relations_members: just the count
+    for tblname in ["ways_nodes", "relations_members"]:
+        triggers.append("CREATE TRIGGER osm_stats_" + tblname + "_insert AFTER INSERT ON " +
+                        tblname + " BEGIN UPDATE osm_stats SET value = value + 1 " +
+                        "WHERE name = 'num_" + tblname + "'; END;")
+        triggers.append("CREATE TRIGGER osm_stats_" + tblname + "_delete AFTER DELETE ON " +
+                        tblname + " BEGIN UPDATE osm_stats SET value = value - 1 " +
+                        "WHERE name = 'num_" + tblname + "'; END;")
+    return triggers
+
+def drop_osm_stats(osmcu):
+    """Drops the summary tables and their triggers"""
+    for row in osmcu.execute("SELECT name FROM sqlite_master WHERE (type = 'trigger') \
+                              AND (name LIKE 'osm_stats_%');").fetchall():
+        osmcu.execute("DROP TRIGGER " + row[0] + ";")
+    osmcu.execute("DROP TABLE IF EXISTS osm_stats;")
+    osmcu.execute("DROP TABLE IF EXISTS osm_tag_counts;")
+    osmcu.execute("DROP TABLE IF EXISTS osm_user_counts;")
+
+def refresh_bounds(osmcu):
+    """Recomputes the bounding box of the nodes with one scan"""
+    row = osmcu.execute("SELECT MIN(lat), MAX(lat), MIN(lon), MAX(lon) FROM nodes;").fetchone()
+    for name, value in zip(["min_lat", "max_lat", "min_lon", "max_lon"], row):
+        osmcu.execute("UPDATE osm_stats SET value = ? WHERE name = ?;", (value, name))
+    osmcu.execute("UPDATE osm_stats SET value = 0 WHERE name = 'bounds_stale';")
+
+def build_osm_stats(osmconn, osmcu):
+    """(Re)builds the summary tables with one scan of each table, and sets up the triggers that
+keep them up to date from then on."""
+    drop_osm_stats(osmcu)
+    osmcu.execute("CREATE TABLE osm_stats (name TEXT PRIMARY KEY NOT NULL, value);")
+    osmcu.execute("CREATE TABLE osm_tag_counts (                          \
+                       tbl TEXT NOT NULL,                                 \
+                       type TEXT,                                         \
+                       key TEXT,                                          \
+                       value TEXT,                                        \
+                       count INTEGER NOT NULL,                            \
+                       PRIMARY KEY (tbl, type, key, value)                \
+                   );")
+    osmcu.execute("CREATE TABLE osm_user_counts (uid PRIMARY KEY, count INTEGER NOT NULL);")
+    stats = {}
+    # nodes: one scan gets the users, the count and the bounding box
+    users = {}
+    bounds = [None, None, None, None]
+    for row in osmcu.execute("SELECT uid, COUNT(*), MIN(lat), MAX(lat), MIN(lon), MAX(lon) \
+                              FROM nodes GROUP BY uid;").fetchall():
+        users[row[0]] = row[1]
+        for idx, pick in [(0, min), (1, max), (2, min), (3, max)]:
+            if row[idx + 2] is not None:
+                if bounds[idx] is None:
+                    bounds[idx] = row[idx + 2]
+                else:
+                    bounds[idx] = pick(bounds[idx], row[idx + 2])
+    stats["num_nodes"] = sum(users.values())
+    stats["min_lat"], stats["max_lat"], stats["min_lon"], stats["max_lon"] = bounds
+    stats["bounds_stale"] = 0
+    # ways and relations: the users and the count
+    for tblname in ["ways", "relations"]:
+        stats["num_" + tblname] = 0
+        for row in osmcu.execute("SELECT uid, COUNT(*) FROM " + tblname + " GROUP BY uid;"
+                                ).fetchall():
+            users[row[0]] = users.get(row[0], 0) + row[1]
+            stats["num_" + tblname] = stats["num_" + tblname] + row[1]
+    osmcu.executemany("INSERT INTO osm_user_counts (uid, count) VALUES (?, ?);", users.items())
+    # tags: the count per (type, key, value)
+    for tblname in ["nodes_tags", "ways_tags", "relations_tags"]:
+        osmcu.execute("INSERT INTO osm_tag_counts (tbl, type, key, value, count)            \
+                       SELECT '" + tblname + "', type, key, value, COUNT(*) FROM " + tblname +
+                      " GROUP BY type, key, value;")
+        stats["num_" + tblname] = osmcu.execute("SELECT COALESCE(SUM(count), 0) FROM osm_tag_counts \
+                                                 WHERE tbl = ?;", (tblname,)).fetchone()[0]
+    for tblname in ["ways_nodes", "relations_members"]:
+        stats["num_" + tblname] = osmcu.execute("SELECT COUNT(*) FROM " + tblname + ";").fetchone()[0]
+    osmcu.executemany("INSERT INTO osm_stats (name, value) VALUES (?, ?);", stats.items())
+    for trigger in osm_stats_triggers():
+        osmcu.execute(trigger)
+    osmconn.commit()
+
+def osm_stat(osmcu, name):
+    """Returns one number from the osm_stats table"""
+    return sql_to_scalar(osmcu, "SELECT value FROM osm_stats WHERE name = '" + name + "';")
+
 def count_tags_for_key(osmcu, tag_type, tag_key, human_name):
     """Here we find the top 10 tag values for a specific tag key and output them for the user."""
-    sql = "SELECT value, COUNT(*)                                          \
-           FROM nodes_tags                                                 \
-           WHERE (type = '" + tag_type + "') AND (key = '" + tag_key + "') \
-           GROUP BY value ORDER BY COUNT(*) DESC;"
+    sql = "SELECT value, count                                                           \
+           FROM osm_tag_counts                                                           \
+           WHERE (tbl = 'nodes_tags') AND (type = '" + tag_type + "') AND (key = '" + tag_key + "') \
+           ORDER BY count DESC, value LIMIT 10;"
     stuff = sql_to_list_of_lists(osmcu, sql)
     print("Top 10 " + human_name + " nodes with number of occurrences:")
     prt_list_top(stuff, 10)
-    sql = "SELECT value, COUNT(*)                                          \
-           FROM ways_tags                                                  \
-           WHERE (type = '" + tag_type + "') AND (key = '" + tag_key + "') \
-           GROUP BY value ORDER BY COUNT(*) DESC;"
+    sql = "SELECT value, count                                                           \
+           FROM osm_tag_counts                                                           \
+           WHERE (tbl = 'ways_tags') AND (type = '" + tag_type + "') AND (key = '" + tag_key + "') \
+           ORDER BY count DESC, value LIMIT 10;"
     stuff = sql_to_list_of_lists(osmcu, sql)
     print("Top 10 " + human_name + " ways with number of occurrences:")
     prt_list_top(stuff, 10)
 
+def top_tag_values(osmcu, tags_table, tag_type, tag_key, top=10):
+    """The most common values of a tag key in one tags table, as a list of [value, count], most
+common first, from the summary tables (like count_tags_for_key, but without printing anything)."""
+    sql = "SELECT value, count FROM osm_tag_counts                                     \
+           WHERE (tbl = ?) AND (type = ?) AND (key = ?) ORDER BY count DESC, value LIMIT ?;"
+    return [[row[0], row[1]] for row in osmcu.execute(sql, (tags_table, tag_type, tag_key, top))]
+
+def way_coordinates(osmcu, way_id):
+    """The coordinates of a way as a list of [lat, lon], from way_geometry if it has been built"""
+    if has_way_geometries(osmcu):
+        coords = get_way_geometry(osmcu, way_id)
+        if coords is None:
+            return []
+        return [list(point) for point in coords]
+    sql = "SELECT nodes.lat, nodes.lon FROM ways_nodes, nodes WHERE (ways_nodes.id = " + str(way_id) + ") AND (ways_nodes.node_id = nodes.id) ORDER BY ways_nodes.position;"
+    return sql_to_list_of_lists(osmcu, sql)
+
 def analyze_osm_sql(osmcu):
-    """Here we assume all corrections are done and we're ready to analyze the data!"""
-    num_nodes = sql_to_scalar(osmcu, "SELECT COUNT(*) FROM nodes WHERE 1;")
+    """Here we assume all corrections are done and we're ready to analyze the data! The numbers come
+from the summary tables, which we build first if they aren't there yet."""
+    if not has_osm_stats(osmcu):
+        build_osm_stats(osmcu.connection, osmcu)
+    if osm_stat(osmcu, "bounds_stale"):
+        refresh_bounds(osmcu)
+        osmcu.connection.commit()
+
+    num_nodes = osm_stat(osmcu, "num_nodes")
     print("Number of nodes:", num_nodes)
 
-    num_ways = sql_to_scalar(osmcu, "SELECT COUNT(*) FROM ways WHERE 1;")
+    num_ways = osm_stat(osmcu, "num_ways")
     print("Number of ways:", num_ways)
 
-    num_nodes_tags = sql_to_scalar(osmcu, "SELECT COUNT(*) FROM nodes_tags WHERE 1;")
+    num_nodes_tags = osm_stat(osmcu, "num_nodes_tags")
     print("Number of node tags:", num_nodes_tags)
 
-    num_ways_tags = sql_to_scalar(osmcu, "SELECT COUNT(*) FROM ways_tags WHERE 1;")
+    num_ways_tags = osm_stat(osmcu, "num_ways_tags")
     print("Number of ways tags:", num_ways_tags)
 
-    num_ways_nodes = sql_to_scalar(osmcu, "SELECT COUNT(*) FROM ways_nodes WHERE 1;")
+    num_ways_nodes = osm_stat(osmcu, "num_ways_nodes")
     print("Number of ways nodes:", num_ways_nodes)
 
-    min_lat = sql_to_scalar(osmcu, "SELECT MIN(lat) FROM nodes WHERE 1;")
+    num_relations = osm_stat(osmcu, "num_relations")
+    print("Number of relations:", num_relations)
+
+    num_relations_tags = osm_stat(osmcu, "num_relations_tags")
+    print("Number of relations tags:", num_relations_tags)
+
+    num_relations_members = osm_stat(osmcu, "num_relations_members")
+    print("Number of relations members:", num_relations_members)
+
+    min_lat = osm_stat(osmcu, "min_lat")
     print("Minimum latitude:", min_lat)
 
-    max_lat = sql_to_scalar(osmcu, "SELECT MAX(lat) FROM nodes WHERE 1;")
+    max_lat = osm_stat(osmcu, "max_lat")
     print("Maximum latitude:", max_lat)
 
-    min_lon = sql_to_scalar(osmcu, "SELECT MIN(lon) FROM nodes WHERE 1;")
+    min_lon = osm_stat(osmcu, "min_lon")
     print("Minimum longitude:", min_lon)
 
-    max_lon = sql_to_scalar(osmcu, "SELECT MAX(lon) FROM nodes WHERE 1;")
+    max_lon = osm_stat(osmcu, "max_lon")
     print("Maximum longitude:", max_lon)
 
     # this is the full outer join attempt that did not work
@@ -459,12 +1699,7 @@ def analyze_osm_sql(osmcu):
     #          WHERE 1;")
     # print("Number of unique users:", num_unique_users)
 
-    num_unique_users = sql_to_scalar(osmcu, "SELECT COUNT(*) FROM ( \
-            SELECT uid FROM nodes                                   \
-            UNION                                                   \
-            SELECT uid FROM ways                                    \
-        ) sub                                                       \
-        WHERE 1;")
+    num_unique_users = sql_to_scalar(osmcu, "SELECT COUNT(*) FROM osm_user_counts WHERE 1;")
     print("Number of unique users:", num_unique_users)
 
     count_tags_for_key(osmcu, "regular", "amenity", "amenities")
@@ -476,27 +1711,1064 @@ def analyze_osm_sql(osmcu):
     count_tags_for_key(osmcu, "regular", "surface", "surfaces")
 
     castle_wall_way_id = sql_to_scalar(osmcu, "SELECT id FROM ways_tags WHERE (type = 'regular') AND (key = 'wall') AND (value = 'castle_wall');")
-    sql = "SELECT nodes.lat, nodes.lon FROM ways_nodes, nodes WHERE (ways_nodes.id = " + str(castle_wall_way_id) + ") AND (ways_nodes.node_id = nodes.id) ORDER BY ways_nodes.position;"
-    castle_wall_coordinates = sql_to_list_of_lists(osmcu, sql)
-    print("Here's the latitude and longitude coordinates for the castle wall:")
-    prt_list_w_commas(castle_wall_coordinates)
+    # the castle wall and the tunnel are in Lyon; other regions don't have them
+    if castle_wall_way_id is not None:
+        castle_wall_coordinates = way_coordinates(osmcu, castle_wall_way_id)
+        print("Here's the latitude and longitude coordinates for the castle wall:")
+        prt_list_w_commas(castle_wall_coordinates)
 
-    sql = "SELECT nodes.lat, nodes.lon FROM ways_nodes, nodes WHERE (ways_nodes.id = 442928017) AND (ways_nodes.node_id = nodes.id) ORDER BY ways_nodes.position;"
-    tunnel_coordinates = sql_to_list_of_lists(osmcu, sql)
-    print("Here's the latitude and longitude coordinates for the tunnel (hand-picked):")
-    prt_list_w_commas(tunnel_coordinates)
+    tunnel_coordinates = way_coordinates(osmcu, 442928017)
+    if tunnel_coordinates:
+        print("Here's the latitude and longitude coordinates for the tunnel (hand-picked):")
+        prt_list_w_commas(tunnel_coordinates)
 
 # ----------------------------------------------------------------
+# third section: keeping the DB up to date with OSM change files (.osc)
+#
+# An osmChange file lists the nodes, ways and relations that were created, modified or deleted, each with
+# its new version number. Instead of rebuilding the whole DB we apply just those changes. An edit
+# is stale (and skipped) if the DB already has that version of the element or a newer one.
+
+# for each element type: its table, its child tables, and the columns the change file fills in
+OSC_ELEMENT_TABLES = {
+    "node": ("nodes", ["nodes_tags"]),
+    "way": ("ways", ["ways_tags", "ways_nodes"]),
+    "relation": ("relations", ["relations_tags", "relations_members"]),
+}
+
+def ensure_update_indexes(osmconn, osmcu):
+    """Updates look up tags, way nodes and relation members by element id, so those lookups need
+indexes, otherwise each change would be a full table scan. This only has to build them the first
+time."""
+    osmcu.execute("CREATE INDEX IF NOT EXISTS idx_ndtg_id ON nodes_tags (id);")
+    osmcu.execute("CREATE INDEX IF NOT EXISTS idx_wytg_id ON ways_tags (id);")
+    osmcu.execute("CREATE INDEX IF NOT EXISTS idx_wynd_id ON ways_nodes (id);")
+    # and to keep the spatial index up to date we need to find the ways a moved node is in
+    osmcu.execute("CREATE INDEX IF NOT EXISTS idx_wynd_nd ON ways_nodes (node_id);")
+    osmcu.execute("CREATE INDEX IF NOT EXISTS idx_rltg_id ON relations_tags (id);")
+    osmcu.execute("CREATE INDEX IF NOT EXISTS idx_rlmb_id ON relations_members (id);")
+    # and to keep the multipolygons up to date, the relations a changed way is in
+    osmcu.execute("CREATE INDEX IF NOT EXISTS idx_rlmb_mbr ON relations_members (member_type, \
+                   member_id);")
+    osmconn.commit()
+
+def osm_element_version(osmcu, elem_type, elem_id):
+    """Returns the version of a node, way or relation that's in the DB, or None if it isn't
+there."""
+    tblname = OSC_ELEMENT_TABLES[elem_type][0]
+    # ways.version is a TEXT column, so we compare versions as numbers
+    for row in osmcu.execute("SELECT CAST(version AS INTEGER) FROM " + tblname + " WHERE id = ?;",
+                             (elem_id,)):
+        return row[0]
+    return None
+
+def delete_osm_element(osmcu, elem_type, elem_id):
+    """Deletes a node, way or relation, with its tags (and for a way, its list of nodes, for a
+relation, its members), from the DB."""
+    tblname, child_tables = OSC_ELEMENT_TABLES[elem_type]
+    for child_table in child_tables:
+        osmcu.execute("DELETE FROM " + child_table + " WHERE id = ?;", (elem_id,))
+    osmcu.execute("DELETE FROM " + tblname + " WHERE id = ?;", (elem_id,))
+
+def insert_osm_element(osmcu, elem, rules, correction_counts):
+    """Inserts a node, way or relation from the change file into the DB, with its tags (corrected
+by rules), way nodes and relation members, the same way the parser would have."""
+    attributes = elem.attrib
+    elem_id = int(attributes["id"])
+    if elem.tag == "node":
+        osmcu.execute("INSERT INTO nodes (id, lat, lon, user, uid, version, changeset, timestamp) \
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                      (elem_id, coerce_float(attributes["lat"]), coerce_float(attributes["lon"]),
+                       attributes.get("user", ""), attributes.get("uid", ""),
+                       attributes["version"], attributes.get("changeset", ""),
+                       attributes.get("timestamp", "")))
+        tags_table = "nodes_tags"
+    else:
+        tblname = OSC_ELEMENT_TABLES[elem.tag][0]
+        osmcu.execute("INSERT INTO " + tblname + " (id, user, uid, version, changeset, timestamp) \
+                       VALUES (?, ?, ?, ?, ?, ?);",
+                      (elem_id, attributes.get("user", ""), attributes.get("uid", ""),
+                       attributes["version"], attributes.get("changeset", ""),
+                       attributes.get("timestamp", "")))
+        tags_table = elem.tag + "s_tags"
+    way_position = 0
+    member_position = 0
+    for child in elem:
+        if child.tag == "tag":
+            key, k_type = split_into_key_and_type(child.attrib["k"])
+            value = child.attrib["v"]
+            if child.attrib["k"] in rules.keys:
+                value = rules.correct(elem.tag, attributes["id"], child.attrib["k"], value,
+                                      correction_counts)
+                if value is None:
+                    continue
+            osmcu.execute("INSERT INTO " + tags_table + " (id, key, value, type) \
+                           VALUES (?, ?, ?, ?);", (elem_id, key, value, k_type))
+        elif child.tag == "nd":
+            way_position = way_position + 1
+            osmcu.execute("INSERT INTO ways_nodes (id, node_id, position) VALUES (?, ?, ?);",
+                          (elem_id, child.attrib["ref"], way_position))
+        elif child.tag == "member":
+            member_position = member_position + 1
+            osmcu.execute("INSERT INTO relations_members (id, member_type, member_id, role, \
+                           position) VALUES (?, ?, ?, ?, ?);",
+                          (elem_id, child.attrib["type"], child.attrib["ref"],
+                           child.attrib.get("role", ""), member_position))
+
+def open_osc(filename):
+    """Opens a change file, which may be gzipped (the daily diffs usually are)."""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+def apply_osc(osmconn, osmcu, filename, rules=None):
+    """Applies an osmChange file to the DB, correcting the new tags with rules (by default,
+corrections.csv). The whole file goes in as one transaction, so if anything goes wrong the DB is
+left as it was. The work done depends only on the size of the change file, not on the size of the
+DB."""
+    if rules is None:
+        rules = default_correction_rules()
+    correction_counts = [0] * len(rules.rules)
+    ensure_update_indexes(osmconn, osmcu)
+    counts = {"create": 0, "modify": 0, "delete": 0, "stale": 0}
+    changed = {"node": set(), "way": set(), "relation": set()}
+    action = None
+    action_elem = None
+    with open_osc(filename) as oscfile:
+        try:
+            for event, elem in ET.iterparse(oscfile, events=('start', 'end')):
+                if elem.tag in ("create", "modify", "delete"):
+                    if event == "start":
+                        action = elem.tag
+                        action_elem = elem
+                    continue
+                if (event != "end") or (action is None):
+                    continue
+                if elem.tag not in OSC_ELEMENT_TABLES:
+                    continue
+                elem_id = int(elem.attrib["id"])
+                version = int(elem.attrib["version"])
+                current = osm_element_version(osmcu, elem.tag, elem_id)
+                if action == "delete":
+                    if (current is None) or (current > version):
+                        counts["stale"] = counts["stale"] + 1
+                    else:
+                        delete_osm_element(osmcu, elem.tag, elem_id)
+                        changed[elem.tag].add(elem_id)
+                        counts["delete"] = counts["delete"] + 1
+                elif (current is not None) and (current >= version):
+                    counts["stale"] = counts["stale"] + 1
+                else:
+                    if current is not None:
+                        delete_osm_element(osmcu, elem.tag, elem_id)
+                    insert_osm_element(osmcu, elem, rules, correction_counts)
+                    changed[elem.tag].add(elem_id)
+                    counts[action] = counts[action] + 1
+                # we're done with this element, so don't let it pile up in memory
+                action_elem.clear()
+            affected_ways = ways_affected_by(osmcu, changed["node"], changed["way"])
+            update_spatial_index(osmcu, changed["node"], affected_ways)
+            update_way_geometries(osmcu, affected_ways)
+            update_multipolygons(osmcu, relations_affected_by(osmcu, affected_ways,
+                                                              changed["relation"]))
+            osmconn.commit()
+        except Exception:
+            osmconn.rollback()
+            raise
+    print("Applied", filename + ":", counts["create"], "created,", counts["modify"], "modified,",
+          counts["delete"], "deleted,", counts["stale"], "stale edits skipped")
+    prt_correction_counts([[rules.describe(rulenum), num]
+                           for rulenum, num in enumerate(correction_counts)])
+    return counts
+
+# ----------------------------------------------------------------
+# fourth section: the spatial index, and finding what's in an area
+#
+# The nodes table only has an index on uid, so any "what's in this area" question would be a full
+# table scan. We keep two SQLite R*Tree indexes instead: one with every node as a point, and one
+# with the bounding box of every way. An R*Tree finds everything overlapping a box without looking
+# at the rest of the data. R*Tree coordinates are 32-bit floats rounded outwards, so for nodes we
+# check the real coordinates afterwards.
+
+EARTH_RADIUS_M = 6371008.8
+
+def build_spatial_index(osmconn, osmcu):
+    """(Re)builds the R*Tree indexes over the nodes and over the bounding boxes of the ways."""
+    osmcu.execute("DROP TABLE IF EXISTS nodes_rtree;")
+    osmcu.execute("CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, \
+                   max_lon);")
+    osmcu.execute("INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes;")
+    osmcu.execute("DROP TABLE IF EXISTS ways_rtree;")
+    osmcu.execute("CREATE VIRTUAL TABLE ways_rtree USING rtree(id, min_lat, max_lat, min_lon, \
+                   max_lon);")
+    osmcu.execute("INSERT INTO ways_rtree                                                        \
+                   SELECT ways_nodes.id, MIN(nodes.lat), MAX(nodes.lat), MIN(nodes.lon),         \
+                       MAX(nodes.lon)                                                            \
+                   FROM ways_nodes JOIN nodes ON (nodes.id = ways_nodes.node_id)                 \
+                   GROUP BY ways_nodes.id;")
+    osmconn.commit()
+
+def has_spatial_index(osmcu):
+    """Tells whether build_spatial_index has been run on this DB"""
+    sql = "SELECT COUNT(*) FROM sqlite_master WHERE (type = 'table') AND (name = 'nodes_rtree');"
+    return osmcu.execute(sql).fetchone()[0] > 0
+
+def ways_affected_by(osmcu, node_ids, way_ids):
+    """Returns the ids of the given ways plus the ways that the given nodes are in. When a node
+moves, the shape (and bounding box) of every way it's in changes with it."""
+    way_ids = set(way_ids)
+    for node_id in node_ids:
+        for row in osmcu.execute("SELECT DISTINCT id FROM ways_nodes WHERE node_id = ?;",
+                                 (node_id,)).fetchall():
+            way_ids.add(row[0])
+    return way_ids
+
+def update_spatial_index(osmcu, node_ids, way_ids):
+    """Brings the spatial index up to date after the given nodes and ways have been inserted,
+changed or deleted (way_ids should come from ways_affected_by). Does nothing if there is no spatial
+index."""
+    if not has_spatial_index(osmcu):
+        return
+    for node_id in node_ids:
+        osmcu.execute("DELETE FROM nodes_rtree WHERE id = ?;", (node_id,))
+        osmcu.execute("INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes \
+                       WHERE id = ?;", (node_id,))
+    for way_id in way_ids:
+        osmcu.execute("DELETE FROM ways_rtree WHERE id = ?;", (way_id,))
+        osmcu.execute("INSERT INTO ways_rtree                                                \
+                       SELECT ways_nodes.id, MIN(nodes.lat), MAX(nodes.lat), MIN(nodes.lon), \
+                           MAX(nodes.lon)                                                    \
+                       FROM ways_nodes JOIN nodes ON (nodes.id = ways_nodes.node_id)         \
+                       WHERE ways_nodes.id = ?                                               \
+                       GROUP BY ways_nodes.id;", (way_id,))
+
+def join_key_and_type(key, k_type):
+    """The reverse of split_into_key_and_type: gives us back the key as it was in the OSM file"""
+    if k_type == "regular":
+        return key
+    return k_type + ":" + key
+
+def tags_for_ids(osmcu, tags_table, ids):
+    """Fetches the tags for a list of element ids. Returns a dictionary from id to a dictionary of
+tags (with the keys as they were in the OSM file)."""
+    result = {}
+    for elem_id in ids:
+        result[elem_id] = {}
+    ids = list(ids)
+    # keep well under SQLite's limit on the number of "?" in one statement
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        sql = "SELECT id, key, value, type FROM " + tags_table + " WHERE id IN (" + \
+              ", ".join(["?"] * len(chunk)) + ");"
+        for row in osmcu.execute(sql, chunk):
+            result[row[0]][join_key_and_type(row[1], row[3])] = row[2]
+    return result
+
+def nodes_in_bbox(osmcu, min_lat, min_lon, max_lat, max_lon, limit=None):
+    """Returns the nodes inside a bounding box, each as a dictionary with its id, lat, lon and
+tags. With limit, at most that many nodes."""
+    sql = "SELECT nodes.id, nodes.lat, nodes.lon                                   \
+           FROM nodes_rtree JOIN nodes ON (nodes.id = nodes_rtree.id)              \
+           WHERE (nodes_rtree.max_lat >= ?) AND (nodes_rtree.min_lat <= ?)         \
+               AND (nodes_rtree.max_lon >= ?) AND (nodes_rtree.min_lon <= ?)       \
+               AND (nodes.lat BETWEEN ? AND ?) AND (nodes.lon BETWEEN ? AND ?)"
+    params = [min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon]
+    if limit is not None:
+        sql = sql + " LIMIT ?"
+        params.append(limit)
+    nodes = []
+    for row in osmcu.execute(sql + ";", params).fetchall():
+        nodes.append({"id": row[0], "lat": row[1], "lon": row[2]})
+    tags = tags_for_ids(osmcu, "nodes_tags", [node["id"] for node in nodes])
+    for node in nodes:
+        node["tags"] = tags[node["id"]]
+    return nodes
+
+def ways_in_bbox(osmcu, min_lat, min_lon, max_lat, max_lon, limit=None):
+    """Returns the ways whose bounding box overlaps a bounding box, each as a dictionary with its
+id, its own bounding box and its tags. With limit, at most that many ways."""
+    sql = "SELECT id, min_lat, min_lon, max_lat, max_lon FROM ways_rtree            \
+           WHERE (max_lat >= ?) AND (min_lat <= ?) AND (max_lon >= ?) AND (min_lon <= ?)"
+    params = [min_lat, max_lat, min_lon, max_lon]
+    if limit is not None:
+        sql = sql + " LIMIT ?"
+        params.append(limit)
+    ways = []
+    for row in osmcu.execute(sql + ";", params).fetchall():
+        ways.append({"id": row[0], "min_lat": row[1], "min_lon": row[2], "max_lat": row[3],
+                     "max_lon": row[4]})
+    tags = tags_for_ids(osmcu, "ways_tags", [way["id"] for way in ways])
+    for way in ways:
+        way["tags"] = tags[way["id"]]
+    return ways
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Distance in meters between two points on the Earth"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    hav = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(hav)))
+
+def radius_to_bbox(lat, lon, radius_m):
+    """Returns (min_lat, min_lon, max_lat, max_lon) of a box that contains the circle"""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    coslat = math.cos(math.radians(lat))
+    if coslat < 1e-6:
+        dlon = 180.0
+    else:
+        dlon = min(180.0, dlat / coslat)
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+def features_in_radius(osmcu, lat, lon, radius_m):
+    """Returns the nodes within radius_m meters of a point, and the ways whose bounding box comes
+within radius_m meters of it, as a dictionary with "nodes" and "ways" lists (see nodes_in_bbox and
+ways_in_bbox). Each one gets a "distance" in meters too (for a way, to the nearest point of its
+bounding box), and the lists are sorted by it."""
+    min_lat, min_lon, max_lat, max_lon = radius_to_bbox(lat, lon, radius_m)
+    nodes = []
+    for node in nodes_in_bbox(osmcu, min_lat, min_lon, max_lat, max_lon):
+        node["distance"] = haversine_m(lat, lon, node["lat"], node["lon"])
+        if node["distance"] <= radius_m:
+            nodes.append(node)
+    ways = []
+    for way in ways_in_bbox(osmcu, min_lat, min_lon, max_lat, max_lon):
+        nearest_lat = min(max(lat, way["min_lat"]), way["max_lat"])
+        nearest_lon = min(max(lon, way["min_lon"]), way["max_lon"])
+        way["distance"] = haversine_m(lat, lon, nearest_lat, nearest_lon)
+        if way["distance"] <= radius_m:
+            ways.append(way)
+    nodes.sort(key=lambda node: node["distance"])
+    ways.sort(key=lambda way: way["distance"])
+    return {"nodes": nodes, "ways": ways}
+
+# ----------------------------------------------------------------
+# fifth section: way geometries
+#
+# Getting the coordinates of a way means joining ways_nodes to nodes and sorting by position, one
+# query per way. Instead we assemble the coordinates of every way in one pass and keep them in the
+# way_geometry table, one row per way, with the coordinates packed into a blob: latitude,
+# longitude, latitude, longitude... as little-endian 32-bit ints in units of 1e-7 degrees (the
+# precision of the OSM data itself).
+
+COORD_SCALE = nodestore.COORD_SCALE
+
+def pack_coordinates(fixed):
+    """Packs a flat list of fixed point lat, lon, lat, lon... into a blob"""
+    packed = array.array("i", fixed)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack_fixed(blob):
+    """Unpacks a blob made by pack_coordinates back into a flat array of fixed point
+lat, lon, lat, lon..."""
+    fixed = array.array("i")
+    fixed.frombytes(blob)
+    if sys.byteorder == "big":
+        fixed.byteswap()
+    return fixed
+
+def unpack_coordinates(blob):
+    """Unpacks a blob made by pack_coordinates into a list of (lat, lon) pairs in degrees"""
+    fixed = unpack_fixed(blob)
+    return [(fixed[idx] / COORD_SCALE, fixed[idx + 1] / COORD_SCALE)
+            for idx in range(0, len(fixed), 2)]
+
+def load_node_coordinates(osmconn):
+    """Reads the location of every node into three arrays sorted by node id: the ids, and the
+latitudes and longitudes in fixed point. Looking a node up is then a binary search (see
+node_coordinates), and the arrays take 16 bytes per node instead of a dictionary's hundreds."""
+    ids = array.array("q")
+    lats = array.array("i")
+    lons = array.array("i")
+    for row in osmconn.execute("SELECT id, lat, lon FROM nodes ORDER BY id;"):
+        ids.append(row[0])
+        lats.append(nodestore.to_fixed(row[1]))
+        lons.append(nodestore.to_fixed(row[2]))
+    return ids, lats, lons
+
+def node_coordinates(locations, node_id):
+    """Looks up a node in the arrays from load_node_coordinates. Returns its fixed point
+(lat, lon), or None if the node isn't in the extract."""
+    ids, lats, lons = locations
+    idx = bisect.bisect_left(ids, node_id)
+    if (idx < len(ids)) and (ids[idx] == node_id):
+        return lats[idx], lons[idx]
+    return None
+
+def create_way_geometry_table(osmcu):
+    """Creates (or empties) the way_geometry table"""
+    osmcu.execute("DROP TABLE IF EXISTS way_geometry;")
+    osmcu.execute("CREATE TABLE way_geometry (                \
+                       id INTEGER PRIMARY KEY NOT NULL,        \
+                       num_points INTEGER NOT NULL,            \
+                       coords BLOB NOT NULL,                   \
+                       FOREIGN KEY (id) REFERENCES ways(id)    \
+                   );")
+
+def build_way_geometries(osmconn, osmcu, batch_size=10000, node_store=None):
+    """Assembles the coordinates of every way in one pass over ways_nodes, and stores them in the
+way_geometry table. Nodes that are missing from the extract (ways at the edge of the area often
+have some) are left out of the way. The node locations come from node_store if we filled one while
+parsing (see nodestore.py), otherwise we read them from the nodes table into memory."""
+    if node_store is None:
+        locations = load_node_coordinates(osmconn)
+        lookup = lambda node_id: node_coordinates(locations, node_id)
+    else:
+        lookup = node_store.get
+    create_way_geometry_table(osmcu)
+    writer = SqlBatchWriter(osmcu, "way_geometry", ["id", "num_points", "coords"], batch_size)
+    missing = 0
+    way_id = None
+    fixed = []
+    readcu = osmconn.cursor()
+    for row in readcu.execute("SELECT id, node_id FROM ways_nodes ORDER BY id, position;"):
+        if row[0] != way_id:
+            if way_id is not None:
+                writer.writerow([way_id, len(fixed) // 2, pack_coordinates(fixed)])
+            way_id = row[0]
+            fixed = []
+        coords = lookup(row[1])
+        if coords is None:
+            missing = missing + 1
+        else:
+            fixed.extend(coords)
+    if way_id is not None:
+        writer.writerow([way_id, len(fixed) // 2, pack_coordinates(fixed)])
+    writer.flush()
+    osmconn.commit()
+    print("Built geometries for", writer.rows, "ways (" + str(missing), "way nodes missing)")
+
+def has_way_geometries(osmcu):
+    """Tells whether build_way_geometries has been run on this DB"""
+    sql = "SELECT COUNT(*) FROM sqlite_master WHERE (type = 'table') AND (name = 'way_geometry');"
+    return osmcu.execute(sql).fetchone()[0] > 0
+
+def update_way_geometries(osmcu, way_ids):
+    """Rebuilds the geometries of the given ways (after an update, see ways_affected_by). Does
+nothing if the geometries haven't been built."""
+    if not has_way_geometries(osmcu):
+        return
+    for way_id in way_ids:
+        osmcu.execute("DELETE FROM way_geometry WHERE id = ?;", (way_id,))
+        fixed = []
+        sql = "SELECT nodes.lat, nodes.lon                                               \
+               FROM ways_nodes JOIN nodes ON (nodes.id = ways_nodes.node_id)             \
+               WHERE ways_nodes.id = ? ORDER BY ways_nodes.position;"
+        for row in osmcu.execute(sql, (way_id,)).fetchall():
+            fixed.append(nodestore.to_fixed(row[0]))
+            fixed.append(nodestore.to_fixed(row[1]))
+        if fixed or (osm_element_version(osmcu, "way", way_id) is not None):
+            osmcu.execute("INSERT INTO way_geometry (id, num_points, coords) VALUES (?, ?, ?);",
+                          (way_id, len(fixed) // 2, pack_coordinates(fixed)))
+
+def get_way_geometry(osmcu, way_id):
+    """Returns the coordinates of a way as a list of (lat, lon) pairs, or None if there is no such
+way."""
+    row = osmcu.execute("SELECT coords FROM way_geometry WHERE id = ?;", (way_id,)).fetchone()
+    if row is None:
+        return None
+    return unpack_coordinates(row[0])
+
+def iter_way_geometries(osmcu, tag_type=None, tag_key=None):
+    """Yields (way id, list of (lat, lon) pairs) for every way, or with tag_type and tag_key, for
+every way with that tag (for example all the streets with "regular", "highway"), all in one
+query."""
+    if tag_key is None:
+        sql = "SELECT id, coords FROM way_geometry ORDER BY id;"
+        params = ()
+    else:
+        sql = "SELECT way_geometry.id, way_geometry.coords FROM way_geometry          \
+               WHERE way_geometry.id IN (SELECT id FROM ways_tags                     \
+                                         WHERE (type = ?) AND (key = ?))              \
+               ORDER BY way_geometry.id;"
+        params = (tag_type, tag_key)
+    for row in osmcu.execute(sql, params):
+        yield row[0], unpack_coordinates(row[1])
+
+# ----------------------------------------------------------------
+# sixth section: multipolygons
+#
+# Areas that can't be drawn as one closed way (big buildings with courtyards, lakes with islands,
+# administrative boundaries) are relations whose member ways, end to end, make up the rings of the
+# area: "outer" rings around it and "inner" rings cut out of it. A ring is often split over many
+# ways, in no particular order or direction, so we have to stitch them together, matching up the
+# ends of the ways. We keep the result in the multipolygon_rings table, one row per closed ring,
+# with the coordinates packed the same way as way_geometry.
+#
+# We go through the relations in batches. For each batch we fetch the members and then the
+# geometries of just those member ways, by primary key from way_geometry, so we never scan the
+# ways and never hold more than one batch of geometries in memory.
+
+MULTIPOLYGON_TYPES = ["multipolygon", "boundary"]
+
+def create_multipolygon_table(osmcu):
+    """Creates (or empties) the multipolygon_rings table"""
+    osmcu.execute("DROP TABLE IF EXISTS multipolygon_rings;")
+    osmcu.execute("CREATE TABLE multipolygon_rings (                   \
+                       id INTEGER NOT NULL,                            \
+                       ring INTEGER NOT NULL,                          \
+                       role TEXT NOT NULL,                             \
+                       num_points INTEGER NOT NULL,                    \
+                       coords BLOB NOT NULL,                           \
+                       PRIMARY KEY (id, ring),                         \
+                       FOREIGN KEY (id) REFERENCES relations(id)       \
+                   );")
+
+def has_multipolygons(osmcu):
+    """Tells whether build_multipolygons has been run on this DB"""
+    sql = "SELECT COUNT(*) FROM sqlite_master WHERE (type = 'table') AND \
+           (name = 'multipolygon_rings');"
+    return osmcu.execute(sql).fetchone()[0] > 0
+
+def fixed_way_geometries(osmcu, way_ids):
+    """Fetches the geometries of a list of ways from way_geometry, by primary key. Returns a
+dictionary from way id to a list of fixed point (lat, lon) pairs; ways we don't have are left
+out."""
+    result = {}
+    way_ids = list(way_ids)
+    for start in range(0, len(way_ids), 500):
+        chunk = way_ids[start:start + 500]
+        sql = "SELECT id, coords FROM way_geometry WHERE id IN (" + \
+              ", ".join(["?"] * len(chunk)) + ");"
+        for row in osmcu.execute(sql, chunk):
+            fixed = unpack_fixed(row[1])
+            result[row[0]] = [(fixed[idx], fixed[idx + 1]) for idx in range(0, len(fixed), 2)]
+    return result
+
+def stitch_rings(pieces):
+    """Joins ways (lists of points) end to end into closed rings. Ways can run in either direction,
+so we look up the ways touching the end of the ring so far by their end points. Returns the list of
+rings and the number of ways we couldn't close a ring with."""
+    rings = []
+    unclosed = 0
+    pieces = [piece for piece in pieces if len(piece) >= 2]
+    ends = {}
+    for idx, piece in enumerate(pieces):
+        if piece[0] != piece[-1]:
+            ends.setdefault(piece[0], []).append(idx)
+            ends.setdefault(piece[-1], []).append(idx)
+    used = [False] * len(pieces)
+    for idx, piece in enumerate(pieces):
+        if used[idx]:
+            continue
+        used[idx] = True
+        ring = list(piece)
+        num_pieces = 1
+        while ring[0] != ring[-1]:
+            nxt = None
+            for candidate in ends.get(ring[-1], []):
+                if not used[candidate]:
+                    nxt = candidate
+                    break
+            if nxt is None:
+                break
+            used[nxt] = True
+            num_pieces = num_pieces + 1
+            if pieces[nxt][0] == ring[-1]:
+                ring.extend(pieces[nxt][1:])
+            else:
+                ring.extend(reversed(pieces[nxt][:-1]))
+        if (ring[0] == ring[-1]) and (len(ring) >= 4):
+            rings.append(ring)
+        else:
+            unclosed = unclosed + num_pieces
+    return rings, unclosed
+
+def assemble_multipolygons(osmcu, relation_ids):
+    """Assembles the rings of a batch of relations. Returns a list of multipolygon_rings rows and
+the number of member ways that didn't make it into a closed ring (including ways we don't have)."""
+    members = {}
+    relation_ids = list(relation_ids)
+    for start in range(0, len(relation_ids), 500):
+        chunk = relation_ids[start:start + 500]
+        sql = "SELECT id, member_id, role FROM relations_members                       \
+               WHERE (member_type = 'way') AND id IN (" + ", ".join(["?"] * len(chunk)) + ") \
+               ORDER BY id, position;"
+        for row in osmcu.execute(sql, chunk):
+            members.setdefault(row[0], []).append((row[1], row[2]))
+    geometries = fixed_way_geometries(osmcu, set(way_id for relation_members in members.values()
+                                                 for way_id, role in relation_members))
+    rows = []
+    unclosed = 0
+    for relation_id in relation_ids:
+        ring_num = 0
+        for role in ["outer", "inner"]:
+            pieces = []
+            for way_id, member_role in members.get(relation_id, []):
+                # untagged members are outer ones, by convention
+                if (member_role == "inner") != (role == "inner"):
+                    continue
+                if way_id in geometries:
+                    pieces.append(geometries[way_id])
+                else:
+                    unclosed = unclosed + 1
+            rings, num_unclosed = stitch_rings(pieces)
+            unclosed = unclosed + num_unclosed
+            for ring in rings:
+                ring_num = ring_num + 1
+                fixed = [coord for point in ring for coord in point]
+                rows.append([relation_id, ring_num, role, len(ring), pack_coordinates(fixed)])
+    return rows, unclosed
+
+def multipolygon_relation_ids(osmcu, relation_ids=None):
+    """Returns the relations that are areas (see MULTIPOLYGON_TYPES), out of relation_ids, or out
+of all of them if relation_ids is None. The whole list comes back as a cursor, in id order."""
+    sql = "SELECT DISTINCT id FROM relations_tags WHERE (type = 'regular') AND (key = 'type') \
+           AND (value IN (" + ", ".join(["?"] * len(MULTIPOLYGON_TYPES)) + "))"
+    if relation_ids is None:
+        return osmcu.execute(sql + " ORDER BY id;", MULTIPOLYGON_TYPES)
+    relation_ids = list(relation_ids)
+    result = []
+    for start in range(0, len(relation_ids), 500):
+        chunk = relation_ids[start:start + 500]
+        for row in osmcu.execute(sql + " AND (id IN (" + ", ".join(["?"] * len(chunk)) + "));",
+                                 MULTIPOLYGON_TYPES + chunk):
+            result.append(row)
+    return result
+
+def build_multipolygons(osmconn, osmcu, batch_size=1000):
+    """Assembles the rings of every multipolygon and boundary relation, batch_size relations at a
+time, and stores them in the multipolygon_rings table. Needs the way geometries (see
+build_way_geometries)."""
+    if not has_way_geometries(osmcu):
+        print("No way geometries, so no multipolygons (run build_way_geometries first)")
+        return
+    ensure_update_indexes(osmconn, osmcu)
+    create_multipolygon_table(osmcu)
+    writer = SqlBatchWriter(osmcu, "multipolygon_rings",
+                            ["id", "ring", "role", "num_points", "coords"], batch_size)
+    readcu = osmconn.cursor()
+    relations = multipolygon_relation_ids(readcu)
+    num_relations = 0
+    unclosed = 0
+    while True:
+        batch = [row[0] for row in relations.fetchmany(batch_size)]
+        if not batch:
+            break
+        num_relations = num_relations + len(batch)
+        rows, num_unclosed = assemble_multipolygons(osmcu, batch)
+        unclosed = unclosed + num_unclosed
+        for row in rows:
+            writer.writerow(row)
+    writer.flush()
+    osmconn.commit()
+    print("Built", writer.rows, "rings for", num_relations, "multipolygons (" + str(unclosed),
+          "member ways not in a closed ring)")
+
+def relations_affected_by(osmcu, way_ids, relation_ids):
+    """Returns the ids of the given relations plus the relations that the given ways are members
+of. When a way changes, so do the rings it's part of."""
+    relation_ids = set(relation_ids)
+    for way_id in way_ids:
+        for row in osmcu.execute("SELECT DISTINCT id FROM relations_members                    \
+                                  WHERE (member_type = 'way') AND (member_id = ?);",
+                                 (way_id,)).fetchall():
+            relation_ids.add(row[0])
+    return relation_ids
+
+def update_multipolygons(osmcu, relation_ids):
+    """Reassembles the rings of the given relations (after an update, see relations_affected_by).
+Does nothing if the multipolygons haven't been built."""
+    if not has_multipolygons(osmcu):
+        return
+    relation_ids = list(relation_ids)
+    for relation_id in relation_ids:
+        osmcu.execute("DELETE FROM multipolygon_rings WHERE id = ?;", (relation_id,))
+    batch = [row[0] for row in multipolygon_relation_ids(osmcu, relation_ids)]
+    rows, unclosed = assemble_multipolygons(osmcu, batch)
+    osmcu.executemany("INSERT INTO multipolygon_rings (id, ring, role, num_points, coords) \
+                       VALUES (?, ?, ?, ?, ?);", rows)
+
+def get_multipolygon(osmcu, relation_id):
+    """Returns the rings of a multipolygon as a dictionary with "outer" and "inner" lists, each
+ring a list of (lat, lon) pairs, or None if there are no rings for that relation."""
+    result = {"outer": [], "inner": []}
+    found = False
+    for row in osmcu.execute("SELECT role, coords FROM multipolygon_rings WHERE id = ? \
+                              ORDER BY ring;", (relation_id,)):
+        result[row[0]].append(unpack_coordinates(row[1]))
+        found = True
+    if not found:
+        return None
+    return result
+
+def ring_area_m2(ring):
+    """The area of a ring of (lat, lon) pairs in square meters. We project the ring onto a plane
+around its middle latitude, which is plenty accurate for anything smaller than a country."""
+    if len(ring) < 4:
+        return 0.0
+    mid_lat = math.radians(sum(point[0] for point in ring) / len(ring))
+    scale_y = math.radians(1) * EARTH_RADIUS_M
+    scale_x = scale_y * math.cos(mid_lat)
+    # measure from the first point, to keep the numbers small
+    lat0, lon0 = ring[0]
+    total = 0.0
+    for idx in range(1, len(ring) - 1):
+        x1 = (ring[idx][1] - lon0) * scale_x
+        y1 = (ring[idx][0] - lat0) * scale_y
+        x2 = (ring[idx + 1][1] - lon0) * scale_x
+        y2 = (ring[idx + 1][0] - lat0) * scale_y
+        total = total + x1 * y2 - x2 * y1
+    return abs(total) / 2
+
+def multipolygon_area_m2(osmcu, relation_id):
+    """The area of a multipolygon in square meters: its outer rings less its inner rings. Returns
+None if there are no rings for that relation."""
+    rings = get_multipolygon(osmcu, relation_id)
+    if rings is None:
+        return None
+    return sum(ring_area_m2(ring) for ring in rings["outer"]) - \
+           sum(ring_area_m2(ring) for ring in rings["inner"])
+
+# ----------------------------------------------------------------
+# seventh section: running the pipeline, for one region or many
+#
+# main() used to be a list of settings to edit in the source, and always read lyon.osm and wrote
+# lyon.db in the current directory. Now the pipeline for one region is run_region: it reads any OSM
+# file, puts everything it writes (the DB, the CSV files, the node store, the Parquet files) in an
+# output directory of its own, runs just the stages it's asked to, and times each one. run_regions
+# runs several regions at once, each in its own process, and main() turns the command line into a
+# call to one or the other.
+
+# the stages of the pipeline, in the order they run
+PIPELINE_STAGES = ["load", "corrections", "spatial_index", "way_geometries", "multipolygons",
+                   "stats", "indexes", "osc", "routing_graph", "analyze"]
+
+class PipelineOptions:
+    """How to run the pipeline (these used to be the settings at the top of main()). stages is
+a list of PIPELINE_STAGES; by default everything but "osc", or, if osc_file is given, just "osc",
+"routing_graph" and "analyze" (an existing DB brought up to date). The routing_graph stage writes
+the graph next to the DB (see osmroute.py). Like a CsvSink, a PipelineOptions is just
+settings, so it can be handed to worker processes."""
+    def __init__(self, stages=None, skip_csvs=True, csv_side_output=False, parse_workers=1,
+                 osc_file=None, node_store_layout=None, correct_while_parsing=True,
+                 csv_compression=None, csv_writer_thread=False, columnar_dir=None,
+                 fast_parse=False, corrections_file=None, bulk_load=False, checkpoints=False,
+                 checkpoint_bytes=DEFAULT_CHECKPOINT_BYTES,
+                 checkpoint_rows=DEFAULT_CHECKPOINT_ROWS):
+        if stages is None:
+            if osc_file is None:
+                stages = [stage for stage in PIPELINE_STAGES if stage != "osc"]
+            else:
+                stages = ["osc", "routing_graph", "analyze"]
+        for stage in stages:
+            if stage not in PIPELINE_STAGES:
+                raise ValueError("unknown stage: " + str(stage))
+        if ("osc" in stages) and (osc_file is None):
+            raise ValueError("the osc stage needs an OSM change file")
+        csvsink.check_compression(csv_compression)
+        if (parse_workers > 1) and (skip_csvs or node_store_layout or columnar_dir):
+            raise ValueError("parsing on several cores only works on the CSV route, without a " +
+                             "node store or Parquet files")
+        if checkpoints and (csv_side_output or node_store_layout or columnar_dir):
+            raise ValueError("a checkpointed load can't write the CSV files on the side, a node " +
+                             "store or Parquet files")
+        self.stages = stages
+        self.skip_csvs = skip_csvs # False to go the old way, through the CSV files, into the DB
+        self.csv_side_output = csv_side_output # True to still get the CSV files when skipping them
+        self.parse_workers = parse_workers # more than 1 to parse the XML on several cores
+        self.osc_file = osc_file
+        self.node_store_layout = node_store_layout # "dense" or "sparse", see nodestore.py
+        self.correct_while_parsing = correct_while_parsing
+        self.csv_compression = csv_compression
+        self.csv_writer_thread = csv_writer_thread
+        self.columnar_dir = columnar_dir # relative to the region's output directory
+        self.fast_parse = fast_parse
+        self.corrections_file = corrections_file # by default, corrections.csv next to this script
+        self.bulk_load = bulk_load # True to load with the bulk-load settings (see set_up_osm_db)
+        self.checkpoints = checkpoints # True to checkpoint the load, and resume it after a crash
+        self.checkpoint_bytes = checkpoint_bytes # of the OSM file between checkpoints
+        self.checkpoint_rows = checkpoint_rows # of the CSV files between checkpoints
+
+    def correction_rules(self):
+        """The correction rules to apply"""
+        if self.corrections_file is None:
+            return default_correction_rules()
+        return load_correction_rules(self.corrections_file)
+
+def region_name(filename):
+    """The name of the region an OSM file holds, going by the file name (lyon.osm.pbf -> lyon)"""
+    name = os.path.basename(filename)
+    for extension in [".pbf", ".osm"]:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name
+
+def load_region(osmconn, osmcu, osm_file, output_dir, options, rules):
+    """The load stage: parses osm_file into the DB, by way of the CSV files or not, as options say.
+Returns the node store, if options asked for one, for build_way_geometries to use."""
+    if not options.correct_while_parsing:
+        rules = CorrectionRules([])
+    sink = csvsink.CsvSink(options.csv_compression, threaded=options.csv_writer_thread,
+                           directory=output_dir)
+    node_store = None
+    if options.node_store_layout is not None:
+        node_store = nodestore.open_node_store(
+            os.path.join(output_dir, region_name(osm_file) + ".nodes"), options.node_store_layout)
+    columnar = None
+    if options.columnar_dir is not None:
+        columnar = open_columnar_export(os.path.join(output_dir, options.columnar_dir))
+    if options.skip_csvs and options.checkpoints:
+        stream_osm_into_sql_checkpointed(osmconn, osmcu, osm_file, options.checkpoint_bytes,
+                                         rules=rules, fast=options.fast_parse)
+    elif options.skip_csvs:
+        stream_osm_into_sql(osmconn, osmcu, osm_file, csv_side_output=options.csv_side_output,
+                            node_store=node_store, rules=rules, sink=sink, columnar=columnar,
+                            fast=options.fast_parse)
+    else:
+        # with checkpoints, a finished set of CSV files doesn't get written again
+        generated = None
+        checkpoint_rows = None
+        if options.checkpoints:
+            create_checkpoint_table(osmconn, osmcu)
+            generated = get_checkpoint(osmcu, "generate_csvs", osm_file)
+            checkpoint_rows = options.checkpoint_rows
+        if generated is not None:
+            print("The CSV files for", osm_file, "are there already")
+        elif options.parse_workers > 1:
+            generate_csvs_parallel(osm_file, workers=options.parse_workers, rules=rules,
+                                   sink=sink, fast=options.fast_parse)
+        else:
+            generate_csvs(osm_file, node_store=node_store, rules=rules, sink=sink,
+                          columnar=columnar, fast=options.fast_parse)
+        if options.checkpoints and (generated is None):
+            save_checkpoint(osmcu, "generate_csvs", osm_file, os.path.getsize(osm_file), done=True)
+            osmconn.commit()
+        parse_csvs_into_sql(osmconn, osmcu, sink=sink, checkpoint_rows=checkpoint_rows)
+    return node_store
+
+def run_pipeline_stages(osm_file, output_dir, db_file, options, timings):
+    """Runs the stages in options on one region, appending the seconds each one took to timings.
+The load stage starts a fresh DB, unless it's checkpointed and there's a DB from a checkpointed
+load already, which it carries on with. Without the load stage, the DB has to be there already."""
+    load = "load" in options.stages
+    resume = False
+    if load and options.checkpoints and os.path.exists(db_file):
+        resume = has_checkpoints(db_file)
+    if load and not resume:
+        if os.path.exists(db_file):
+            os.remove(db_file)
+    elif not os.path.exists(db_file):
+        raise ValueError(db_file + " doesn't exist, so the load stage has to run first")
+    if resume:
+        print("Carrying on with the checkpointed load into", db_file)
+    osmconn, osmcu = set_up_osm_db(load and not resume, db_file, load and options.bulk_load)
+    node_store = None
+    try:
+        rules = options.correction_rules()
+        for stage in PIPELINE_STAGES:
+            if stage not in options.stages:
+                continue
+            print("Stage:", stage)
+            started = time.perf_counter()
+            if stage == "load":
+                node_store = load_region(osmconn, osmcu, osm_file, output_dir, options, rules)
+            elif stage == "corrections":
+                # unless the load stage already corrected the tags on the way in
+                if not (load and options.correct_while_parsing):
+                    apply_corrections_to_sql_db(osmconn, osmcu, rules)
+            elif stage == "spatial_index":
+                build_spatial_index(osmconn, osmcu)
+            elif stage == "way_geometries":
+                build_way_geometries(osmconn, osmcu, node_store=node_store)
+            elif stage == "multipolygons":
+                build_multipolygons(osmconn, osmcu)
+            elif stage == "stats":
+                build_osm_stats(osmconn, osmcu)
+            elif stage == "indexes":
+                finish_osm_db(osmconn, osmcu)
+            elif stage == "osc":
+                osc_rules = rules
+                if not options.correct_while_parsing:
+                    osc_rules = CorrectionRules([])
+                apply_osc(osmconn, osmcu, options.osc_file, osc_rules)
+            elif stage == "routing_graph":
+                osmroute.build_routing_graph(osmcu, osmroute.graph_filename(db_file))
+            elif stage == "analyze":
+                analyze_osm_sql(osmcu)
+            timings.append({"stage": stage, "seconds": round(time.perf_counter() - started, 4)})
+    finally:
+        if node_store is not None:
+            node_store.close()
+        osmconn.close()
+
+def run_region(osm_file, output_dir=".", options=None, db_file=None, log_file=None):
+    """Runs the pipeline on one OSM file, with everything it writes going into output_dir, and the
+DB into db_file (by default, the region name plus .db, in output_dir). If log_file is given, what
+the stages print goes there instead of to the screen. Returns a summary: the region, its files, the
+seconds each stage took, and the error (a traceback) if it failed. We catch the error rather than
+raise it, so that one bad region doesn't stop the others."""
+    if options is None:
+        options = PipelineOptions()
+    region = region_name(osm_file)
+    os.makedirs(output_dir, exist_ok=True)
+    if db_file is None:
+        db_file = os.path.join(output_dir, region + ".db")
+    summary = {"region": region, "input": osm_file, "output_dir": output_dir, "db": db_file,
+               "log": log_file, "stages": [], "error": None}
+    started = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if log_file is not None:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(log_file,
+                                                                                    "w"))))
+        try:
+            run_pipeline_stages(osm_file, output_dir, db_file, options, summary["stages"])
+        except Exception: # reported in the summary
+            summary["error"] = traceback.format_exc()
+            print(summary["error"])
+    summary["total_seconds"] = round(time.perf_counter() - started, 4)
+    return summary
+
+def run_regions(osm_files, output_dir=".", options=None, processes=None):
+    """Runs the pipeline on several OSM files at once, each in its own process (as many at a time
+as there are cores, by default). Each region gets a directory of its own under output_dir, named
+after the region, for its DB, its other files and a log of what it printed. Returns the summaries
+(see run_region), in the order of osm_files."""
+    if options is None:
+        options = PipelineOptions()
+    jobs = []
+    for osm_file in osm_files:
+        region = region_name(osm_file)
+        if region in [job[0] for job in jobs]:
+            raise ValueError("two input files for the region " + region)
+        region_dir = os.path.join(output_dir, region)
+        os.makedirs(region_dir, exist_ok=True)
+        jobs.append((region, osm_file, region_dir, os.path.join(region_dir, region + ".log")))
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+    summaries = {}
+    if processes == 1:
+        for region, osm_file, region_dir, log_file in jobs:
+            summaries[region] = run_region(osm_file, region_dir, options, log_file=log_file)
+            prt_region_done(summaries[region])
+    else:
+        # not a multiprocessing.Pool: its workers can't start processes of their own, which the
+        # parallel parser and the PBF reader do
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            futures = []
+            for region, osm_file, region_dir, log_file in jobs:
+                futures.append(pool.submit(run_region, osm_file, region_dir, options,
+                                           log_file=log_file))
+            for future in concurrent.futures.as_completed(futures):
+                summary = future.result()
+                summaries[summary["region"]] = summary
+                prt_region_done(summary)
+    return [summaries[job[0]] for job in jobs]
+
+def prt_region_done(summary):
+    """Prints a line when a region is done"""
+    if summary["error"] is None:
+        print("Finished", summary["region"], "in", round(summary["total_seconds"], 2), "seconds")
+    else:
+        print("FAILED", summary["region"], "after", round(summary["total_seconds"], 2),
+              "seconds, see", summary["log"] or "above")
+
+def prt_pipeline_summary(summaries):
+    """Prints the seconds each stage took for each region, side by side"""
+    stages = [stage for stage in PIPELINE_STAGES
+              if any(stage in [timing["stage"] for timing in summary["stages"]]
+                     for summary in summaries)]
+    width = max([len("region")] + [len(summary["region"]) for summary in summaries])
+    print(("%-" + str(width) + "s") % "region", end="")
+    for stage in stages + ["total"]:
+        print(" %*s" % (max(len(stage), 8), stage), end="")
+    print("  status")
+    for summary in summaries:
+        seconds = {}
+        for timing in summary["stages"]:
+            seconds[timing["stage"]] = timing["seconds"]
+        print(("%-" + str(width) + "s") % summary["region"], end="")
+        for stage in stages:
+            if stage in seconds:
+                print(" %*.2f" % (max(len(stage), 8), seconds[stage]), end="")
+            else:
+                print(" %*s" % (max(len(stage), 8), "-"), end="")
+        print(" %8.2f" % summary["total_seconds"], end="")
+        print("  " + ("ok" if summary["error"] is None else "FAILED"))
 
 def main():
-    make_database = True # set to False if you have already built the DB and just want to run analysis queries
-    osmconn, osmcu = set_up_osm_db(make_database)
-    if make_database:
-        generate_csvs()
-        parse_csvs_into_sql(osmconn, osmcu)
-        apply_corrections_to_sql_db(osmconn, osmcu)
-    analyze_osm_sql(osmcu)
-    osmconn.close()
+    parser = argparse.ArgumentParser(description="Parses OpenStreetMap files into SQLite DBs and "
+                                     "analyzes them")
+    parser.add_argument("osm_files", nargs="*", default=["lyon.osm"],
+                        help="OSM files (.osm or .osm.pbf), one per region (default: lyon.osm)")
+    parser.add_argument("--output-dir", default=".",
+                        help="where to put the DB and the other files; with several inputs, "
+                        "each region gets a directory of its own in here")
+    parser.add_argument("--db", default=None,
+                        help="the DB file, for a single input (default: the region name plus .db)")
+    parser.add_argument("--stages", nargs="+", choices=PIPELINE_STAGES, default=None,
+                        help="which stages to run (default: all but osc; with --osc, just osc, "
+                        "routing_graph and analyze)")
+    parser.add_argument("--osc", default=None, help="an OSM change file to apply to the DB")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="how many regions to run at once (default: one per core)")
+    parser.add_argument("--csv-route", action="store_true",
+                        help="go the old way, through the CSV files, into the DB")
+    parser.add_argument("--csv-side-output", action="store_true",
+                        help="still write the CSV files when going straight into the DB")
+    parser.add_argument("--parse-workers", type=int, default=1,
+                        help="parse the XML on this many cores (on the CSV route)")
+    parser.add_argument("--node-store", choices=["dense", "sparse"], default=None,
+                        help="keep node locations in a memory-mapped file")
+    parser.add_argument("--correct-after-load", action="store_true",
+                        help="apply the corrections to the DB after loading, not while parsing "
+                        "(or while applying a change file)")
+    parser.add_argument("--corrections", default=None,
+                        help="the correction rules (default: corrections.csv next to this script)")
+    parser.add_argument("--csv-compression", choices=["gzip", "zstd"], default=None,
+                        help="write the CSV files compressed")
+    parser.add_argument("--csv-writer-thread", action="store_true",
+                        help="compress and write the CSV files in a separate thread")
+    parser.add_argument("--columnar-dir", default=None,
+                        help="write the tables to Parquet files in this directory too (needs "
+                        "pyarrow)")
+    parser.add_argument("--fast-parse", action="store_true",
+                        help="use the fast XML parser (it skips the tag structure tallies)")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="load with SQLite tuned for bulk inserts, building the indexes after")
+    parser.add_argument("--resumable", action="store_true",
+                        help="checkpoint the load, and carry on from the last checkpoint if it was "
+                        "cut short (on the CSV route, writing the CSV files starts over unless "
+                        "it had finished; loading them carries on)")
+    parser.add_argument("--checkpoint-mb", type=int, default=DEFAULT_CHECKPOINT_BYTES >> 20,
+                        help="MB of the OSM file between checkpoints")
+    parser.add_argument("--checkpoint-rows", type=int, default=DEFAULT_CHECKPOINT_ROWS,
+                        help="rows of the CSV files between checkpoints (on the CSV route)")
+    parser.add_argument("--summary", default=None,
+                        help="write the timing summary to this file (JSON) as well")
+    args = parser.parse_args()
+    if (args.db is not None) and (len(args.osm_files) > 1):
+        parser.error("--db only goes with a single input file")
+    try:
+        options = PipelineOptions(stages=args.stages, skip_csvs=not args.csv_route,
+                                  csv_side_output=args.csv_side_output,
+                                  parse_workers=args.parse_workers, osc_file=args.osc,
+                                  node_store_layout=args.node_store,
+                                  correct_while_parsing=not args.correct_after_load,
+                                  csv_compression=args.csv_compression,
+                                  csv_writer_thread=args.csv_writer_thread,
+                                  columnar_dir=args.columnar_dir, fast_parse=args.fast_parse,
+                                  corrections_file=args.corrections, bulk_load=args.bulk_load,
+                                  checkpoints=args.resumable,
+                                  checkpoint_bytes=args.checkpoint_mb << 20,
+                                  checkpoint_rows=args.checkpoint_rows)
+    except ValueError as err:
+        parser.error(str(err))
+    if len(args.osm_files) == 1:
+        summaries = [run_region(args.osm_files[0], args.output_dir, options, db_file=args.db)]
+    else:
+        summaries = run_regions(args.osm_files, args.output_dir, options, args.jobs)
+    prt_pipeline_summary(summaries)
+    if args.summary is not None:
+        with open(args.summary, "w") as summary_file:
+            json.dump(summaries, summary_file, indent=2)
+    if any(summary["error"] is not None for summary in summaries):
+        sys.exit(1)
     print("Done!")
 
-main()
+if __name__ == "__main__":
+    main()
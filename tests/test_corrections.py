@@ -0,0 +1,58 @@
+"""Checks that correcting the tags in the DB after the load (apply_corrections_to_sql_db) gives the
+same DB as correcting them while parsing."""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import osmbench
+import parseosm
+
+TAGS_TABLES = ["nodes_tags", "ways_tags", "relations_tags"]
+
+def table_contents(db_file, tblname):
+    """All the rows of a table, sorted, so tables can be compared whatever order they went in"""
+    conn = sqlite3.connect(db_file)
+    try:
+        return sorted(conn.execute("SELECT * FROM " + tblname + ";").fetchall(), key=repr)
+    finally:
+        conn.close()
+
+class CorrectAfterLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="osmtest-")
+        self.osm_file = os.path.join(self.workdir, "test.osm")
+        osmbench.generate_osm(self.osm_file, 5000, seed=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def load(self, name, correct_while_parsing):
+        """Loads the test file into its own DB, correcting the tags one way or the other, and
+returns the DB's file name"""
+        options = parseosm.PipelineOptions(stages=["load", "corrections", "stats"],
+                                           correct_while_parsing=correct_while_parsing)
+        output_dir = os.path.join(self.workdir, name)
+        os.makedirs(output_dir)
+        summary = parseosm.run_region(self.osm_file, output_dir, options,
+                                      log_file=os.path.join(output_dir, "log.txt"))
+        self.assertIsNone(summary["error"])
+        return summary["db"]
+
+    def test_same_as_inline(self):
+        inline_db = self.load("inline", True)
+        after_db = self.load("after", False)
+        # the made-up file has misspelled street names on relations too
+        relation_tags = table_contents(inline_db, "relations_tags")
+        self.assertTrue(any(row[1] == "street" for row in relation_tags))
+        for tblname in TAGS_TABLES + ["osm_tag_counts"]:
+            self.assertEqual(table_contents(inline_db, tblname),
+                             table_contents(after_db, tblname), tblname)
+
+if __name__ == "__main__":
+    unittest.main()
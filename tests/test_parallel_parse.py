@@ -0,0 +1,60 @@
+"""Checks that parsing on several cores writes the same CSV files as parsing on one."""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import csvsink
+import osmbench
+import parseosm
+
+class ParallelParseTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="osmtest-")
+        self.osm_file = os.path.join(self.workdir, "test.osm")
+        osmbench.generate_osm(self.osm_file, 5000, seed=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def csv_files(self, name, workers):
+        """Writes the CSV files for the test file into a directory of their own, with the given
+number of workers (1 for the serial parser), and returns their contents by table"""
+        directory = os.path.join(self.workdir, name)
+        os.makedirs(directory)
+        sink = csvsink.CsvSink(directory=directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            if workers == 1:
+                parseosm.generate_csvs(self.osm_file, sink=sink)
+            else:
+                parseosm.generate_csvs_parallel(self.osm_file, workers=workers, sink=sink)
+        contents = {}
+        for tblname in parseosm.OSM_TABLES:
+            with open(sink.filename(tblname + ".csv"), "rb") as csvfile:
+                contents[tblname] = csvfile.read()
+        return contents
+
+    def test_same_as_serial(self):
+        serial = self.csv_files("serial", 1)
+        self.assertTrue(all(serial.values()))
+        for workers in [2, 3, 7]:
+            parallel = self.csv_files("parallel" + str(workers), workers)
+            for tblname in parseosm.OSM_TABLES:
+                self.assertEqual(serial[tblname], parallel[tblname],
+                                 tblname + " with " + str(workers) + " workers")
+
+    def test_workers_need_csv_route(self):
+        with self.assertRaises(ValueError):
+            parseosm.PipelineOptions(parse_workers=2)
+        with self.assertRaises(ValueError):
+            parseosm.PipelineOptions(parse_workers=2, skip_csvs=False, node_store_layout="sparse")
+        parseosm.PipelineOptions(parse_workers=2, skip_csvs=False)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,242 @@
+"""Checks the PBF reader on a small file written by the test itself, through the serial path and
+the pool of worker processes."""
+
+import calendar
+import contextlib
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import osmpbf
+import parseosm
+
+# ----------------------------------------------------------------
+# just enough of a protobuf and PBF writer to make the test file
+
+def varint(value):
+    """A varint (negative numbers as 64-bit two's complement, like int64)"""
+    value = value & ((1 << 64) - 1)
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value = value >> 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def zigzag(value):
+    """The zigzag encoding of a sint64"""
+    return (value << 1) ^ (value >> 63)
+
+def int_field(field, value):
+    return varint(field << 3) + varint(value)
+
+def bytes_field(field, data):
+    return varint((field << 3) | 2) + varint(len(data)) + data
+
+def packed(values):
+    return b"".join(varint(value) for value in values)
+
+def packed_sint_deltas(values):
+    """A packed sint64 field, delta coded"""
+    last = 0
+    out = []
+    for value in values:
+        out.append(zigzag(value - last))
+        last = value
+    return packed(out)
+
+def seconds(stamp):
+    return calendar.timegm((int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10]),
+                            int(stamp[11:13]), int(stamp[14:16]), int(stamp[17:19])))
+
+class StringTable:
+    def __init__(self):
+        self.strings = [""]
+
+    def sid(self, string):
+        if string not in self.strings:
+            self.strings.append(string)
+        return self.strings.index(string)
+
+    def encode(self):
+        return b"".join(bytes_field(1, string.encode("utf-8")) for string in self.strings)
+
+def info_message(strings, user, uid, version, changeset, timestamp):
+    return (int_field(1, version) + int_field(2, seconds(timestamp)) + int_field(3, changeset) +
+            int_field(4, uid) + int_field(5, strings.sid(user)))
+
+def tags_fields(strings, tags):
+    return (bytes_field(2, packed([strings.sid(key) for key, value in tags])) +
+            bytes_field(3, packed([strings.sid(value) for key, value in tags])))
+
+def dense_group(strings, nodes):
+    """A PrimitiveGroup with nodes (id, lat, lon in 1e-7 degrees, user, uid, version, changeset,
+timestamp, tags) as DenseNodes"""
+    keys_vals = []
+    for node in nodes:
+        for key, value in node[8]:
+            keys_vals.extend([strings.sid(key), strings.sid(value)])
+        keys_vals.append(0)
+    info = (bytes_field(1, packed([node[5] for node in nodes])) +
+            bytes_field(2, packed_sint_deltas([seconds(node[7]) for node in nodes])) +
+            bytes_field(3, packed_sint_deltas([node[6] for node in nodes])) +
+            bytes_field(4, packed_sint_deltas([node[4] for node in nodes])) +
+            bytes_field(5, packed_sint_deltas([strings.sid(node[3]) for node in nodes])))
+    dense = (bytes_field(1, packed_sint_deltas([node[0] for node in nodes])) +
+             bytes_field(5, info) +
+             bytes_field(8, packed_sint_deltas([node[1] for node in nodes])) +
+             bytes_field(9, packed_sint_deltas([node[2] for node in nodes])) +
+             bytes_field(10, packed(keys_vals)))
+    return bytes_field(2, dense)
+
+def node_group(strings, node):
+    """A PrimitiveGroup with one (non-dense) Node"""
+    message = (int_field(1, zigzag(node[0])) + tags_fields(strings, node[8]) +
+               bytes_field(4, info_message(strings, *node[3:8])) +
+               int_field(8, zigzag(node[1])) + int_field(9, zigzag(node[2])))
+    return bytes_field(1, message)
+
+def way_group(strings, way):
+    """A PrimitiveGroup with one Way (id, user, uid, version, changeset, timestamp, tags, refs)"""
+    message = (int_field(1, way[0]) + tags_fields(strings, way[6]) +
+               bytes_field(4, info_message(strings, *way[1:6])) +
+               bytes_field(8, packed_sint_deltas(way[7])))
+    return bytes_field(3, message)
+
+def relation_group(strings, relation):
+    """A PrimitiveGroup with one Relation (id, user, uid, version, changeset, timestamp, tags,
+members)"""
+    members = relation[7]
+    message = (int_field(1, relation[0]) + tags_fields(strings, relation[6]) +
+               bytes_field(4, info_message(strings, *relation[1:6])) +
+               bytes_field(8, packed([strings.sid(role) for mtype, ref, role in members])) +
+               bytes_field(9, packed_sint_deltas([ref for mtype, ref, role in members])) +
+               bytes_field(10, packed([osmpbf.MEMBER_TYPES.index(mtype)
+                                       for mtype, ref, role in members])))
+    return bytes_field(4, message)
+
+def blob(blob_type, data, compress):
+    if compress:
+        body = int_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+    else:
+        body = bytes_field(1, data)
+    header = bytes_field(1, blob_type.encode("utf-8")) + int_field(3, len(body))
+    return struct.pack(">I", len(header)) + header + body
+
+# ----------------------------------------------------------------
+# the test file
+
+DENSE_NODES = [
+    (10, 457640000, 48357000, "alice", 1, 2, 500, "2017-01-02T10:00:00Z",
+     [("amenity", "cafe"), ("name", "Café Ümlaut")]),
+    (12, -338688197, -1512092955, "bob", 2, 1, 499, "2016-12-31T23:59:59Z", []),
+    (11, 1, -1, "alice", 1, 7, 501, "2017-01-03T00:00:00Z", [("addr:street", "Rue moliere")]),
+]
+NODE = (20, 15000000, 22500000, "cé'cile", 3, 1, 600, "2017-02-01T12:30:00Z",
+        [("natural", "tree")])
+WAY = (100, "bob", 2, 3, 700, "2017-03-01T08:00:00Z", [("highway", "residential")],
+       [10, 12, 11, 20, 10])
+RELATION = (200, "alice", 1, 1, 800, "2017-04-01T00:00:00Z", [("type", "multipolygon")],
+            [("node", 10, "label"), ("way", 100, "outer"), ("relation", 201, "")])
+
+def write_test_pbf(filename):
+    with open(filename, "wb") as pbffile:
+        pbffile.write(blob("OSMHeader", bytes_field(4, b"OsmSchema-V0.6") +
+                           bytes_field(4, b"DenseNodes"), True))
+        strings = StringTable()
+        groups = bytes_field(2, dense_group(strings, DENSE_NODES))
+        pbffile.write(blob("OSMData", bytes_field(1, strings.encode()) + groups, True))
+        strings = StringTable()
+        groups = b"".join(bytes_field(2, group) for group in
+                          [node_group(strings, NODE), way_group(strings, WAY),
+                           relation_group(strings, RELATION)])
+        pbffile.write(blob("OSMData", bytes_field(1, strings.encode()) + groups, False))
+
+def expected_node(node, lat, lon):
+    return (node[0], lat, lon, node[3], str(node[4]), str(node[5]), str(node[6]), node[7],
+            node[8])
+
+EXPECTED = {
+    "nodes": [expected_node(DENSE_NODES[0], "45.7640000", "4.8357000"),
+              expected_node(DENSE_NODES[1], "-33.8688197", "-151.2092955"),
+              expected_node(DENSE_NODES[2], "0.0000001", "-0.0000001"),
+              expected_node(NODE, "1.5000000", "2.2500000")],
+    "ways": [(100, "bob", "2", "3", "700", "2017-03-01T08:00:00Z", [("highway", "residential")],
+              [10, 12, 11, 20, 10])],
+    "relations": [(200, "alice", "1", "1", "800", "2017-04-01T00:00:00Z",
+                   [("type", "multipolygon")],
+                   [("node", 10, "label"), ("way", 100, "outer"), ("relation", 201, "")])],
+}
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(list(row))
+
+class PbfTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="osmtest-")
+        self.pbf_file = os.path.join(self.workdir, "test.osm.pbf")
+        write_test_pbf(self.pbf_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def read_all(self, workers, blocks_ahead=None):
+        result = {"nodes": [], "ways": [], "relations": []}
+        blocks = 0
+        for block in osmpbf.read_pbf(self.pbf_file, workers, blocks_ahead):
+            blocks = blocks + 1
+            for kind in result:
+                result[kind].extend(block[kind])
+        self.assertEqual(blocks, 2)
+        return result
+
+    def test_serial(self):
+        self.assertEqual(self.read_all(1), EXPECTED)
+
+    def test_pool(self):
+        self.assertEqual(self.read_all(2), EXPECTED)
+        self.assertEqual(self.read_all(3, blocks_ahead=1), EXPECTED)
+
+    def test_rows(self):
+        for workers in [1, 2]:
+            writers = {tblname: ListWriter() for tblname in parseosm.OSM_TABLES}
+            with contextlib.redirect_stdout(io.StringIO()):
+                parseosm.parse_pbf_into_writers(self.pbf_file, writers, workers)
+            self.assertEqual([row[0] for row in writers["nodes"].rows], [10, 12, 11, 20])
+            self.assertEqual(writers["nodes_tags"].rows,
+                             [[10, "amenity", "cafe", "regular"],
+                              [10, "name", "Café Ümlaut", "regular"],
+                              [11, "street", "Rue Molière", "addr"],
+                              [20, "natural", "tree", "regular"]])
+            self.assertEqual(writers["ways_nodes"].rows,
+                             [[100, 10, 1], [100, 12, 2], [100, 11, 3], [100, 20, 4],
+                              [100, 10, 5]])
+            self.assertEqual(writers["relations_members"].rows,
+                             [[200, "node", 10, "label", 1], [200, "way", 100, "outer", 2],
+                              [200, "relation", 201, "", 3]])
+            self.assertEqual(writers["relations_tags"].rows,
+                             [[200, "type", "multipolygon", "regular"]])
+
+    def test_unsupported_feature(self):
+        with open(self.pbf_file, "wb") as pbffile:
+            pbffile.write(blob("OSMHeader", bytes_field(4, b"OsmSchema-V0.6") +
+                               bytes_field(4, b"HistoricalInformation"), True))
+        with self.assertRaises(osmpbf.PbfError):
+            list(osmpbf.read_pbf(self.pbf_file, 1))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""Runs the whole pipeline, with the default stages, on small made-up regions that aren't Lyon."""
+
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import osmbench
+import osmroute
+import parseosm
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="osmtest-")
+        self.osm_files = []
+        for region, seed in [("smallville", 1), ("hamlet", 2)]:
+            osm_file = os.path.join(self.workdir, region + ".osm")
+            osmbench.generate_osm(osm_file, 3000, seed=seed)
+            self.osm_files.append(osm_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def check_region(self, summary):
+        """Checks that a region went through every default stage and left a full DB behind"""
+        self.assertIsNone(summary["error"], summary["error"])
+        self.assertEqual([timing["stage"] for timing in summary["stages"]],
+                         [stage for stage in parseosm.PIPELINE_STAGES if stage != "osc"])
+        conn = sqlite3.connect(summary["db"])
+        try:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM nodes;").fetchone()[0], 3000)
+            self.assertGreater(conn.execute("SELECT COUNT(*) FROM way_geometry;").fetchone()[0], 0)
+            self.assertGreater(conn.execute("SELECT COUNT(*) FROM osm_stats;").fetchone()[0], 0)
+        finally:
+            conn.close()
+        self.assertTrue(os.path.exists(osmroute.graph_filename(summary["db"])))
+
+    def test_run_region(self):
+        output_dir = os.path.join(self.workdir, "one")
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary = parseosm.run_region(self.osm_files[0], output_dir)
+        self.assertEqual(summary["region"], "smallville")
+        self.check_region(summary)
+
+    def test_run_regions(self):
+        output_dir = os.path.join(self.workdir, "many")
+        with contextlib.redirect_stdout(io.StringIO()):
+            summaries = parseosm.run_regions(self.osm_files, output_dir, processes=2)
+        self.assertEqual([summary["region"] for summary in summaries], ["smallville", "hamlet"])
+        for summary in summaries:
+            self.assertEqual(os.path.dirname(summary["db"]),
+                             os.path.join(output_dir, summary["region"]))
+            self.check_region(summary)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+"""Checks the routing graph and the shortest paths over it, on a few hand-made streets."""
+
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import osmroute
+
+# the nodes on a grid of 0.001 degrees: id -> (row, column)
+#
+#     4 <-- 5 <-- 6        (way 101, oneway, goes west)
+#     |     |     |
+#     1 --- 2 --- 3        (way 100)
+#
+# with a footway 102 from 2 to 5, a oneway=-1 street 103 from 3 to 6 (so it goes from 6 to 3), a
+# street under construction 104 from 1 to 4, a building 106, and a street 105 from 7 to 8 that
+# isn't connected to the rest. Way 107 goes to node 99, which isn't in the extract, so it's left
+# out.
+NODES = {1: (0, 0), 2: (0, 1), 3: (0, 2), 4: (1, 0), 5: (1, 1), 6: (1, 2), 7: (5, 5), 8: (5, 6)}
+WAYS = [
+    (100, [1, 2, 3], [("highway", "residential")]),
+    (101, [6, 5, 4], [("highway", "residential"), ("oneway", "yes")]),
+    (102, [2, 5], [("highway", "footway")]),
+    (103, [3, 6], [("highway", "primary"), ("oneway", "-1")]),
+    (104, [1, 4], [("highway", "construction")]),
+    (105, [7, 8], [("highway", "service")]),
+    (106, [4, 5], [("building", "yes")]),
+    (107, [4, 99], [("highway", "residential")]),
+]
+
+def location(node_id):
+    row, column = NODES[node_id]
+    return 45.0 + 0.001 * row, 4.0 + 0.001 * column
+
+def path_length(node_ids):
+    """The length of a path through some of the nodes, in meters"""
+    return sum(osmroute.distance_m(*(location(first) + location(second)))
+               for first, second in zip(node_ids, node_ids[1:]))
+
+class RouteTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="osmtest-")
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE nodes (id INTEGER PRIMARY KEY, lat REAL, lon REAL);")
+        conn.execute("CREATE TABLE ways_nodes (id INTEGER, node_id INTEGER, position INTEGER);")
+        conn.execute("CREATE TABLE ways_tags (id INTEGER, key TEXT, value TEXT, type TEXT);")
+        for node_id in NODES:
+            conn.execute("INSERT INTO nodes VALUES (?, ?, ?);", (node_id,) + location(node_id))
+        for way_id, refs, tags in WAYS:
+            for position, node_id in enumerate(refs):
+                conn.execute("INSERT INTO ways_nodes VALUES (?, ?, ?);",
+                             (way_id, node_id, position + 1))
+            for key, value in tags:
+                conn.execute("INSERT INTO ways_tags VALUES (?, ?, ?, 'regular');",
+                             (way_id, key, value))
+        self.osmcu = conn.cursor()
+        self.graphs = []
+
+    def tearDown(self):
+        for graph in self.graphs:
+            graph.close()
+        self.osmcu.connection.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def build(self, respect_oneway=True):
+        filename = os.path.join(self.workdir, "test" + str(len(self.graphs)) + ".graph")
+        with contextlib.redirect_stdout(io.StringIO()):
+            info = osmroute.build_routing_graph(self.osmcu, filename, respect_oneway)
+        graph = osmroute.RoutingGraph(filename)
+        self.graphs.append(graph)
+        return info, graph
+
+    def test_graph(self):
+        info, graph = self.build()
+        self.assertEqual(info, {"ways": 5, "nodes": 8, "edges": 11})
+        self.assertEqual(list(graph.node_ids), [1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual((graph.num_nodes, graph.num_edges), (8, 11))
+        for node_id in NODES:
+            lat, lon = graph.node_location(graph.node_index(node_id))
+            self.assertAlmostEqual(lat, location(node_id)[0], places=7)
+            self.assertAlmostEqual(lon, location(node_id)[1], places=7)
+
+    def test_route(self):
+        info, graph = self.build()
+        for method in ["astar", "dijkstra"]:
+            route = graph.route_between_nodes(1, 4, method)
+            self.assertEqual(route["nodes"], [1, 2, 5, 4])
+            self.assertEqual(route["ways"], [100, 102, 101])
+            self.assertAlmostEqual(route["distance_m"], path_length([1, 2, 5, 4]), delta=0.03)
+            # 3 to 6 is against the oneway, so we go around
+            route = graph.route_between_nodes(3, 4, method)
+            self.assertEqual(route["nodes"], [3, 2, 5, 4])
+
+    def test_same_distances(self):
+        info, graph = self.build()
+        for source in range(graph.num_nodes):
+            for target in range(graph.num_nodes):
+                dijkstra = graph.shortest_path(source, target, "dijkstra")
+                astar = graph.shortest_path(source, target, "astar")
+                self.assertEqual(dijkstra is None, astar is None)
+                if dijkstra is not None:
+                    self.assertEqual(dijkstra[0], astar[0])
+                    self.assertEqual(sum(graph.lengths[edge] for edge in astar[1]), astar[0])
+
+    def test_unreachable(self):
+        info, graph = self.build()
+        # nothing leaves 4 (the oneway only comes in, the street under construction doesn't count)
+        self.assertIsNone(graph.route_between_nodes(4, 1))
+        self.assertIsNone(graph.route_between_nodes(1, 7, "dijkstra"))
+        with self.assertRaises(ValueError):
+            graph.route_between_nodes(1, 99)
+        # on foot the oneways go both ways
+        info, graph = self.build(respect_oneway=False)
+        self.assertEqual(info["edges"], 14)
+        self.assertEqual(graph.route_between_nodes(4, 1)["nodes"], [4, 5, 2, 1])
+
+    def test_nearest_node(self):
+        info, graph = self.build()
+        lat, lon = location(5)
+        nearest = graph.nearest_node(lat + 0.0001, lon - 0.0001)
+        self.assertEqual(graph.node_ids[nearest], 5)
+        self.assertEqual(graph.node_ids[graph.nearest_node(45.0049, 4.0049)], 7)
+        self.assertIsNone(graph.nearest_node(45.0025, 4.0035, max_distance_m=100))
+        route = graph.route_between(45.0, 4.0, 45.001, 4.0)
+        self.assertEqual(route["nodes"], [1, 2, 5, 4])
+
+    def test_not_a_graph(self):
+        filename = os.path.join(self.workdir, "bad.graph")
+        with open(filename, "wb") as badfile:
+            badfile.write(b"not a graph at all, not even close to one")
+        with self.assertRaises(ValueError):
+            osmroute.RoutingGraph(filename)
+
+if __name__ == "__main__":
+    unittest.main()
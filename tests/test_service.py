@@ -0,0 +1,101 @@
+"""Checks the query service's answers, its cache, and what it does when the DB changes."""
+
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import osmbench
+import osmservice
+import parseosm
+
+class ServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="osmtest-")
+        osm_file = os.path.join(self.workdir, "town.osm")
+        osmbench.generate_osm(osm_file, 3000, seed=4)
+        options = parseosm.PipelineOptions(stages=["load", "spatial_index", "stats"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary = parseosm.run_region(osm_file, self.workdir, options)
+        self.assertIsNone(summary["error"], summary["error"])
+        self.db_file = summary["db"]
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def run_service(self, steps):
+        """Runs steps(service) inside the event loop, with a service on the test DB"""
+        async def run():
+            service = osmservice.QueryService(self.db_file, pool_size=2)
+            try:
+                return await steps(service)
+            finally:
+                await service.close()
+        return asyncio.run(run())
+
+    def test_cache_hit(self):
+        async def steps(service):
+            first = await osmservice.answer_request(service, "GET",
+                                                    "/query/tag_counts?key=amenity&top=3")
+            second = await osmservice.answer_request(service, "GET",
+                                                     "/query/tag_counts?key=amenity&top=3")
+            return first, second, service.stats()["cache"]
+        first, second, cache = self.run_service(steps)
+        self.assertEqual(first[0], 200)
+        self.assertEqual(len(first[1]["result"]), 3)
+        self.assertEqual(first, second)
+        self.assertEqual((cache["misses"], cache["hits"], cache["entries"]), (1, 1, 1))
+
+    def test_reload_when_db_changes(self):
+        async def steps(service):
+            before = await service.query("tag_counts", {"key": "amenity"})
+            conn = sqlite3.connect(self.db_file)
+            conn.execute("UPDATE nodes_tags SET value = 'observatory' \
+                          WHERE (type = 'regular') AND (key = 'amenity');")
+            conn.commit()
+            conn.close()
+            after = await service.query("tag_counts", {"key": "amenity"})
+            return before, after, service.reloads
+        before, after, reloads = self.run_service(steps)
+        self.assertNotIn("observatory", [value for value, count in before])
+        self.assertEqual([value for value, count in after], ["observatory"])
+        self.assertEqual(reloads, 1)
+
+    def test_bad_arguments(self):
+        async def steps(service):
+            answers = []
+            for target in ["/query/tag_counts?key=amenity&top=-1",
+                           "/query/tag_counts?key=amenity&top=0",
+                           "/query/nodes_in_bbox?min_lat=45&min_lon=4&max_lat=46&max_lon=5"
+                           "&limit=100000",
+                           "/query/way_geometry"]:
+                answers.append(await osmservice.answer_request(service, "GET", target))
+            return answers
+        for status, body in self.run_service(steps):
+            self.assertEqual(status, 400, body)
+
+    def test_bbox_limit(self):
+        async def steps(service):
+            return await service.query("nodes_in_bbox", {"min_lat": "-90", "min_lon": "-180",
+                                                         "max_lat": "90", "max_lon": "180",
+                                                         "limit": "7"})
+        self.assertEqual(len(self.run_service(steps)), 7)
+
+    def test_db_gone(self):
+        async def steps(service):
+            os.rename(self.db_file, self.db_file + ".moved")
+            return (await osmservice.answer_request(service, "GET", "/reload"),
+                    await osmservice.answer_request(service, "GET", "/query/counts"))
+        reload_answer, query_answer = self.run_service(steps)
+        self.assertEqual(reload_answer[0], 500)
+        self.assertEqual(query_answer[0], 500)
+
+if __name__ == "__main__":
+    unittest.main()